@@ -8,8 +8,10 @@ from sqlalchemy import pool
 from alembic import context
 
 from src.config import get_database_info
+from src.database.migrations import set_timeouts, check_access_exclusive_locks
 from src.auth.models import Base as UserBase
 from src.tasks.models import Base as TasksBase
+import src.idempotency  # noqa: F401, registers `idempotency_keys`
 
 sys.path.append(os.path.join(sys.path[0], 'src'))
 
@@ -64,6 +66,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        transaction_per_migration=True,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -86,8 +89,14 @@ def run_migrations_online() -> None:
     )
 
     with connectable.connect() as connection:
+        # guards of online migrations, see `src.database.migrations`
+        set_timeouts(connection)
+        connection.commit()
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection,
+            target_metadata=target_metadata,
+            transaction_per_migration=True,
+            on_version_apply=[check_access_exclusive_locks]
         )
 
         with context.begin_transaction():
@@ -0,0 +1,46 @@
+"""Task versions and tombstones
+
+Revision ID: 0299e5e90fb7
+Revises: 9749b5c21194
+Create Date: 2023-07-03 12:10:42.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from src.database.migrations import lift_statement_timeout
+
+
+# revision identifiers, used by Alembic.
+revision = '0299e5e90fb7'
+down_revision = '9749b5c21194'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    lift_statement_timeout()
+    op.execute(sa.schema.CreateSequence(sa.Sequence('tasks_version_seq')))
+    op.add_column('tasks', sa.Column('version', sa.BigInteger(),
+                                     server_default=sa.text("nextval('tasks_version_seq')"),
+                                     nullable=False))
+    op.execute('UPDATE tasks SET expired = false WHERE expired IS NULL')
+    op.create_index('ix_tasks_creator_id_version', 'tasks', ['creator_id', 'version'], unique=False)
+    op.create_table('tasks_tombstones',
+    sa.Column('id', sa.UUID(), nullable=False),
+    sa.Column('creator_id', sa.UUID(), nullable=False),
+    sa.Column('version', sa.BigInteger(), server_default=sa.text("nextval('tasks_version_seq')"), nullable=False),
+    sa.Column('deleted', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.ForeignKeyConstraint(['creator_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_tasks_tombstones_creator_id_version', 'tasks_tombstones',
+                    ['creator_id', 'version'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_tasks_tombstones_creator_id_version', table_name='tasks_tombstones')
+    op.drop_table('tasks_tombstones')
+    op.drop_index('ix_tasks_creator_id_version', table_name='tasks')
+    op.drop_column('tasks', 'version')
+    op.execute(sa.schema.DropSequence(sa.Sequence('tasks_version_seq')))
@@ -0,0 +1,28 @@
+"""User versions
+
+Revision ID: b50beb26ff2b
+Revises: 0299e5e90fb7
+Create Date: 2023-07-05 18:34:09.871254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b50beb26ff2b'
+down_revision = '0299e5e90fb7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute(sa.schema.CreateSequence(sa.Sequence('users_version_seq')))
+    op.add_column('users', sa.Column('version', sa.BigInteger(),
+                                     server_default=sa.text("nextval('users_version_seq')"),
+                                     nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'version')
+    op.execute(sa.schema.DropSequence(sa.Sequence('users_version_seq')))
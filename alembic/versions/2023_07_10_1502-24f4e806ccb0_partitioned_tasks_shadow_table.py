@@ -0,0 +1,107 @@
+"""Partitioned tasks shadow table
+
+Revision ID: 24f4e806ccb0
+Revises: b50beb26ff2b
+Create Date: 2023-07-10 15:02:37.412961
+
+First step of the online move of `tasks` to hash partitioning:
+    1. this migration creates `tasks_partitioned` and a trigger which
+       mirrors every write to `tasks` into it;
+    2. `python -m src.tasks.partitioning` copies existing rows in
+       small batches while the application keeps running; it is not
+       needed when `tasks` is empty, this migration marks the shadow
+       table as backfilled then;
+    3. migration 8a68672dd75b swaps the tables.
+
+Tasks without creator can not be partitioned by creator, they are
+left in the old table; migration 8a68672dd75b logs how many.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '24f4e806ccb0'
+down_revision = 'b50beb26ff2b'
+branch_labels = None
+depends_on = None
+
+TASKS_PARTITIONS = 16
+
+# Mirrors writes to `tasks` into `tasks_partitioned` until the swap.
+# Kept here verbatim, the migration must not change with the app code.
+MIRROR_FUNCTION_SQL = """
+    CREATE FUNCTION tasks_mirror_to_partitioned() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.creator_id IS DISTINCT FROM NEW.creator_id) THEN
+            DELETE FROM tasks_partitioned
+            WHERE creator_id = OLD.creator_id AND id = OLD.id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.creator_id IS NOT NULL THEN
+            INSERT INTO tasks_partitioned
+                (id, creator_id, title, task_text, created, updated, deadline, expired, version)
+            VALUES
+                (NEW.id, NEW.creator_id, NEW.title, NEW.task_text, NEW.created,
+                 NEW.updated, NEW.deadline, NEW.expired, NEW.version)
+            ON CONFLICT (creator_id, id) DO UPDATE SET
+                title = EXCLUDED.title,
+                task_text = EXCLUDED.task_text,
+                created = EXCLUDED.created,
+                updated = EXCLUDED.updated,
+                deadline = EXCLUDED.deadline,
+                expired = EXCLUDED.expired,
+                version = EXCLUDED.version;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+MIRROR_TRIGGER_SQL = """
+    CREATE TRIGGER tasks_mirror_to_partitioned
+    AFTER INSERT OR UPDATE OR DELETE ON tasks
+    FOR EACH ROW EXECUTE FUNCTION tasks_mirror_to_partitioned()
+"""
+
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE TABLE tasks_partitioned (
+            id UUID NOT NULL,
+            creator_id UUID NOT NULL REFERENCES users (id),
+            title VARCHAR(150) NOT NULL,
+            task_text TEXT NOT NULL,
+            created TIMESTAMP WITH TIME ZONE DEFAULT now(),
+            updated TIMESTAMP WITH TIME ZONE,
+            deadline DATE NOT NULL,
+            expired BOOLEAN,
+            version BIGINT DEFAULT nextval('tasks_version_seq') NOT NULL,
+            CONSTRAINT tasks_partitioned_pkey PRIMARY KEY (creator_id, id)
+        ) PARTITION BY HASH (creator_id)
+    """)
+    for remainder in range(TASKS_PARTITIONS):
+        op.execute(f"""
+            CREATE TABLE tasks_p{remainder:02d} PARTITION OF tasks_partitioned
+            FOR VALUES WITH (MODULUS {TASKS_PARTITIONS}, REMAINDER {remainder})
+        """)
+    op.execute('CREATE INDEX ix_tasks_partitioned_creator_id_version '
+               'ON tasks_partitioned (creator_id, version)')
+
+    op.execute(MIRROR_FUNCTION_SQL)
+    op.execute(MIRROR_TRIGGER_SQL)
+    # The trigger mirrors every write from now on, so with no rows to
+    # copy, as on a fresh database, the table is ready for the swap.
+    op.execute("""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM tasks WHERE creator_id IS NOT NULL) THEN
+                COMMENT ON TABLE tasks_partitioned IS 'backfilled';
+            END IF;
+        END
+        $$
+    """)
+
+
+def downgrade() -> None:
+    op.execute('DROP TRIGGER tasks_mirror_to_partitioned ON tasks')
+    op.execute('DROP FUNCTION tasks_mirror_to_partitioned()')
+    op.drop_table('tasks_partitioned')
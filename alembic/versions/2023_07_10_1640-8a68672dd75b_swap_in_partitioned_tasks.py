@@ -0,0 +1,120 @@
+"""Swap in partitioned tasks
+
+Revision ID: 8a68672dd75b
+Revises: 24f4e806ccb0
+Create Date: 2023-07-10 16:40:12.925316
+
+Requires the backfill `python -m src.tasks.partitioning` to be
+finished, unless `tasks` was empty at migration 24f4e806ccb0. The swap
+itself only renames tables, so `tasks` is locked for a moment. The old
+table is kept as `tasks_unpartitioned`.
+
+Tasks without a creator can not be partitioned by it and are neither
+backfilled nor mirrored. They stay behind in `tasks_unpartitioned`, and
+the migration logs how many there are.
+"""
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+from src.database.migrations import lift_statement_timeout
+
+
+# revision identifiers, used by Alembic.
+revision = '8a68672dd75b'
+down_revision = '24f4e806ccb0'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+# Recreated by the downgrade, as in migration 24f4e806ccb0.
+MIRROR_FUNCTION_SQL = """
+    CREATE FUNCTION tasks_mirror_to_partitioned() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.creator_id IS DISTINCT FROM NEW.creator_id) THEN
+            DELETE FROM tasks_partitioned
+            WHERE creator_id = OLD.creator_id AND id = OLD.id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.creator_id IS NOT NULL THEN
+            INSERT INTO tasks_partitioned
+                (id, creator_id, title, task_text, created, updated, deadline, expired, version)
+            VALUES
+                (NEW.id, NEW.creator_id, NEW.title, NEW.task_text, NEW.created,
+                 NEW.updated, NEW.deadline, NEW.expired, NEW.version)
+            ON CONFLICT (creator_id, id) DO UPDATE SET
+                title = EXCLUDED.title,
+                task_text = EXCLUDED.task_text,
+                created = EXCLUDED.created,
+                updated = EXCLUDED.updated,
+                deadline = EXCLUDED.deadline,
+                expired = EXCLUDED.expired,
+                version = EXCLUDED.version;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+MIRROR_TRIGGER_SQL = """
+    CREATE TRIGGER tasks_mirror_to_partitioned
+    AFTER INSERT OR UPDATE OR DELETE ON tasks
+    FOR EACH ROW EXECUTE FUNCTION tasks_mirror_to_partitioned()
+"""
+
+TASK_COLUMNS = 'id, creator_id, title, task_text, created, updated, deadline, expired, version'
+
+
+def upgrade() -> None:
+    connection = op.get_bind()
+    mark = connection.execute(sa.text("SELECT obj_description('tasks_partitioned'::regclass, 'pg_class')")).scalar()
+    if mark != 'backfilled':
+        raise RuntimeError('tasks_partitioned is not backfilled yet, '
+                           'run `python -m src.tasks.partitioning` first.')
+    op.execute('LOCK TABLE tasks IN ACCESS EXCLUSIVE MODE')
+    op.execute('DROP TRIGGER tasks_mirror_to_partitioned ON tasks')
+    op.execute('DROP FUNCTION tasks_mirror_to_partitioned()')
+    left_behind = connection.execute(sa.text('SELECT count(*) FROM tasks WHERE creator_id IS NULL')).scalar()
+    if left_behind:
+        logger.warning('%s tasks without a creator are left behind in tasks_unpartitioned', left_behind)
+
+    op.execute('ALTER TABLE tasks RENAME TO tasks_unpartitioned')
+    op.execute('ALTER TABLE tasks_unpartitioned RENAME CONSTRAINT tasks_pkey TO tasks_unpartitioned_pkey')
+    op.execute('ALTER INDEX ix_tasks_creator_id_version RENAME TO ix_tasks_unpartitioned_creator_id_version')
+
+    op.execute('ALTER TABLE tasks_partitioned RENAME TO tasks')
+    op.execute('ALTER TABLE tasks RENAME CONSTRAINT tasks_partitioned_pkey TO tasks_pkey')
+    op.execute('ALTER INDEX ix_tasks_partitioned_creator_id_version RENAME TO ix_tasks_creator_id_version')
+    op.execute('COMMENT ON TABLE tasks IS NULL')
+
+
+def downgrade() -> None:
+    lift_statement_timeout()
+    op.execute('LOCK TABLE tasks IN ACCESS EXCLUSIVE MODE')
+    # bring rows written since the swap back to the old table
+    op.execute(f"""
+        INSERT INTO tasks_unpartitioned ({TASK_COLUMNS})
+        SELECT {TASK_COLUMNS} FROM tasks
+        ON CONFLICT (id) DO UPDATE SET
+            title = EXCLUDED.title,
+            task_text = EXCLUDED.task_text,
+            updated = EXCLUDED.updated,
+            deadline = EXCLUDED.deadline,
+            expired = EXCLUDED.expired,
+            version = EXCLUDED.version
+    """)
+    op.execute("""
+        DELETE FROM tasks_unpartitioned old
+        WHERE old.creator_id IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM tasks t WHERE t.creator_id = old.creator_id AND t.id = old.id)
+    """)
+    op.execute('ALTER TABLE tasks RENAME TO tasks_partitioned')
+    op.execute('ALTER TABLE tasks_partitioned RENAME CONSTRAINT tasks_pkey TO tasks_partitioned_pkey')
+    op.execute('ALTER INDEX ix_tasks_creator_id_version RENAME TO ix_tasks_partitioned_creator_id_version')
+    op.execute("COMMENT ON TABLE tasks_partitioned IS 'backfilled'")
+
+    op.execute('ALTER TABLE tasks_unpartitioned RENAME TO tasks')
+    op.execute('ALTER TABLE tasks RENAME CONSTRAINT tasks_unpartitioned_pkey TO tasks_pkey')
+    op.execute('ALTER INDEX ix_tasks_unpartitioned_creator_id_version RENAME TO ix_tasks_creator_id_version')
+    op.execute(MIRROR_FUNCTION_SQL)
+    op.execute(MIRROR_TRIGGER_SQL)
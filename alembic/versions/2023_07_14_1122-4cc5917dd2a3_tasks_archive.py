@@ -0,0 +1,43 @@
+"""Tasks archive
+
+Revision ID: 4cc5917dd2a3
+Revises: 8a68672dd75b
+Create Date: 2023-07-14 11:22:51.604117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4cc5917dd2a3'
+down_revision = '8a68672dd75b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('tasks_archive',
+    sa.Column('id', sa.UUID(), nullable=False),
+    sa.Column('creator_id', sa.UUID(), nullable=False),
+    sa.Column('title', sa.String(length=150), nullable=False),
+    sa.Column('task_text', sa.Text(), nullable=False),
+    sa.Column('created', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('updated', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('deadline', sa.Date(), nullable=False),
+    sa.Column('expired', sa.Boolean(), nullable=True),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.Column('archived', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.ForeignKeyConstraint(['creator_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('creator_id', 'id')
+    )
+    op.create_index('ix_tasks_deadline_pending', 'tasks', ['deadline', 'creator_id'],
+                    unique=False, postgresql_where=sa.text('NOT expired'))
+    op.create_index('ix_tasks_archivable', 'tasks', [sa.text('coalesce(updated, created)')],
+                    unique=False, postgresql_where=sa.text('expired'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_tasks_archivable', table_name='tasks')
+    op.drop_index('ix_tasks_deadline_pending', table_name='tasks')
+    op.drop_table('tasks_archive')
@@ -0,0 +1,54 @@
+"""User task stats
+
+Revision ID: bc4893fb5546
+Revises: 4cc5917dd2a3
+Create Date: 2023-07-17 10:45:12.381904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from src.database.migrations import lift_statement_timeout
+
+
+# revision identifiers, used by Alembic.
+revision = 'bc4893fb5546'
+down_revision = '4cc5917dd2a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    lift_statement_timeout()
+    op.create_table('user_task_stats',
+    sa.Column('user_id', sa.UUID(), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.Column('expired', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_table('user_task_deadlines',
+    sa.Column('user_id', sa.UUID(), nullable=False),
+    sa.Column('deadline', sa.Date(), nullable=False),
+    sa.Column('pending', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'deadline')
+    )
+    op.execute("""
+        INSERT INTO user_task_stats (user_id, total, expired)
+        SELECT u.id, count(t.id), count(t.id) FILTER (WHERE t.expired)
+        FROM users u
+        LEFT JOIN tasks t ON t.creator_id = u.id
+        GROUP BY u.id
+    """)
+    op.execute("""
+        INSERT INTO user_task_deadlines (user_id, deadline, pending)
+        SELECT creator_id, deadline, count(*) FROM tasks
+        WHERE NOT expired
+        GROUP BY creator_id, deadline
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table('user_task_deadlines')
+    op.drop_table('user_task_stats')
@@ -0,0 +1,30 @@
+"""Deadline digests
+
+Revision ID: bff9aab83f28
+Revises: bc4893fb5546
+Create Date: 2023-07-18 09:15:40.227513
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'bff9aab83f28'
+down_revision = 'bc4893fb5546'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('deadline_digests',
+    sa.Column('user_id', sa.UUID(), nullable=False),
+    sa.Column('digest_date', sa.Date(), nullable=False),
+    sa.Column('sent', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'digest_date')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('deadline_digests')
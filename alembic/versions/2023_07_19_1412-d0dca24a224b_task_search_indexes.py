@@ -0,0 +1,32 @@
+"""Task search indexes
+
+Revision ID: d0dca24a224b
+Revises: bff9aab83f28
+Create Date: 2023-07-19 14:12:05.918342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from src.database.migrations import lift_statement_timeout
+
+
+# revision identifiers, used by Alembic.
+revision = 'd0dca24a224b'
+down_revision = 'bff9aab83f28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    lift_statement_timeout()
+    op.create_index('ix_tasks_creator_id_deadline', 'tasks', ['creator_id', 'deadline', 'id'], unique=False)
+    op.create_index('ix_tasks_creator_id_created', 'tasks', ['creator_id', 'created', 'id'], unique=False)
+    op.create_index('ix_tasks_creator_id_title', 'tasks',
+                    ['creator_id', sa.text('title COLLATE "C"'), 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_tasks_creator_id_title', table_name='tasks')
+    op.drop_index('ix_tasks_creator_id_created', table_name='tasks')
+    op.drop_index('ix_tasks_creator_id_deadline', table_name='tasks')
@@ -0,0 +1,45 @@
+"""Task recurrences
+
+Revision ID: 778bf464f173
+Revises: d0dca24a224b
+Create Date: 2023-07-21 11:33:47.502861
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '778bf464f173'
+down_revision = 'd0dca24a224b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('task_recurrences',
+    sa.Column('creator_id', sa.UUID(), nullable=False),
+    sa.Column('task_id', sa.UUID(), nullable=False),
+    sa.Column('frequency', sa.String(length=10), nullable=False),
+    sa.Column('interval', sa.Integer(), nullable=False),
+    sa.Column('until', sa.Date(), nullable=True),
+    sa.ForeignKeyConstraint(['creator_id', 'task_id'], ['tasks.creator_id', 'tasks.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('creator_id', 'task_id')
+    )
+    op.create_table('task_occurrences',
+    sa.Column('creator_id', sa.UUID(), nullable=False),
+    sa.Column('task_id', sa.UUID(), nullable=False),
+    sa.Column('occurrence', sa.Date(), nullable=False),
+    sa.Column('title', sa.String(length=150), nullable=True),
+    sa.Column('task_text', sa.Text(), nullable=True),
+    sa.Column('expired', sa.Boolean(), nullable=False),
+    sa.Column('cancelled', sa.Boolean(), nullable=False),
+    sa.Column('updated', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.ForeignKeyConstraint(['creator_id', 'task_id'], ['tasks.creator_id', 'tasks.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('creator_id', 'task_id', 'occurrence')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('task_occurrences')
+    op.drop_table('task_recurrences')
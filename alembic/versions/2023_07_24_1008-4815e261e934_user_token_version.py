@@ -0,0 +1,24 @@
+"""User token version
+
+Revision ID: 4815e261e934
+Revises: 778bf464f173
+Create Date: 2023-07-24 10:08:19.674021
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4815e261e934'
+down_revision = '778bf464f173'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('token_version', sa.Integer(), server_default=sa.text('0'), nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'token_version')
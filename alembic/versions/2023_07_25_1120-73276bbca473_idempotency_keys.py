@@ -0,0 +1,34 @@
+"""Idempotency keys
+
+Revision ID: 73276bbca473
+Revises: 4815e261e934
+Create Date: 2023-07-25 11:20:52.183406
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '73276bbca473'
+down_revision = '4815e261e934'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('idempotency_keys',
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('fingerprint', sa.String(length=64), nullable=False),
+    sa.Column('response', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('created', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.Column('expires', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index(op.f('ix_idempotency_keys_expires'), 'idempotency_keys', ['expires'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_idempotency_keys_expires'), table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
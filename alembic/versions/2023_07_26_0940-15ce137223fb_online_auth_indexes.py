@@ -0,0 +1,48 @@
+"""Auth token and blacklist expiry indexes
+
+Revision ID: 15ce137223fb
+Revises: 73276bbca473
+Create Date: 2023-07-26 09:40:11.508217
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from src.database.migrations import batched_update, create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = '15ce137223fb'
+down_revision = '73276bbca473'
+branch_labels = None
+depends_on = None
+
+# `exp` claim of the token, decoded from its base64url payload
+TOKEN_EXPIRES = """
+    to_timestamp(CAST(convert_from(decode(
+        rpad(translate(split_part(token, '.', 2), '-_', '+/'),
+             (length(split_part(token, '.', 2)) + 3) / 4 * 4, '='),
+        'base64'), 'UTF8')::json ->> 'exp' AS double precision))
+"""
+
+
+def upgrade() -> None:
+    # varchar to text and a nullable column change the catalog only
+    op.alter_column('jwt_tokens_blacklist', 'token',
+                    existing_type=sa.String(length=150),
+                    type_=sa.Text(),
+                    existing_nullable=False)
+    op.add_column('jwt_tokens_blacklist', sa.Column('expires', sa.DateTime(timezone=True), nullable=True))
+    batched_update('jwt_tokens_blacklist', f'expires = {TOKEN_EXPIRES}', where='expires IS NULL')
+    create_index_concurrently('ix_jwt_tokens_blacklist_expires', 'jwt_tokens_blacklist', ['expires'])
+    create_index_concurrently('ix_auth_tokens_token_owner_token_type', 'auth_tokens', ['token_owner', 'token_type'])
+
+
+def downgrade() -> None:
+    drop_index_concurrently('ix_auth_tokens_token_owner_token_type')
+    drop_index_concurrently('ix_jwt_tokens_blacklist_expires')
+    op.drop_column('jwt_tokens_blacklist', 'expires')
+    op.alter_column('jwt_tokens_blacklist', 'token',
+                    existing_type=sa.Text(),
+                    type_=sa.String(length=150),
+                    existing_nullable=False)
@@ -0,0 +1,37 @@
+"""Task attachments
+
+Revision ID: 38bd12234f4f
+Revises: 15ce137223fb
+Create Date: 2023-07-27 10:15:37.640128
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '38bd12234f4f'
+down_revision = '15ce137223fb'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('task_attachments',
+    sa.Column('id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('creator_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('task_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('filename', sa.String(length=255), nullable=False),
+    sa.Column('content_type', sa.String(length=255), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=False),
+    sa.Column('sha256', sa.String(length=64), nullable=False),
+    sa.Column('created', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.PrimaryKeyConstraint('creator_id', 'task_id', 'id')
+    )
+    op.create_index('ix_task_attachments_sha256', 'task_attachments', ['sha256'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_task_attachments_sha256', table_name='task_attachments')
+    op.drop_table('task_attachments')
@@ -0,0 +1,38 @@
+"""Auth events
+
+Revision ID: 5b4f65fa9e00
+Revises: 38bd12234f4f
+Create Date: 2023-07-28 09:05:44.912370
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '5b4f65fa9e00'
+down_revision = '38bd12234f4f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('auth_events',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('occurred', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('event', sa.String(length=20), nullable=False),
+    sa.Column('user_id', postgresql.UUID(as_uuid=True), nullable=True),
+    sa.Column('username', sa.String(length=150), nullable=True),
+    sa.Column('ip', postgresql.INET(), nullable=True),
+    sa.Column('user_agent', sa.String(length=255), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_auth_events_occurred', 'auth_events', ['occurred'], unique=False, postgresql_using='brin')
+    op.create_index('ix_auth_events_user_id_occurred', 'auth_events', ['user_id', 'occurred'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_auth_events_user_id_occurred', table_name='auth_events')
+    op.drop_index('ix_auth_events_occurred', table_name='auth_events')
+    op.drop_table('auth_events')
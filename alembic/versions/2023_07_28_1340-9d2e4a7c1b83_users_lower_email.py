@@ -0,0 +1,39 @@
+"""Unique lower(email) of users
+
+Revision ID: 9d2e4a7c1b83
+Revises: 5b4f65fa9e00
+Create Date: 2023-07-28 13:40:21.367594
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from src.database.migrations import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = '9d2e4a7c1b83'
+down_revision = '5b4f65fa9e00'
+branch_labels = None
+depends_on = None
+
+DUPLICATE_EMAILS_QUERY = sa.text("""
+    SELECT lower(email) AS email FROM users
+    GROUP BY lower(email)
+    HAVING count(*) > 1
+    LIMIT 10
+""")
+
+
+def upgrade() -> None:
+    duplicates = [row.email for row in op.get_bind().execute(DUPLICATE_EMAILS_QUERY)]
+    if duplicates:
+        raise RuntimeError(f'Emails differing in case only must be merged first: {", ".join(duplicates)}')
+    create_index_concurrently('ix_users_lower_email', 'users', ['lower(email)'], unique=True)
+    # covered by the index above
+    op.drop_constraint('users_email_key', 'users', type_='unique')
+
+
+def downgrade() -> None:
+    op.create_unique_constraint('users_email_key', 'users', ['email'])
+    drop_index_concurrently('ix_users_lower_email')
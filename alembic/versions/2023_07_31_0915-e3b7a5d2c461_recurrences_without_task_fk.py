@@ -0,0 +1,35 @@
+"""Recurrences without foreign keys to tasks
+
+Revision ID: e3b7a5d2c461
+Revises: 9d2e4a7c1b83
+Create Date: 2023-07-31 09:15:42.183027
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3b7a5d2c461'
+down_revision = '9d2e4a7c1b83'
+branch_labels = None
+depends_on = None
+
+TABLES = ('task_recurrences', 'task_occurrences')
+
+
+def upgrade() -> None:
+    # archiving a task deleted its rule and exceptions through the cascade
+    for table in TABLES:
+        op.drop_constraint(f'{table}_creator_id_task_id_fkey', table, type_='foreignkey')
+
+
+def downgrade() -> None:
+    for table in TABLES:
+        # rows of archived tasks have no task to refer to
+        op.execute(sa.text(f"""
+            DELETE FROM {table} r
+            WHERE NOT EXISTS (SELECT 1 FROM tasks t WHERE t.creator_id = r.creator_id AND t.id = r.task_id)
+        """))
+        op.create_foreign_key(f'{table}_creator_id_task_id_fkey', table, 'tasks',
+                              ['creator_id', 'task_id'], ['creator_id', 'id'], ondelete='CASCADE')
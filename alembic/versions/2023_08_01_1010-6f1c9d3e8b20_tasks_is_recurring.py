@@ -0,0 +1,45 @@
+"""Recurring masters out of the pending index
+
+Revision ID: 6f1c9d3e8b20
+Revises: e3b7a5d2c461
+Create Date: 2023-08-01 10:10:27.531904
+
+Masters of recurring tasks never expire, so they stayed in
+`ix_tasks_deadline_pending` for good and the hourly expiry sweep
+anti-joined every one of them against `task_recurrences`. They are now
+flagged with `tasks.is_recurring`, which the index predicate excludes.
+The index is rebuilt partition by partition without blocking writes;
+the sweep runs without it meanwhile.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from src.database.migrations import create_partitioned_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = '6f1c9d3e8b20'
+down_revision = 'e3b7a5d2c461'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # a constant default, the column is added without rewriting tasks
+    op.add_column('tasks', sa.Column('is_recurring', sa.Boolean(), server_default=sa.text('false'), nullable=False))
+    # masters are few, one per series
+    op.execute("""
+        UPDATE tasks t SET is_recurring = true
+        FROM task_recurrences r
+        WHERE t.creator_id = r.creator_id AND t.id = r.task_id
+    """)
+    op.drop_index('ix_tasks_deadline_pending', table_name='tasks')
+    create_partitioned_index_concurrently('ix_tasks_deadline_pending', 'tasks', ['deadline', 'creator_id'],
+                                          where='NOT expired AND NOT is_recurring')
+
+
+def downgrade() -> None:
+    op.drop_index('ix_tasks_deadline_pending', table_name='tasks')
+    create_partitioned_index_concurrently('ix_tasks_deadline_pending', 'tasks', ['deadline', 'creator_id'],
+                                          where='NOT expired')
+    op.drop_column('tasks', 'is_recurring')
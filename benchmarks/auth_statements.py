@@ -0,0 +1,133 @@
+"""
+Per-call Python overhead of the hot auth queries: statements built on
+every call, as before, against the prebuilt ones of `src.auth.statements`.
+
+Measured is everything `Session.execute` does before and after the
+driver: building the statement (built per call only), its cache key,
+the compiled cache lookup, parameter processing and the result setup.
+The driver is a stub which returns no rows, so no database is needed
+and driver time is left out.
+
+Run from the project root:
+    python -m benchmarks.auth_statements
+"""
+import timeit
+
+from sqlalchemy import create_engine, select, exists
+from sqlalchemy.dialects import registry
+from sqlalchemy.dialects.postgresql.psycopg2 import PGDialect_psycopg2
+from sqlalchemy.orm import Session
+
+from src.auth import statements
+from src.auth.models import User, AuthToken, JwtTokensBlackList
+from src.tasks import models  # noqa: F401, mapped for the relationships of User
+
+NUMBER = 5000
+
+
+class StubCursor:
+    description = None
+    rowcount = 0
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, statement, parameters=None):
+        pass
+
+    def fetchall(self):
+        return []
+
+    def fetchone(self):
+        return None
+
+    def fetchmany(self, size=None):
+        return []
+
+    def close(self):
+        pass
+
+
+class StubConnection:
+    notices = []
+
+    def cursor(self, *args, **kwargs):
+        return StubCursor(self)
+
+    def rollback(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StubDialect(PGDialect_psycopg2):
+    """psycopg2 dialect which never talks to a server"""
+    supports_statement_cache = True
+
+    def on_connect(self):
+        return None
+
+    def initialize(self, connection):
+        self.server_version_info = (15, 0)
+        self.default_schema_name = 'public'
+        self.default_isolation_level = 'READ COMMITTED'
+
+    def do_execute(self, cursor, statement, parameters, context=None):
+        # the columns a real cursor would describe, for the result setup
+        cursor.description = [(column.name, None, None, None, None, None, None)
+                              for column in context.compiled._result_columns]
+
+
+registry.register('postgresql.stub', __name__, 'StubDialect')
+
+
+def stub_session() -> Session:
+    return Session(create_engine('postgresql+stub://', creator=StubConnection))
+
+
+def build_user_by_username():
+    return select(User).where(User.username == 'username'), None
+
+
+def build_blacklist_exists():
+    return exists(select(JwtTokensBlackList).where(JwtTokensBlackList.token == 'token')).select(), None
+
+
+def build_auth_token_exists():
+    return exists(select(AuthToken).filter_by(token_owner='email', token_type='su')).select(), None
+
+
+CASES = (
+    ('user by username', build_user_by_username,
+     lambda: (statements.USER_BY_USERNAME, {'username': 'username'})),
+    ('blacklist token exists', build_blacklist_exists,
+     lambda: (statements.BLACKLIST_TOKEN_EXISTS, {'token': 'token'})),
+    ('auth token exists', build_auth_token_exists,
+     lambda: (statements.AUTH_TOKEN_EXISTS[(True, False)], {'email': 'email', 'token_type': 'su'})),
+)
+
+
+def per_call(session: Session, statement_and_params) -> float:
+    def execute():
+        statement, params = statement_and_params()
+        session.execute(statement, params).all()
+
+    execute()
+    return min(timeit.repeat(execute, number=NUMBER, repeat=5)) / NUMBER * 1e6
+
+
+def main():
+    with stub_session() as session, session.begin():
+        print(f'{"query":<24} {"built per call":>16} {"prebuilt":>10} {"saved":>8}')
+        for name, build, prebuilt in CASES:
+            built = per_call(session, build)
+            reused = per_call(session, prebuilt)
+            print(f'{name:<24} {built:>13.1f} us {reused:>7.1f} us {1 - reused / built:>7.0%}')
+
+
+if __name__ == '__main__':
+    main()
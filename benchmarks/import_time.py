@@ -0,0 +1,43 @@
+"""
+Import time of `src.main`, which every fresh process pays before it
+serves: the gunicorn master with `preload_app`, or each worker without.
+
+Each run imports the app in a new interpreter with `-X importtime`.
+The best total of the runs is printed, along with the modules which
+took longest to import themselves.
+
+Run from the project root:
+    python -m benchmarks.import_time
+"""
+import subprocess
+import sys
+
+RUNS = 5
+TOP = 15
+
+
+def import_times() -> dict:
+    """Returns self and cumulative microseconds of every module imported"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import src.main'],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_time), int(cumulative))
+    return times
+
+
+def main():
+    runs = [import_times() for _ in range(RUNS)]
+    best = min(runs, key=lambda times: times['src.main'][1])
+    print(f'src.main: {best["src.main"][1] / 1000:.1f} ms, best of {RUNS}')
+    print(f'{"module":<48} {"self":>10}')
+    slowest = sorted(best.items(), key=lambda item: item[1][0], reverse=True)[:TOP]
+    for name, (self_time, _) in slowest:
+        print(f'{name:<48} {self_time / 1000:>7.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
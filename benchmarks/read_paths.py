@@ -0,0 +1,89 @@
+"""
+ORM against raw asyncpg reads of the token user lookup and the task list,
+the two paths switched by `DATABASE_RAW_READS`.
+
+Needs the database of `DATABASE_URL` with migrations applied. A user
+with `TASKS` tasks is inserted for the run and deleted afterwards. Every
+call opens a new session, as a request does.
+
+Run from the project root:
+    python -m benchmarks.read_paths
+"""
+import asyncio
+import time
+import uuid
+from datetime import date, timedelta
+
+from sqlalchemy import insert, delete
+
+from src.auth.models import User
+from src.auth.repository import UserReadRepository
+from src.auth.utils import UserManager, find_black_list_token
+from src.database.core import session, transactional_session
+from src.tasks.models import Tasks
+from src.tasks.repository import TaskReadRepository
+from src.tasks.schemas import TaskShow
+from src.tasks.utils import TasksManager
+
+NUMBER = 500
+TASKS = 200
+
+
+async def per_call(function) -> float:
+    best = None
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(NUMBER):
+            async with session() as async_session:
+                await function(async_session)
+        elapsed = (time.perf_counter() - started) / NUMBER * 1e6
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+async def main():
+    user_id = uuid.uuid4()
+    username = f'@bench{user_id.hex[:8]}'
+    async with transactional_session() as async_session, async_session.begin():
+        await async_session.execute(insert(User).values(
+            id=user_id, username=username, email=f'{username[1:]}@bench.io', name='Bench', surname='Bench',
+            hashed_password='', is_active=True, roles=['role_user'], token_version=0
+        ))
+        await async_session.execute(insert(Tasks), [
+            {'id': uuid.uuid4(), 'creator_id': user_id, 'title': f'Task {number}', 'task_text': 'Text',
+             'deadline': date.today() + timedelta(days=number), 'expired': False}
+            for number in range(TASKS)
+        ])
+
+    async def orm_user(async_session):
+        await find_black_list_token(token='token', session=async_session)
+        async with async_session.begin():
+            await UserManager(async_session).get_user_by_username(username)
+
+    async def raw_user(async_session):
+        await UserReadRepository(async_session).get_user_by_token(username, 'token')
+
+    async def orm_tasks(async_session):
+        async with async_session.begin():
+            tasks = await TasksManager(async_session).get_user_tasks(user_id)
+            return [TaskShow.from_orm(task) for task in tasks]
+
+    async def raw_tasks(async_session):
+        async with async_session.begin():
+            return await TaskReadRepository(async_session).get_user_tasks(user_id)
+
+    try:
+        print(f'{"query":<24} {"orm":>12} {"raw":>12} {"saved":>8}')
+        for name, orm, raw in (('token user lookup', orm_user, raw_user),
+                               (f'task list ({TASKS} tasks)', orm_tasks, raw_tasks)):
+            orm_time = await per_call(orm)
+            raw_time = await per_call(raw)
+            print(f'{name:<24} {orm_time:>9.1f} us {raw_time:>9.1f} us {1 - raw_time / orm_time:>7.0%}')
+    finally:
+        async with transactional_session() as async_session, async_session.begin():
+            await async_session.execute(delete(Tasks).where(Tasks.creator_id == user_id))
+            await async_session.execute(delete(User).where(User.id == user_id))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,9 +1,32 @@
 #!/bin/bash
+# Usage: celery.sh mail|digests|maintenance|beat|flower
 
-cd /app/todolist_app/src
+set -e
 
-if [[ "${1}" == "celery" ]]; then
-  celery --app=tasks.tasks:celery worker -l INFO
-elif [[ "${1}" == "flower" ]]; then
-  celery --app=tasks.tasks:celery flower
-fi
+cd /app/todolist_app
+
+case "${1}" in
+  mail)
+    # short I/O bound jobs, a few reserved per process keep latency low
+    exec celery --app=src.celery:app worker -Q mail -n mail@%h -l INFO \
+      --concurrency="${CELERY_MAIL_CONCURRENCY:-4}" --prefetch-multiplier=4
+    ;;
+  digests)
+    exec celery --app=src.celery:app worker -Q digests -n digests@%h -l INFO \
+      --concurrency="${CELERY_DIGESTS_CONCURRENCY:-2}" --prefetch-multiplier=1
+    ;;
+  maintenance)
+    exec celery --app=src.celery:app worker -Q maintenance -n maintenance@%h -l INFO \
+      --concurrency="${CELERY_MAINTENANCE_CONCURRENCY:-1}" --prefetch-multiplier=1
+    ;;
+  beat)
+    exec celery --app=src.celery:app beat -l INFO --schedule=/tmp/celerybeat-schedule
+    ;;
+  flower)
+    exec celery --app=src.celery:app flower
+    ;;
+  *)
+    echo "Usage: celery.sh mail|digests|maintenance|beat|flower" >&2
+    exit 1
+    ;;
+esac
@@ -0,0 +1,36 @@
+"""
+Gunicorn settings of the production web server.
+
+The app is imported once in the master (`preload_app`) and workers are
+forked from it, sharing its memory copy-on-write. Objects of the master
+are moved out of the garbage collector's reach before forking, so that
+collections in workers do not touch, and copy, those pages.
+
+Every worker warms up in the app start-up (see `src.startup`) before it
+accepts requests.
+"""
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+worker_class = 'uvicorn.workers.UvicornWorker'
+# async workers do not block on I/O, one per core keeps them all busy
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+preload_app = True
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+accesslog = '-'
+
+
+def when_ready(server):
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # connections opened by the master must not be shared with workers
+    from src.database.core import engine, replica_engine
+    for async_engine in (engine, replica_engine):
+        if async_engine is not None:
+            async_engine.sync_engine.dispose(close=False)
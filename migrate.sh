@@ -0,0 +1,12 @@
+#!/bin/sh
+# Applies the migrations once, before the app starts.
+# Runs as the one-shot `migrate` compose service, never in app replicas,
+# so migrations do not race and a failed one does not crash-loop the app.
+
+set -e
+
+cd /app/todolist_app
+
+python -m src.startup wait-for-db
+
+exec alembic upgrade head
@@ -0,0 +1,159 @@
+"""
+Log of authentication events for security analytics.
+
+Endpoints record events with `auth_event_log.record`, which only puts
+them on a bounded in-process queue and never waits. A writer task of
+the worker drains the queue into `auth_events` with COPY, in batches
+of up to `BATCH_SIZE` events, every `FLUSH_INTERVAL` seconds or as soon
+as a batch is full. So logging adds no database round trip to the
+request, and the write load is one COPY per batch.
+
+The log degrades by losing events, never by slowing requests down:
+events are dropped and counted in `dropped` when the queue is full, or
+when a batch could not be written. The queue is flushed on shutdown of
+the worker.
+"""
+import asyncio
+import datetime
+import ipaddress
+import logging
+from typing import NamedTuple, Optional
+
+import asyncpg
+from fastapi import Request
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.exc import SQLAlchemyError
+
+from src.database.core import engine
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1
+MAX_USER_AGENT_LENGTH = 255
+
+
+class AuthEventTypes:
+    LOGIN = 'login'
+    LOGIN_FAILED = 'login_failed'
+    LOGOUT = 'logout'
+    CONFIRMED = 'confirmed'
+
+
+class AuthEvent(NamedTuple):
+    """Row of `auth_events`, in the order of `COLUMNS`"""
+    occurred: datetime.datetime
+    event: str
+    user_id: Optional[UUID]
+    username: Optional[str]
+    ip: Optional[str]
+    user_agent: Optional[str]
+
+
+COLUMNS = AuthEvent._fields
+
+
+def _client_ip(request: Request) -> Optional[str]:
+    if request.client is None:
+        return None
+    try:
+        return str(ipaddress.ip_address(request.client.host))
+    except ValueError:
+        return None
+
+
+class AuthEventLog:
+    """Bounded queue of the worker's auth events and the task writing them"""
+
+    def __init__(self, maxsize: int = QUEUE_SIZE, batch_size: int = BATCH_SIZE):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._batch_ready: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+        # batch taken by the writer, written by `stop` if the writer is stopped meanwhile
+        self._batch: Optional[list] = None
+
+    def _start(self):
+        # created here to be bound to the running loop
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._batch_ready = asyncio.Event()
+        self._writer = asyncio.get_running_loop().create_task(self._run())
+
+    def record(self,
+               event: str,
+               request: Request,
+               username: Optional[str] = None,
+               user_id: Optional[UUID] = None):
+        """Queues the event, or drops it if the queue is full"""
+        if self._writer is None:
+            self._start()
+        user_agent = request.headers.get('user-agent')
+        auth_event = AuthEvent(occurred=datetime.datetime.now(datetime.timezone.utc),
+                               event=event,
+                               user_id=user_id,
+                               username=username,
+                               ip=_client_ip(request),
+                               user_agent=user_agent[:MAX_USER_AGENT_LENGTH] if user_agent else None)
+        try:
+            self._queue.put_nowait(auth_event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return
+        if self._queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+    def _take_batch(self, size: int) -> list[AuthEvent]:
+        batch = []
+        while len(batch) < size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _write(self, batch: list[AuthEvent]):
+        try:
+            async with engine.connect() as connection:
+                raw_connection = await connection.get_raw_connection()
+                await raw_connection.driver_connection.copy_records_to_table(
+                    'auth_events', records=batch, columns=COLUMNS
+                )
+        except (OSError, asyncpg.PostgresError, SQLAlchemyError, asyncio.TimeoutError) as error:
+            self.dropped += len(batch)
+            logger.warning('Dropped %s auth events, %s in total: %s', len(batch), self.dropped, error)
+        except Exception:
+            # bad data must not stop the writer
+            self.dropped += len(batch)
+            logger.exception('Dropped %s auth events, %s in total', len(batch), self.dropped)
+
+    async def _run(self):
+        while True:
+            self._batch = [await self._queue.get()]
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), timeout=FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._batch += self._take_batch(self.batch_size - 1)
+            if self._queue.qsize() < self.batch_size:
+                self._batch_ready.clear()
+            await self._write(self._batch)
+            self._batch = None
+
+    async def stop(self):
+        """Stops the writer and writes the events left in the queue"""
+        if self._writer is None:
+            return
+        self._writer.cancel()
+        try:
+            await self._writer
+        except asyncio.CancelledError:
+            pass
+        self._writer = None
+        if self._batch is not None:
+            await self._write(self._batch)
+            self._batch = None
+        while not self._queue.empty():
+            await self._write(self._take_batch(self.batch_size))
+
+
+auth_event_log = AuthEventLog()
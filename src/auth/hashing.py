@@ -1,14 +1,18 @@
 from passlib.context import CryptContext
 
+from src.tracing import traced
+
 hash_content = CryptContext(schemes=['bcrypt'])
 
 
 class Hashing:
 
     @staticmethod
+    @traced('bcrypt.verify')
     def verify_password(password: str, hashed_password: str) -> bool:
         return hash_content.verify(password, hashed_password)
 
     @staticmethod
+    @traced('bcrypt.hash')
     def get_hashed_password(password: str) -> str:
         return hash_content.hash(password)
@@ -1,10 +1,10 @@
 import uuid
 import sqlalchemy.types as types
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, String, Boolean, DateTime
+from sqlalchemy import Column, String, Text, Boolean, DateTime, BigInteger, Integer, Sequence, Index
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
-from sqlalchemy.dialects.postgresql import UUID, ARRAY
+from sqlalchemy.sql import func, text
+from sqlalchemy.dialects.postgresql import UUID, ARRAY, INET
 from enum import Enum
 from src.database.core import Base
 
@@ -17,9 +17,17 @@ class Roles(str, Enum):
 
 # Base = declarative_base()
 
+users_version_seq = Sequence('users_version_seq', metadata=Base.metadata)
+
 
 class User(Base):
     __tablename__ = 'users'
+    __table_args__ = (
+        # emails are unique in any case, registration relies on it
+        Index('ix_users_lower_email', text('lower(email)'), unique=True),
+    )
+    # fetch server generated `version` with RETURNING
+    __mapper_args__ = {'eager_defaults': True}
 
     id = Column(UUID(as_uuid=True),  # as_uuid helps us to return python uuid
                 primary_key=True,
@@ -27,14 +35,19 @@ class User(Base):
     username = Column(String,
                       nullable=False,
                       unique=True)
-    email = Column(String,
-                   nullable=False,
-                   unique=True)
+    email = Column(String, nullable=False)
     name = Column(String, nullable=False)
     surname = Column(String, nullable=False)
     hashed_password = Column(String, nullable=False)
     is_active = Column(Boolean, default=False)
     roles = Column(ARRAY(String), nullable=False)
+    # bumped to revoke every access token issued before
+    token_version = Column(Integer, nullable=False, default=0)
+    # bumped on every update, used as ETag of user representations
+    version = Column(BigInteger,
+                     server_default=users_version_seq.next_value(),
+                     onupdate=users_version_seq.next_value(),
+                     nullable=False)
     tasks = relationship('Tasks', back_populates='creator')
 
     def __repr__(self):
@@ -51,13 +64,15 @@ class User(Base):
 
 class TokenChoicesTypes(types.TypeDecorator):
     impl = types.String
+    # choices are kept hashable, so statements with this type are cached
+    cache_ok = True
 
     def __init__(self, choices, **kw):
-        self.choices = dict(choices)
+        self.choices = tuple(dict(choices).items())
         super().__init__(**kw)
 
     def process_bind_param(self, value, dialect):
-        return [k for k, v in self.choices.items() if v == value][0]
+        return [k for k, v in self.choices if v == value][0]
 
 
 class AuthToken(Base):
@@ -67,6 +82,9 @@ class AuthToken(Base):
         'pr': 'pr'
     }
     __tablename__ = 'auth_tokens'
+    __table_args__ = (
+        Index('ix_auth_tokens_token_owner_token_type', 'token_owner', 'token_type'),
+    )
 
     id = Column(UUID(as_uuid=True),
                 primary_key=True,
@@ -88,10 +106,38 @@ class JwtTokensBlackList(Base):
     id = Column(UUID(as_uuid=True),
                 primary_key=True,
                 default=uuid.uuid4)
-    token = Column(String(length=150),
+    # access tokens outgrow 150 characters with long usernames
+    token = Column(Text,
                    unique=True,
                    nullable=False)
     email = Column(String(length=150), nullable=False)
+    # the token is useless once expired, the row can go
+    expires = Column(DateTime(timezone=True), nullable=True, index=True)
 
     def __repr__(self):
         return f'BLACKLIST TOKEN: {self.token}, OWNER: {self.email}'
+
+
+class AuthEvents(Base):
+    """
+    Log of logins, failed logins, logouts and confirmations, written
+    in batches by `src.auth.events`. Append only, so `occurred` grows
+    with the physical order of rows and a BRIN index covers it.
+    """
+    __tablename__ = 'auth_events'
+    __table_args__ = (
+        Index('ix_auth_events_occurred', 'occurred', postgresql_using='brin'),
+        Index('ix_auth_events_user_id_occurred', 'user_id', 'occurred'),
+    )
+
+    id = Column(BigInteger, primary_key=True)
+    occurred = Column(DateTime(timezone=True), nullable=False)
+    event = Column(String(length=20), nullable=False)
+    user_id = Column(UUID(as_uuid=True), nullable=True)
+    # as given, for failed logins of unknown users
+    username = Column(String(length=150), nullable=True)
+    ip = Column(INET, nullable=True)
+    user_agent = Column(String(length=255), nullable=True)
+
+    def __repr__(self):
+        return f'Auth event {self.event} of {self.username}'
@@ -0,0 +1,193 @@
+"""
+Authorization from access token claims.
+
+Access tokens carry the user's roles as a bitmask (`rl`) and the
+user's token version (`tv`). Dependencies of this module authorize a
+request from the token alone, without loading the user.
+
+Tokens are revoked in two ways:
+    - logout blacklists a single token;
+    - bumping `User.token_version` (on a role change, for example)
+      revokes every token issued before.
+Both are mirrored in Redis and checked with a single MGET. When the
+version is not cached or Redis is unavailable the database is asked
+instead, for the version, the blacklist and whether the user is active,
+and the version of an active user is cached again.
+
+The cache only ever raises a version, so a request which read the old
+version from the database can not overwrite a newer one. Cached
+versions live for `TOKEN_VERSION_TTL` only: a revocation whose write to
+Redis failed is missed for at most that long before the database, and
+its blacklist, is asked again. Deactivating a user must bump the token
+version, as inactive users are only refused on the database path.
+"""
+import hashlib
+import logging
+import time
+from typing import NamedTuple, Iterable, Optional
+
+from fastapi import Depends, HTTPException, status
+from jose import jwt, JWTError
+from redis.exceptions import RedisError
+from sqlalchemy import select, exists
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import SECRET_KEY
+from src.database.core import get_database
+from src.redis import get_redis
+from .models import Roles, User, JwtTokensBlackList
+from .utils import oauth2_scheme, ACCESS_TOKEN_EXPIRE_MINUTES
+
+logger = logging.getLogger(__name__)
+
+ROLE_BITS = {
+    Roles.role_user: 1 << 0,
+    Roles.role_admin: 1 << 1,
+    Roles.role_superadmin: 1 << 2,
+}
+
+# bounds how long a revocation missing from Redis goes unnoticed
+TOKEN_VERSION_TTL = 5 * 60
+
+# sets the version unless a newer one is cached
+CACHE_TOKEN_VERSION_SCRIPT = """
+local cached = redis.call('GET', KEYS[1])
+if cached and tonumber(cached) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+
+def roles_mask(roles: Iterable[str]) -> int:
+    mask = 0
+    for role in roles:
+        mask |= ROLE_BITS.get(role, 0)
+    return mask
+
+
+def access_token_claims(user: User) -> dict:
+    """Returns claims of an access token issued to the user"""
+    return {
+        'sub': user.username,
+        'rl': roles_mask(user.roles),
+        'tv': user.token_version
+    }
+
+
+class TokenClaims(NamedTuple):
+    username: str
+    roles: int
+    token_version: int
+
+    def has_role(self, role: Roles) -> bool:
+        return bool(self.roles & ROLE_BITS[role])
+
+
+def _token_version_key(username: str) -> str:
+    return f'auth:tv:{username}'
+
+
+def _revoked_token_key(token: str) -> str:
+    return f'auth:revoked:{hashlib.sha256(token.encode()).hexdigest()}'
+
+
+async def cache_token_version(username: str, token_version: int):
+    script = get_redis().register_script(CACHE_TOKEN_VERSION_SCRIPT)
+    try:
+        await script(keys=[_token_version_key(username)], args=[token_version, TOKEN_VERSION_TTL])
+    except RedisError as error:
+        logger.warning('Could not cache token version: %s', error)
+
+
+async def cache_revoked_token(token: str):
+    """Remembers a blacklisted token until it expires"""
+    try:
+        expires = jwt.get_unverified_claims(token).get('exp')
+    except JWTError:
+        return
+    ttl = int(expires - time.time()) if expires else ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    if ttl <= 0:
+        return
+    try:
+        await get_redis().set(_revoked_token_key(token), 1, ex=ttl)
+    except RedisError as error:
+        logger.warning('Could not cache revoked token: %s', error)
+
+
+class TokenState(NamedTuple):
+    token_version: Optional[int]
+    revoked: bool
+    is_active: bool
+
+
+async def _load_token_state(session: AsyncSession, username: str, token: str) -> TokenState:
+    """Returns token version of the user, whether the token is blacklisted and the user active"""
+    blacklisted = exists().where(JwtTokensBlackList.token == token)
+    query = select(User.token_version, blacklisted, User.is_active).where(User.username == username)
+    async with session.begin():
+        row = (await session.execute(query)).fetchone()
+    if row is None:
+        return TokenState(token_version=None, revoked=True, is_active=False)
+    state = TokenState(token_version=row[0], revoked=row[1], is_active=bool(row[2]))
+    if state.is_active:
+        await cache_token_version(username, state.token_version)
+    return state
+
+
+async def get_token_claims(token: str = Depends(oauth2_scheme),
+                           session: AsyncSession = Depends(get_database)) -> TokenClaims:
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+    except JWTError:
+        raise credentials_exception
+    username: Optional[str] = payload.get('sub')
+    if username is None:
+        raise credentials_exception
+    claims = TokenClaims(username=username,
+                         roles=payload.get('rl', 0),
+                         token_version=payload.get('tv', 0))
+    try:
+        token_version, revoked = await get_redis().mget(_token_version_key(username),
+                                                        _revoked_token_key(token))
+    except RedisError as error:
+        logger.warning('Token state is unavailable in Redis: %s', error)
+        token_version, revoked = None, None
+    if revoked is not None:
+        raise credentials_exception
+    if token_version is None:
+        state = await _load_token_state(session, username, token)
+        if state.revoked:
+            raise credentials_exception
+        if not state.is_active:
+            raise HTTPException(status_code=400, detail='Inactive user')
+        token_version = state.token_version
+    if int(token_version) != claims.token_version:
+        raise credentials_exception
+    return claims
+
+
+def require_roles(*roles: Roles):
+    """
+    Returns dependency which lets in tokens having any of the roles
+    and returns their claims.
+    """
+    mask = roles_mask(roles)
+
+    async def check_roles(claims: TokenClaims = Depends(get_token_claims)) -> TokenClaims:
+        if not claims.roles & mask:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                                detail='Not enough permissions!')
+        return claims
+
+    return check_roles
+
+
+require_admin = require_roles(Roles.role_admin, Roles.role_superadmin)
+require_superadmin = require_roles(Roles.role_superadmin)
@@ -0,0 +1,143 @@
+"""
+Distributed token-bucket rate limiting on Redis.
+
+All buckets of a request are checked and consumed by a single Lua
+script, so a check costs one round-trip and is atomic across workers.
+A request is rejected unless every bucket has enough tokens, and a
+rejected request consumes nothing.
+"""
+import logging
+import math
+from typing import NamedTuple, Optional
+
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.security import OAuth2PasswordRequestForm
+from redis.exceptions import RedisError
+
+from src.config import RATE_LIMIT_ENABLED
+from src.redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+# KEYS: bucket keys
+# ARGV: cost, then capacity and refill rate (tokens per second) of every key
+# Returns 0 if the tokens were taken, otherwise milliseconds to wait.
+TOKEN_BUCKET_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local cost = tonumber(ARGV[1])
+local levels = {}
+local retry = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2])
+    local rate = tonumber(ARGV[i * 2 + 1]) / 1000
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < cost then
+        retry = math.max(retry, math.ceil((cost - tokens) / rate))
+    end
+end
+if retry > 0 then
+    return retry
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2])
+    local rate = tonumber(ARGV[i * 2 + 1]) / 1000
+    redis.call('HSET', key, 'tokens', levels[i] - cost, 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(capacity / rate))
+end
+return 0
+"""
+
+
+class Bucket(NamedTuple):
+    """Bucket of `capacity` tokens, refilled completely in `period` seconds"""
+    capacity: int
+    period: int
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.period
+
+
+class RateLimiter:
+    """
+    Rate limiter with one bucket per client IP address and,
+    optionally, one per identity (username or email) of the
+    request. Unavailable Redis lets requests through.
+
+    Attributes:
+        scope (str): name of the protected action, part of bucket keys.
+        ip_bucket (Bucket): bucket settings per client IP address.
+        identity_bucket (Bucket): bucket settings per identity.
+    """
+
+    def __init__(self, scope: str, ip_bucket: Bucket, identity_bucket: Optional[Bucket] = None):
+        self.scope = scope
+        self.ip_bucket = ip_bucket
+        self.identity_bucket = identity_bucket
+        self._script = None
+
+    def _get_script(self):
+        if self._script is None:
+            self._script = get_redis().register_script(TOKEN_BUCKET_SCRIPT)
+        return self._script
+
+    async def check(self, ip: str, identity: Optional[str] = None) -> int:
+        """
+        Takes a token from every bucket of the request.
+
+        Returns:
+            0 if the request is allowed, otherwise milliseconds to wait.
+        """
+        keys = [f'ratelimit:{self.scope}:ip:{ip}']
+        args = [1, self.ip_bucket.capacity, self.ip_bucket.rate]
+        if identity and self.identity_bucket is not None:
+            keys.append(f'ratelimit:{self.scope}:id:{identity.lower()}')
+            args += [self.identity_bucket.capacity, self.identity_bucket.rate]
+        try:
+            return int(await self._get_script()(keys=keys, args=args))
+        except RedisError as error:
+            logger.warning('Rate limiter is unavailable: %s', error)
+            return 0
+
+    async def hit(self, request: Request, identity: Optional[str] = None):
+        """Raises HTTP 429 if the request exceeds any of the limits"""
+        if not RATE_LIMIT_ENABLED:
+            return
+        ip = request.client.host if request.client else 'unknown'
+        retry_after = await self.check(ip, identity)
+        if retry_after:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail='Too many requests, try again later.',
+                headers={'Retry-After': str(math.ceil(retry_after / 1000))}
+            )
+
+
+login_limiter = RateLimiter('login',
+                            ip_bucket=Bucket(capacity=30, period=60),
+                            identity_bucket=Bucket(capacity=5, period=60))
+registration_limiter = RateLimiter('registration',
+                                   ip_bucket=Bucket(capacity=5, period=600),
+                                   identity_bucket=Bucket(capacity=3, period=3600))
+
+
+async def login_rate_limit(request: Request,
+                           form_data: OAuth2PasswordRequestForm = Depends()):
+    await login_limiter.hit(request, identity=form_data.username)
+
+
+async def registration_rate_limit(request: Request):
+    # the body is already read and cached on the request by FastAPI;
+    # an invalid body is limited by address only, then rejected with 422
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    email = data.get('email') if isinstance(data, dict) else None
+    await registration_limiter.hit(request, identity=email if isinstance(email, str) else None)
@@ -0,0 +1,113 @@
+"""
+Read-only fast path of the token user lookup.
+
+Enabled by `DATABASE_RAW_READS`. The query runs directly on the asyncpg
+connection behind the session and its record is copied into a
+`UserSnapshot`, so the lookup skips ORM row processing, the identity
+map and attribute instrumentation. It also checks the blacklist in the
+same round trip. The gain has not been measured yet: run
+`benchmarks/read_paths.py` against the target database before enabling
+it.
+
+Snapshots are detached copies: they can not be changed or flushed. The
+ORM path stays in use for everything that writes. Read endpoints get
+either a `User` or a `UserSnapshot`, and rely only on `CurrentUser`,
+which both implement.
+"""
+import uuid
+from typing import Protocol, Union
+
+import asyncpg
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.core import get_driver_connection
+from src.singleflight import SingleFlight, flight_session
+from .models import Roles
+
+USER_BY_TOKEN_QUERY = """
+    SELECT id, username, email, name, surname, is_active, roles, version, token_version,
+           EXISTS (SELECT 1 FROM jwt_tokens_blacklist WHERE token = $2) AS blacklisted
+    FROM users
+    WHERE username = $1
+"""
+
+token_user_flights = SingleFlight()
+
+
+class CurrentUser(Protocol):
+    """User of a read endpoint, a `User` or a `UserSnapshot`"""
+    id: uuid.UUID
+    username: str
+    email: str
+    name: str
+    surname: str
+    is_active: bool
+    roles: list
+    version: int
+    token_version: int
+
+    @property
+    def is_superadmin(self) -> bool: ...
+
+    @property
+    def is_admin(self) -> bool: ...
+
+
+class UserSnapshot:
+    """Read-only copy of the user columns the read endpoints use"""
+    __slots__ = ('id', 'username', 'email', 'name', 'surname',
+                 'is_active', 'roles', 'version', 'token_version')
+
+    def __init__(self, record: asyncpg.Record):
+        self.id = record['id']
+        self.username = record['username']
+        self.email = record['email']
+        self.name = record['name']
+        self.surname = record['surname']
+        self.is_active = record['is_active']
+        self.roles = record['roles']
+        self.version = record['version']
+        self.token_version = record['token_version']
+
+    def __repr__(self):
+        return f'UserSnapshot: {self.username}'
+
+    @property
+    def is_superadmin(self) -> bool:
+        return Roles.role_superadmin in self.roles
+
+    @property
+    def is_admin(self) -> bool:
+        return Roles.role_admin in self.roles
+
+
+class UserReadRepository:
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def get_user_by_token(self, username: str, token: str) -> tuple[Union[UserSnapshot, None], bool]:
+        """
+        Returns snapshot of the user and whether the token is
+        blacklisted. The snapshot is None if there is no such user.
+        """
+        async with self.session.begin():
+            return await self._fetch_user_by_token(username, token)
+
+    async def get_user_by_token_shared(self, username: str, token: str) -> tuple[Union[UserSnapshot, None], bool]:
+        """
+        Same as `get_user_by_token`, but concurrent lookups of the
+        token in the worker share one query, see `src.singleflight`.
+        """
+        async def fetch(seal):
+            async with flight_session(self.session, seal) as shared_session:
+                return await UserReadRepository(shared_session)._fetch_user_by_token(username, token)
+
+        return await token_user_flights.do((self.session.bind, username, token), fetch)
+
+    async def _fetch_user_by_token(self, username: str, token: str) -> tuple[Union[UserSnapshot, None], bool]:
+        connection = await get_driver_connection(self.session)
+        record = await connection.fetchrow(USER_BY_TOKEN_QUERY, username, token)
+        if record is None:
+            return None, False
+        return UserSnapshot(record), record['blacklisted']
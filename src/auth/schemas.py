@@ -5,6 +5,7 @@ from typing import Union
 from pydantic import BaseModel, EmailStr, validator
 from fastapi import HTTPException
 from .services import validate_password
+from .models import Roles
 
 LETTERS_PATTERN = re.compile(r"^[а-яА-Яa-zA-Z\-]+$")
 EN_LOWER_LETTERS_PATTERN = re.compile(r"^[a-z0-9]+$")
@@ -74,5 +75,9 @@ class Token(BaseModel):
     token_type: str
 
 
+class UserRolesUpdate(BaseModel):
+    roles: list[Roles]
+
+
 class TokenData(BaseModel):
     username: Union[str, None] = None
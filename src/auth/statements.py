@@ -0,0 +1,87 @@
+"""
+Prebuilt statements of the hot auth queries.
+
+Statements are built once at import with bound parameters and only
+executed with new values, so a call skips constructing the statement
+and most of computing its cache key. Compiled SQL and the prepared
+statements of the asyncpg dialect were already reused before, as the
+per-call statements compiled to the same SQL; the only exception was
+anything touching `AuthToken.token_type`, which was not cacheable until
+`TokenChoicesTypes` set `cache_ok`.
+
+See `benchmarks/auth_statements.py` for the per-call overhead saved.
+"""
+from sqlalchemy import select, delete, exists, bindparam, func, text
+
+from .models import User, AuthToken, JwtTokensBlackList
+
+USER_BY_ID = select(User).where(User.id == bindparam('user_id'))
+USER_BY_USERNAME = select(User).where(User.username == bindparam('username'))
+# emails are matched case-insensitively, by the unique `lower(email)` index
+USER_BY_EMAIL = select(User).where(func.lower(User.email) == func.lower(bindparam('email')))
+
+# Free username for `:base`: the base itself, or the base with the
+# lowest free numeric suffix. Taken names are probed one index lookup
+# each within the statement, instead of a query each.
+_TAKEN_USERNAMES = """
+    taken(n) AS (
+        SELECT 0 WHERE EXISTS (SELECT 1 FROM users WHERE username = CAST(:base AS varchar))
+        UNION ALL
+        SELECT n + 1 FROM taken
+        WHERE EXISTS (SELECT 1 FROM users WHERE username = CAST(:base AS varchar) || (n + 1))
+    )
+"""
+_FREE_USERNAME = """
+    CASE WHEN count(*) = 0 THEN CAST(:base AS varchar) ELSE CAST(:base AS varchar) || (max(n) + 1) END
+"""
+FREE_USERNAME = text(f'WITH RECURSIVE {_TAKEN_USERNAMES} SELECT {_FREE_USERNAME} FROM taken')
+
+# Whole registration in one statement, so in one round trip and one
+# transaction: the user is inserted unless the email is taken in any
+# case, then signup tokens of the email are replaced by `:token`.
+# Returns no row if the email is taken. A concurrent registration with
+# the same username base or a token collision fail the statement with
+# a unique violation, and it can be run again.
+REGISTER_USER = text(f"""
+    WITH RECURSIVE {_TAKEN_USERNAMES},
+    new_user AS (
+        INSERT INTO users (id, username, email, name, surname, hashed_password, is_active, roles, token_version)
+        SELECT CAST(:user_id AS uuid), {_FREE_USERNAME}, :email, :name, :surname, :hashed_password,
+               false, CAST(:roles AS varchar[]), 0
+        FROM taken
+        ON CONFLICT ((lower(email))) DO NOTHING
+        RETURNING id, username, email, name, surname, is_active
+    ), purged_tokens AS (
+        DELETE FROM auth_tokens
+        WHERE token_owner = :email AND token_type = :token_type AND EXISTS (SELECT 1 FROM new_user)
+    ), new_token AS (
+        INSERT INTO auth_tokens (id, token, token_type, token_owner, expired)
+        SELECT CAST(:token_id AS uuid), :token, :token_type, email, false FROM new_user
+        RETURNING token
+    )
+    SELECT new_user.id, new_user.username, new_user.email, new_user.name,
+           new_user.surname, new_user.is_active, new_token.token
+    FROM new_user CROSS JOIN new_token
+""")
+
+BLACKLIST_TOKEN_EXISTS = exists().where(JwtTokensBlackList.token == bindparam('token')).select()
+
+_BY_OWNER = (AuthToken.token_owner == bindparam('email'),
+             AuthToken.token_type == bindparam('token_type'))
+_BY_TOKEN = (AuthToken.token == bindparam('token'),)
+_BY_TOKEN_AND_OWNER = (AuthToken.token == bindparam('token'),
+                       AuthToken.token_owner == bindparam('email'))
+
+AUTH_TOKEN_BY_TOKEN_AND_OWNER = select(AuthToken).where(*_BY_TOKEN_AND_OWNER)
+
+# keyed by which of email and token are given
+AUTH_TOKEN_EXISTS = {
+    (True, False): exists().where(*_BY_OWNER).select(),
+    (False, True): exists().where(*_BY_TOKEN).select(),
+    (True, True): exists().where(*_BY_TOKEN_AND_OWNER).select(),
+}
+AUTH_TOKEN_DELETE = {
+    (True, False): delete(AuthToken).where(*_BY_OWNER),
+    (False, True): delete(AuthToken).where(*_BY_TOKEN),
+    (True, True): delete(AuthToken).where(*_BY_TOKEN_AND_OWNER),
+}
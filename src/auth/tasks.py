@@ -1,2 +1,27 @@
-from celery import app
+import asyncio
 
+from fastapi_mail.errors import ConnectionErrors
+from sqlalchemy import text
+
+from src.celery import app
+from src.database.core import get_sync_engine
+
+MAIL_TIME_LIMIT = 60
+
+PURGE_BLACKLIST_QUERY = text('DELETE FROM jwt_tokens_blacklist WHERE expires < now()')
+
+
+@app.task(autoretry_for=(ConnectionErrors, OSError),
+          retry_backoff=True,
+          max_retries=5,
+          time_limit=MAIL_TIME_LIMIT)
+def send_mail_job(email: str, url: str, subject: str):
+    # imported here, `token` imports this module to queue the job
+    from .token import SendEmailMixin
+    asyncio.run(SendEmailMixin(email=email, url=url).send_mail(subject))
+
+
+@app.task
+def purge_expired_blacklist_job() -> int:
+    with get_sync_engine().connect() as connection, connection.begin():
+        return connection.execute(PURGE_BLACKLIST_QUERY).rowcount
@@ -6,9 +6,11 @@ Link: https://github.com/okuzmenko31/drf-ecommerce/blob/main/ecommerce/apps/user
 import binascii
 import os
 from src import config
-from sqlalchemy import select, exists, delete
 from sqlalchemy.ext.asyncio import AsyncSession
+from . import statements
 from .models import AuthToken
+from .tasks import send_mail_job
+from src.tracing import span
 from typing import NamedTuple, Optional
 from jinja2 import Environment, select_autoescape, PackageLoader
 from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
@@ -33,6 +35,10 @@ MESSAGES = {
 }
 
 
+def generate_token() -> str:
+    return binascii.hexlify(os.urandom(16)).decode()
+
+
 class TokenData(NamedTuple):
     token: Optional[AuthToken] = None
     email: Optional[str] = None
@@ -96,24 +102,27 @@ env = Environment(
 )
 
 
+def get_mail_config() -> ConnectionConfig:
+    return ConnectionConfig(
+        MAIL_USERNAME=config.SMTP_USERNAME,
+        MAIL_PASSWORD=config.SMTP_PASSWORD,
+        MAIL_FROM=config.SMTP_USER,
+        MAIL_PORT=config.SMTP_PORT,
+        MAIL_SERVER=config.SMTP_HOST,
+        MAIL_STARTTLS=True,
+        MAIL_SSL_TLS=False,
+        USE_CREDENTIALS=True,
+        VALIDATE_CERTS=True
+    )
+
+
 class SendEmailMixin:
     def __init__(self, email: str, url: str):
         self.email = email
         self.url = url
 
     async def maker_send_mail(self, subject, template):
-        # Define the config
-        conf = ConnectionConfig(
-            MAIL_USERNAME=config.SMTP_USERNAME,
-            MAIL_PASSWORD=config.SMTP_PASSWORD,
-            MAIL_FROM=config.SMTP_USER,
-            MAIL_PORT=config.SMTP_PORT,
-            MAIL_SERVER=config.SMTP_HOST,
-            MAIL_STARTTLS=True,
-            MAIL_SSL_TLS=False,
-            USE_CREDENTIALS=True,
-            VALIDATE_CERTS=True
-        )
+        conf = get_mail_config()
         # Generate the HTML template based on the template name
         template = env.get_template(f'{template}.html')
 
@@ -133,7 +142,8 @@ class SendEmailMixin:
 
         # Send the email
         fm = FastMail(conf)
-        await fm.send_message(message)
+        with span('smtp.send', **{'mail.template': template.name}):
+            await fm.send_message(message)
 
     async def send_mail(self, subject):
         await self.maker_send_mail(subject, 'verification')
@@ -141,33 +151,23 @@ class SendEmailMixin:
 
 class AuthTokenQueryMixin:
     """
-    Mixin which is responsible for returning
-    query for token instance.
+    Mixin which is responsible for choosing prebuilt
+    token statement and its parameters.
     """
-    query = None
-    __statement = None
-
-    async def query_by_token_email(self,
-                                   statement,
-                                   email: Optional[str] = None,
-                                   token: Optional[str] = None,
-                                   token_type: Optional[str] = None):
-        stmt = statement
-        if email is not None and token is None:
-            self.query = stmt.filter_by(token_owner=email, token_type=token_type)
-        elif token is not None and email is None:
-            self.query = stmt.filter_by(token=token)
-        elif email is not None and token is not None:
-            self.query = stmt.filter_by(token=token, token_owner=email)
-        return self.query
-
-    @property
-    async def select_stmt(self):
-        return select(AuthToken)
-
-    @property
-    async def delete_stmt(self):
-        return delete(AuthToken)
+
+    @staticmethod
+    def statement_by_token_email(statements: dict,
+                                 email: Optional[str] = None,
+                                 token: Optional[str] = None,
+                                 token_type: Optional[str] = None) -> tuple:
+        """
+        Returns statement of `statements` filtering by the given
+        values and parameters to execute it with.
+        """
+        key = (email is not None, token is not None)
+        if key not in statements:
+            raise ValueError('Email or token must be provided!')
+        return statements[key], {'email': email, 'token': token, 'token_type': token_type}
 
 
 class AuthTokenManager(AuthTokenQueryMixin,
@@ -186,7 +186,7 @@ class AuthTokenManager(AuthTokenQueryMixin,
         mail_with_celery (bool): setting which can help you to send emails with celery.
     """
     token_type = None
-    mail_with_celery = False
+    mail_with_celery = config.MAIL_WITH_CELERY
 
     def __init__(self, session: AsyncSession):
         self.session = session
@@ -206,24 +206,23 @@ class AuthTokenManager(AuthTokenQueryMixin,
         Returns:
             True or False.
         """
-        query = await self.query_by_token_email(
-            statement=await self.select_stmt,
+        query, params = self.statement_by_token_email(
+            statements=statements.AUTH_TOKEN_EXISTS,
             email=email,
             token=token,
             token_type=self.token_type
         )
-        exists_query = exists(query).select()
-        result = await self.session.execute(exists_query)
+        result = await self.session.execute(query, params)
         exists_row = result.fetchone()
         return exists_row[0]
 
     @staticmethod
     async def __generate_token():
-        return binascii.hexlify(os.urandom(16)).decode()
+        return generate_token()
 
     async def generate_unique_token(self):
         token = await self.__generate_token()
-        while await self.check_token_exists(token):
+        while await self.check_token_exists(token=token):
             token = await self.__generate_token()
         return token
 
@@ -261,13 +260,13 @@ class AuthTokenManager(AuthTokenQueryMixin,
             email (str): email of token owner.
             token (str): string token value.
         """
-        query = await self.query_by_token_email(
-            statement=await self.delete_stmt,
+        query, params = self.statement_by_token_email(
+            statements=statements.AUTH_TOKEN_DELETE,
             email=email,
             token=token,
             token_type=self.token_type
         )
-        await self.session.execute(query)
+        await self.session.execute(query, params)
 
     async def _create_token(self, email: str) -> TokenData:
         """
@@ -304,18 +303,24 @@ class AuthTokenManager(AuthTokenQueryMixin,
             A success message upon successful email delivery
             or an error message if an error occurs.
         """
-        mail_context = await self.get_context(token_type=self.token_type)
         token_data = await self._create_token(email)
 
         if token_data.error:
             return token_data.error
+        return await self.send_token_mail(email, token_data.token.token)
 
+    async def send_token_mail(self, email: str, token: str) -> str:
+        """
+        Sends mail with the already created token to the email
+        address. Returns the success message.
+        """
+        mail_context = await self.get_context(token_type=self.token_type)
         subject = mail_context['subject']
-        url = 'http' + '://127.0.0.1:8000' + f'/confirm_email_reg/{token_data.token.token}/{email}'
+        url = 'http' + '://127.0.0.1:8000' + f'/confirm_email_reg/{token}/{email}'
         mail_mixin = SendEmailMixin(email=email,
                                     url=url)
         if self.mail_with_celery:
-            pass
+            send_mail_job.delay(email, url, subject)
         else:
             await mail_mixin.send_mail(subject)
         return mail_context['success_message']
@@ -333,8 +338,8 @@ async def get_token_by_params(token_value: str, token_owner: str, session: Async
     Returns:
         Token instance or None.
     """
-    query = select(AuthToken).filter_by(token=token_value, token_owner=token_owner)
-    result = await session.execute(query)
+    result = await session.execute(statements.AUTH_TOKEN_BY_TOKEN_AND_OWNER,
+                                   {'token': token_value, 'email': token_owner})
     token_row = result.fetchone()
     if token_row is not None:
         token = token_row[0]
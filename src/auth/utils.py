@@ -1,18 +1,33 @@
-from datetime import datetime, timedelta
+import uuid
+from datetime import datetime, timedelta, timezone
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from . import statements
 from .hashing import Hashing
+from .repository import CurrentUser, UserSnapshot, UserReadRepository
+from src.tracing import traced
+from src.singleflight import SingleFlight, flight_session
 from .models import Roles, User, JwtTokensBlackList
-from sqlalchemy import select, delete, exists
+from .token import TokenTypes, generate_token
+from sqlalchemy import select, delete, func
 from sqlalchemy.dialects.postgresql import UUID
-from typing import Union
+from typing import NamedTuple, Union
 from .schemas import UserCreate, UserShow, TokenData
-from src.config import SECRET_KEY
-from src.database.core import get_database
+from src.config import SECRET_KEY, DATABASE_RAW_READS
+from src.database.core import get_database, get_read_database
+
+
+ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# a unique violation means a concurrent registration won the username
+REGISTRATION_ATTEMPTS = 3
+
+user_flights = SingleFlight()
+blacklist_flights = SingleFlight()
 
 
 def username_from_email(email: str):
@@ -24,44 +39,16 @@ class UserManager:
     def __init__(self, session: AsyncSession):
         self.session = session
 
-    async def _check_user_exists(self, username, suffix=None) -> bool:
-        query = select(User).where(User.username == username + str(suffix))
-        if suffix is not None:
-            query = select(User).where(User.username == username)
-        exist_query = exists(query).select()
-        result = await self.session.execute(exist_query)
-        exists_row = result.fetchone()
-        return exists_row[0]
-
+    @traced('users.generate_username')
     async def generate_username(self, email: str) -> str:
+        """
+        Returns username made of the email, with the lowest free
+        numeric suffix if it is taken, in a single query.
+        """
         if not email:
             raise ValueError('Email must be provided!')
-        username = username_from_email(email)
-        exist_by_username = await self._check_user_exists(username)
-        if not exist_by_username:
-            return username
-        suffix = 1
-        exist_by_username_and_suffix = await self._check_user_exists(username, suffix=suffix)
-        while exist_by_username_and_suffix:
-            suffix += 1
-        return username + str(suffix)
-
-    async def create_user(self,
-                          name: str,
-                          surname: str,
-                          email: str,
-                          password: str) -> User:
-        username = await self.generate_username(email)
-        roles = [Roles.role_user]
-        new_user = User(name=name,
-                        surname=surname,
-                        email=email,
-                        username=username,
-                        hashed_password=password,
-                        roles=roles)
-        self.session.add(new_user)
-        await self.session.flush()
-        return new_user
+        result = await self.session.execute(statements.FREE_USERNAME, {'base': username_from_email(email)})
+        return result.scalar()
 
     async def delete_user(self, user_id: UUID) -> Union[UUID, None]:
         query = delete(User).where(User.id == user_id).returning(User.id)
@@ -71,22 +58,33 @@ class UserManager:
             return deleted_user_row[0]
 
     async def get_user_by_id(self, user_id: UUID) -> Union[User, None]:
-        query = select(User).where(User.id == user_id)
-        result = await self.session.execute(query)
+        result = await self.session.execute(statements.USER_BY_ID, {'user_id': user_id})
         user_row = result.fetchone()
         if user_row is not None:
             return user_row[0]
 
     async def get_user_by_username(self, username) -> Union[User, None]:
-        query = select(User).where(User.username == username)
-        result = await self.session.execute(query)
+        result = await self.session.execute(statements.USER_BY_USERNAME, {'username': username})
         user_row = result.fetchone()
         if user_row is not None:
             return user_row[0]
 
+    async def get_user_by_username_shared(self, username) -> Union[User, None]:
+        """
+        Same as `get_user_by_username`, but concurrent calls of the
+        worker share one query, see `src.singleflight`. The user is
+        detached and must not be changed. Call it outside of a
+        transaction of the session, the query runs in a session of
+        its own.
+        """
+        async def fetch(seal):
+            async with flight_session(self.session, seal) as shared_session:
+                return await UserManager(shared_session).get_user_by_username(username)
+
+        return await user_flights.do((self.session.bind, username), fetch)
+
     async def get_user_by_email(self, email):
-        query = select(User).where(User.email == email)
-        result = await self.session.execute(query)
+        result = await self.session.execute(statements.USER_BY_EMAIL, {'email': email})
         user_row = result.fetchone()
         if user_row is not None:
             return user_row[0]
@@ -97,33 +95,82 @@ class UserManager:
         users_row = result.fetchall()
         return users_row
 
+    async def set_roles(self, user_id: UUID, roles: list[Roles]) -> Union[User, None]:
+        """
+        Replaces roles of the user and revokes their access tokens,
+        which carry the old roles.
+        """
+        user = await self.get_user_by_id(user_id)
+        if user is None:
+            return None
+        user.roles = [role.value for role in roles]
+        user.token_version = User.token_version + 1
+        await self.session.flush()
+        await self.session.refresh(user, ['token_version'])
+        return user
 
-async def create_new_user(data: UserCreate, session: AsyncSession) -> UserShow:
-    async with session.begin():
-        manager = UserManager(session=session)
-        user = await manager.create_user(
-            name=data.name,
-            surname=data.surname,
-            email=data.email,
-            password=Hashing.get_hashed_password(data.password)
-        )
-        return UserShow(
-            id=user.id,
-            name=user.name,
-            surname=user.surname,
-            username=user.username,
-            email=user.email,
-            is_active=user.is_active
-        )
-
-
-async def check_unique_email(email: str, session: AsyncSession) -> bool:
-    async with session.begin():
-        query = select(User).where(User.email == email)
-        exist_query = exists(query).select()
-        result = await session.execute(exist_query)
-        exists_row = result.fetchone()
-        return exists_row[0]
+    async def get_all_users_stamp(self) -> tuple:
+        """
+        Returns count and the highest version of active users,
+        which change whenever the list of active users changes.
+        """
+        query = select(func.count(), func.coalesce(func.max(User.version), 0)).where(User.is_active.is_(True))
+        result = await self.session.execute(query)
+        return tuple(result.fetchone())
+
+
+class Registration(NamedTuple):
+    user: UserShow
+    token: str
+
+
+class EmailTaken(Exception):
+    pass
+
+
+@traced('users.register')
+async def register_user(data: UserCreate, session: AsyncSession) -> Registration:
+    """
+    Creates the inactive user with a unique username and their signup
+    token with `statements.REGISTER_USER`, in one round trip and one
+    transaction of the autocommit session. The statement is run again
+    when a concurrent registration took the same username.
+
+    Raises:
+        EmailTaken: a user with the email exists, in any case.
+    """
+    params = {
+        'base': username_from_email(data.email),
+        'email': data.email,
+        'name': data.name,
+        'surname': data.surname,
+        'hashed_password': Hashing.get_hashed_password(data.password),
+        'roles': [Roles.role_user.value],
+        'token_type': TokenTypes.SIGNUP
+    }
+    for attempt in range(REGISTRATION_ATTEMPTS):
+        try:
+            async with session.begin():
+                result = await session.execute(statements.REGISTER_USER, {
+                    **params,
+                    'user_id': uuid.uuid4(),
+                    'token_id': uuid.uuid4(),
+                    'token': generate_token()
+                })
+                row = result.fetchone()
+        except IntegrityError:
+            if attempt == REGISTRATION_ATTEMPTS - 1:
+                raise
+            continue
+        if row is None:
+            raise EmailTaken()
+        return Registration(user=UserShow(id=row.id,
+                                          name=row.name,
+                                          surname=row.surname,
+                                          username=row.username,
+                                          email=row.email,
+                                          is_active=row.is_active),
+                            token=row.token)
 
 
 async def authenticate_user(username: str,
@@ -155,43 +202,87 @@ async def create_access_token(data: dict, expires_delta: Union[timedelta, None]
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
-async def get_current_user(session: AsyncSession = Depends(get_database),
-                           token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+
+def _decode_token(token: str) -> tuple[str, int]:
+    """Returns username and token version of the access token"""
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
-        username: str = payload.get('sub')
-        if username is None:
-            raise credentials_exception
-        token_in_black_list = await find_black_list_token(token=token,
-                                                          session=session)
-        if token_in_black_list:
-            raise credentials_exception
-        token_data = TokenData(username=username)
     except JWTError:
-        raise credentials_exception
+        raise _credentials_exception()
+    username: str = payload.get('sub')
+    if username is None:
+        raise _credentials_exception()
+    return username, payload.get('tv', 0)
+
+
+async def _get_user_by_token(session: AsyncSession, token: str):
+    username, token_version = _decode_token(token)
+    token_in_black_list = await find_black_list_token_shared(token=token,
+                                                             session=session)
+    if token_in_black_list:
+        raise _credentials_exception()
+    token_data = TokenData(username=username)
     manager = UserManager(session=session)
-    async with session.begin():
-        user = await manager.get_user_by_username(username=token_data.username)
-    if user is None:
-        raise credentials_exception
+    user = await manager.get_user_by_username_shared(username=token_data.username)
+    if user is None or user.token_version != token_version:
+        raise _credentials_exception()
+    return user
+
+
+async def _get_user_snapshot_by_token(session: AsyncSession, token: str) -> UserSnapshot:
+    username, token_version = _decode_token(token)
+    user, token_in_black_list = await UserReadRepository(session).get_user_by_token_shared(username, token)
+    if user is None or token_in_black_list or user.token_version != token_version:
+        raise _credentials_exception()
     return user
 
 
+async def get_current_user(session: AsyncSession = Depends(get_database),
+                           token: str = Depends(oauth2_scheme)):
+    return await _get_user_by_token(session, token)
+
+
+async def get_current_reader(session: AsyncSession = Depends(get_read_database),
+                             token: str = Depends(oauth2_scheme)) -> CurrentUser:
+    """
+    Same as `get_current_user`, but reads from the replica when
+    it is allowed. Use it in read-only endpoints. With
+    `DATABASE_RAW_READS` the user is a read-only `UserSnapshot`,
+    so only attributes of `CurrentUser` may be used.
+    """
+    if DATABASE_RAW_READS:
+        return await _get_user_snapshot_by_token(session, token)
+    return await _get_user_by_token(session, token)
+
+
 async def get_current_active_user(current_user=Depends(get_current_user)):
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail='Inactive user')
     return current_user
 
 
+async def get_current_active_reader(current_user: CurrentUser = Depends(get_current_reader)) -> CurrentUser:
+    if not current_user.is_active:
+        raise HTTPException(status_code=400, detail='Inactive user')
+    return current_user
+
+
 async def add_jwt_token_to_blacklist(token: str,
                                      email: str,
                                      session: AsyncSession):
-    blacklist_token = JwtTokensBlackList(token=token, email=email)
+    expires = jwt.get_unverified_claims(token).get('exp')
+    blacklist_token = JwtTokensBlackList(
+        token=token,
+        email=email,
+        expires=datetime.fromtimestamp(expires, tz=timezone.utc) if expires else None
+    )
     async with session.begin():
         session.add(blacklist_token)
         await session.flush()
@@ -199,13 +290,22 @@ async def add_jwt_token_to_blacklist(token: str,
 
 async def find_black_list_token(token: str,
                                 session: AsyncSession):
-    query = select(JwtTokensBlackList).where(JwtTokensBlackList.token == token)
-    exist_query = exists(query).select()
     async with session.begin():
-        result = await session.execute(exist_query)
+        result = await session.execute(statements.BLACKLIST_TOKEN_EXISTS, {'token': token})
         exists_row = result.fetchone()
         return exists_row[0]
 
 
+async def find_black_list_token_shared(token: str,
+                                       session: AsyncSession) -> bool:
+    """Same as `find_black_list_token`, with concurrent checks of the token sharing one query"""
+    async def fetch(seal):
+        async with flight_session(session, seal) as shared_session:
+            result = await shared_session.execute(statements.BLACKLIST_TOKEN_EXISTS, {'token': token})
+            return result.fetchone()[0]
+
+    return await blacklist_flights.do((session.bind, token), fetch)
+
+
 async def get_token_user(token: str = Depends(oauth2_scheme)):
     return token
@@ -1,47 +1,58 @@
 from datetime import timedelta
-from typing import Union
+import uuid
+from typing import Optional, Union
 
-from fastapi import Depends, HTTPException, status, APIRouter
+from fastapi import Depends, Header, HTTPException, Request, Response, status, APIRouter
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from .schemas import UserShow, UserCreate, Token
-from src.database.core import get_database
-from .utils import (create_new_user,
-                    check_unique_email,
+from .schemas import UserShow, UserCreate, Token, UserRolesUpdate
+from src.database.core import get_database, get_read_database, replica_router
+from src.etag import make_etag, etag_matches, not_modified
+from src.idempotency import IdempotentRoute, idempotent
+from .utils import (register_user,
+                    EmailTaken,
                     UserManager,
                     authenticate_user,
                     get_current_active_user,
+                    get_current_active_reader,
                     create_access_token,
                     add_jwt_token_to_blacklist,
-                    get_token_user)
-from .token import AuthTokenManager, get_token_data
+                    get_token_user,
+                    ACCESS_TOKEN_EXPIRE_MINUTES)
+from .permissions import access_token_claims, cache_revoked_token, cache_token_version, require_superadmin
+from .token import AuthTokenManager, TokenTypes, get_token_data
+from .events import auth_event_log, AuthEventTypes
+from .ratelimit import login_rate_limit, registration_rate_limit
 
 router = APIRouter(
     prefix='/users',
-    tags=['Users']
+    tags=['Users'],
+    route_class=IdempotentRoute
 )
 
 
-@router.post('/registration/', response_model=UserShow)
+@router.post('/registration/', response_model=UserShow,
+             dependencies=[Depends(registration_rate_limit)])
+@idempotent(anonymous=True)
 async def create_user(data: UserCreate, session: AsyncSession = Depends(get_database)) -> UserShow:
-    check_email = await check_unique_email(data.email, session)
-    if check_email:
-        raise HTTPException(status_code=400, detail='User with provided email exists!')
-    token_manager = AuthTokenManager(session=session)
-    token_manager.token_type = 'su'
     try:
-        user = await create_new_user(data, session)
-        await token_manager.send_tokenized_mail(data.email)
-        return user
+        registration = await register_user(data, session)
+    except EmailTaken:
+        raise HTTPException(status_code=400, detail='User with provided email exists!')
     except IntegrityError as error:
         raise HTTPException(status_code=503, detail=f'Database error: {error}')
+    token_manager = AuthTokenManager(session=session)
+    token_manager.token_type = TokenTypes.SIGNUP
+    await token_manager.send_token_mail(registration.user.email, registration.token)
+    return registration.user
 
 
 @router.post('/confirm_email_reg/{token}/{email}/')
 async def confirm_email_and_register(token: str,
                                      email: str,
+                                     request: Request,
                                      session: AsyncSession = Depends(get_database)) -> Union[UserShow, str]:
     async with session.begin():
         token_data = await get_token_data(token, email, session)
@@ -50,6 +61,8 @@ async def confirm_email_and_register(token: str,
             user = await user_manager.get_user_by_email(email)
             user.is_active = True
             await session.commit()
+            await replica_router.note_write(user.username)
+            auth_event_log.record(AuthEventTypes.CONFIRMED, request, username=user.username, user_id=user.id)
             return UserShow(
                 id=user.id,
                 name=user.name,
@@ -64,31 +77,39 @@ async def confirm_email_and_register(token: str,
         )
 
 
-@router.post('/token/', response_model=Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(),
+@router.post('/token/', response_model=Token,
+             dependencies=[Depends(login_rate_limit)])
+async def login_for_access_token(request: Request,
+                                 form_data: OAuth2PasswordRequestForm = Depends(),
                                  session: AsyncSession = Depends(get_database)):
     user = await authenticate_user(session=session,
                                    username=form_data.username,
                                    password=form_data.password)
     if not user:
+        auth_event_log.record(AuthEventTypes.LOGIN_FAILED, request, username=form_data.username[:150])
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=30)
-    access_token = await create_access_token(data={'sub': user.username},
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = await create_access_token(data=access_token_claims(user),
                                              expires_delta=access_token_expires)
+    auth_event_log.record(AuthEventTypes.LOGIN, request, username=user.username, user_id=user.id)
     return {'access_token': access_token, 'token_type': 'bearer'}
 
 
 @router.get('/logout/')
-async def logout(session: AsyncSession = Depends(get_database),
+async def logout(request: Request,
+                 session: AsyncSession = Depends(get_database),
                  token: str = Depends(get_token_user),
                  current_user=Depends(get_current_active_user)):
     await add_jwt_token_to_blacklist(session=session,
                                      token=token,
                                      email=current_user.email)
+    await cache_revoked_token(token)
+    await replica_router.note_write(current_user.username)
+    auth_event_log.record(AuthEventTypes.LOGOUT, request, username=current_user.username, user_id=current_user.id)
     return {
         'status_code': status.HTTP_200_OK,
         'detail': 'You successfully logged out.'
@@ -96,14 +117,26 @@ async def logout(session: AsyncSession = Depends(get_database),
 
 
 @router.get("/me/", response_model=UserShow)
-async def read_users_me(current_user=Depends(get_current_active_user)):
+async def read_users_me(response: Response,
+                        if_none_match: Optional[str] = Header(None),
+                        current_user=Depends(get_current_active_reader)):
+    etag = make_etag('user', current_user.id, current_user.version)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    response.headers['ETag'] = etag
     return current_user
 
 
 @router.get('/all/', response_model=list[UserShow])
-async def get_all_users(session: AsyncSession = Depends(get_database)) -> list[UserShow]:
+async def get_all_users(response: Response,
+                        if_none_match: Optional[str] = Header(None),
+                        session: AsyncSession = Depends(get_read_database)) -> list[UserShow]:
     manager = UserManager(session)
     async with session.begin():
+        etag = make_etag('users', *await manager.get_all_users_stamp())
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+        response.headers['ETag'] = etag
         users = await manager.get_all_users()
         users_lst = []
         for obj in users:
@@ -118,3 +151,24 @@ async def get_all_users(session: AsyncSession = Depends(get_database)) -> list[U
             )
             users_lst.append(show)
         return users_lst
+
+
+@router.put('/{user_id}/roles/', dependencies=[Depends(require_superadmin)])
+async def set_user_roles(user_id: uuid.UUID,
+                         data: UserRolesUpdate,
+                         session: AsyncSession = Depends(get_database)):
+    """
+    Replaces roles of the user. Access tokens issued to
+    the user before are revoked.
+    """
+    manager = UserManager(session)
+    async with session.begin():
+        user = await manager.set_roles(user_id=user_id, roles=data.roles)
+        if user is None:
+            raise HTTPException(status_code=404, detail='User not found!')
+    await cache_token_version(user.username, user.token_version)
+    await replica_router.note_write(user.username)
+    return {
+        'status_code': status.HTTP_200_OK,
+        'detail': 'Roles have been updated.'
+    }
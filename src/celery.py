@@ -1,4 +1,8 @@
 from celery import Celery
 
-app = Celery('src', broker='redis://redis:6379')
-app.autodiscover_tasks()
+from src.tracing import instrument_celery
+
+app = Celery('src')
+app.config_from_object('src.celeryconfig')
+app.autodiscover_tasks(['src.auth', 'src.tasks'])
+instrument_celery()
@@ -0,0 +1,76 @@
+"""
+Celery settings, see `src.celery`.
+
+Jobs are routed to three queues, each consumed by its own workers
+(see `celery.sh`), so a long job never waits in front of a short one:
+    - `mail`: interactive mails a user is waiting for;
+    - `digests`: bulk deadline digests;
+    - `maintenance`: sweeps over the tasks tables.
+Unrouted jobs go to `maintenance`, never to `mail`.
+
+Jobs are acknowledged after they finish, so a job of a worker which
+died is delivered again. The broker redelivers an unacknowledged job
+after `visibility_timeout` seconds, which therefore must be longer
+than the longest job. Jobs are fire-and-forget, no results are stored.
+"""
+from celery.schedules import crontab
+from kombu import Queue
+
+from src.config import CELERY_BROKER_URL
+
+broker_url = CELERY_BROKER_URL
+broker_connection_retry_on_startup = True
+broker_transport_options = {'visibility_timeout': 2 * 60 * 60}
+
+task_queues = (
+    Queue('mail'),
+    Queue('digests'),
+    Queue('maintenance'),
+)
+task_default_queue = 'maintenance'
+task_routes = {
+    'src.auth.tasks.purge_expired_blacklist_job': {'queue': 'maintenance'},
+    'src.auth.tasks.*': {'queue': 'mail'},
+    'src.tasks.tasks.dispatch_deadline_digests_job': {'queue': 'digests'},
+    'src.tasks.tasks.send_deadline_digests_job': {'queue': 'digests'},
+    'src.tasks.tasks.*': {'queue': 'maintenance'},
+}
+
+task_acks_late = True
+task_reject_on_worker_lost = True
+# workers reserve one job at a time unless started with more
+worker_prefetch_multiplier = 1
+
+task_ignore_result = True
+result_backend = None
+
+beat_schedule = {
+    'expire-overdue-tasks': {
+        'task': 'src.tasks.tasks.expire_overdue_tasks_job',
+        'schedule': crontab(minute=5),
+    },
+    'archive-expired-tasks': {
+        'task': 'src.tasks.tasks.archive_expired_tasks_job',
+        'schedule': crontab(minute=30, hour=3),
+    },
+    'send-deadline-digests': {
+        'task': 'src.tasks.tasks.dispatch_deadline_digests_job',
+        'schedule': crontab(minute=0, hour=7),
+    },
+    'purge-idempotency-keys': {
+        'task': 'src.tasks.tasks.purge_idempotency_keys_job',
+        'schedule': crontab(minute=45),
+    },
+    'purge-expired-blacklist': {
+        'task': 'src.auth.tasks.purge_expired_blacklist_job',
+        'schedule': crontab(minute=15, hour=4),
+    },
+    'collect-attachments': {
+        'task': 'src.tasks.tasks.collect_attachments_job',
+        'schedule': crontab(minute=30, hour=3),
+    },
+    'reconcile-task-stats': {
+        'task': 'src.tasks.tasks.reconcile_task_stats_job',
+        'schedule': crontab(minute=0, hour=4, day_of_week=0),
+    },
+}
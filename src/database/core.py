@@ -1,16 +1,161 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from typing import AsyncGenerator
+import asyncio
+import logging
+import time
+
+from fastapi import Request
+from jose import jwt, JWTError
+from redis.exceptions import RedisError
+from sqlalchemy import text, create_engine, Engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker, AsyncEngine
+from typing import AsyncGenerator, Optional
 
 from sqlalchemy.ext.declarative import declarative_base
 
-from src.config import DATABASE_URL
+from src.config import (DATABASE_URL,
+                        DATABASE_ECHO,
+                        DATABASE_REPLICA_URL,
+                        DATABASE_REPLICA_MAX_LAG,
+                        DATABASE_REPLICA_CHECK_INTERVAL)
+from src.redis import get_redis
+from src.tracing import instrument_engine
+
+logger = logging.getLogger(__name__)
 
 engine = create_async_engine(DATABASE_URL,
                              future=True,
-                             echo=True,
+                             echo=DATABASE_ECHO,
                              execution_options={'isolation_level': 'AUTOCOMMIT'})
+instrument_engine(engine.sync_engine)
+
+# Same pool as `engine`, but connections leave autocommit mode, so
+# `session.begin()` opens a real database transaction. Use it for
+# writes that must be applied atomically.
+transactional_engine = engine.execution_options(isolation_level='READ COMMITTED')
 
 session = async_sessionmaker(engine, expire_on_commit=False)
+transactional_session = async_sessionmaker(transactional_engine, expire_on_commit=False)
+
+replica_engine = None
+replica_session = None
+if DATABASE_REPLICA_URL:
+    replica_engine = create_async_engine(DATABASE_REPLICA_URL,
+                                         future=True,
+                                         echo=DATABASE_ECHO,
+                                         execution_options={'isolation_level': 'AUTOCOMMIT'})
+    instrument_engine(replica_engine.sync_engine)
+    replica_session = async_sessionmaker(replica_engine, expire_on_commit=False)
+
+# Lag is zero while the replica has replayed everything it received,
+# so an idle primary does not make the replica look stale.
+REPLICA_LAG_QUERY = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+""")
+REPLICA_CHECK_TIMEOUT = 1
+
+
+class ReplicaRouter:
+    """
+    Chooses the database for read-only requests.
+
+    Reads go to the replica unless:
+        - no replica is configured;
+        - the last health check failed or found the replica lagging
+          more than `max_lag` seconds (failover to the primary);
+        - the requesting user wrote something within the last
+          `max_lag + check_interval` seconds, so they read their writes.
+
+    The replica is checked at most once per `check_interval` seconds
+    per worker. Recent writes are remembered in Redis, keyed by the
+    JWT subject, so every worker routes the user's reads alike.
+    """
+
+    def __init__(self,
+                 engine: Optional[AsyncEngine],
+                 max_lag: float = DATABASE_REPLICA_MAX_LAG,
+                 check_interval: float = DATABASE_REPLICA_CHECK_INTERVAL):
+        self.engine = engine
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._usable = False
+        self._checked_at = None
+
+    @property
+    def write_window(self) -> int:
+        return int(self.max_lag + self.check_interval) + 1
+
+    @staticmethod
+    def request_subject(request: Request) -> Optional[str]:
+        """
+        Returns `sub` claim of the request bearer token. The token is
+        not verified here, the subject is used for routing only.
+        """
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not token:
+            return None
+        try:
+            return jwt.get_unverified_claims(token).get('sub')
+        except JWTError:
+            return None
+
+    async def _check(self):
+        try:
+            async with self.engine.connect() as connection:
+                result = await connection.execute(REPLICA_LAG_QUERY)
+                lag = result.scalar()
+        except (OSError, asyncio.TimeoutError, SQLAlchemyError) as error:
+            logger.warning('Database replica is unavailable: %s', error)
+            self._usable = False
+            return
+        self._usable = lag is not None and lag <= self.max_lag
+        if not self._usable:
+            logger.warning('Database replica lags %s seconds behind', lag)
+
+    async def replica_usable(self) -> bool:
+        if self.engine is None:
+            return False
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            try:
+                await asyncio.wait_for(self._check(), timeout=REPLICA_CHECK_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning('Database replica health check timed out')
+                self._usable = False
+        return self._usable
+
+    async def note_write(self, subject: Optional[str]):
+        """Routes reads of the subject to the primary for a while"""
+        if self.engine is None or not subject:
+            return
+        try:
+            await get_redis().set(f'db:recent_write:{subject}', 1, ex=self.write_window)
+        except RedisError as error:
+            logger.warning('Could not remember recent write: %s', error)
+
+    async def _wrote_recently(self, subject: Optional[str]) -> bool:
+        if not subject:
+            return False
+        try:
+            return bool(await get_redis().exists(f'db:recent_write:{subject}'))
+        except RedisError as error:
+            logger.warning('Could not check recent writes: %s', error)
+            return True
+
+    async def session_factory(self, request: Request) -> async_sessionmaker:
+        if not await self.replica_usable():
+            return session
+        if await self._wrote_recently(self.request_subject(request)):
+            return session
+        return replica_session
+
+
+replica_router = ReplicaRouter(replica_engine)
 
 
 async def get_database() -> AsyncGenerator[AsyncSession, None]:
@@ -18,4 +163,56 @@ async def get_database() -> AsyncGenerator[AsyncSession, None]:
         yield async_session
 
 
+async def get_transactional_database(request: Request) -> AsyncGenerator[AsyncSession, None]:
+    await replica_router.note_write(replica_router.request_subject(request))
+    async with transactional_session() as async_session:
+        yield async_session
+
+
+async def get_read_database(request: Request) -> AsyncGenerator[AsyncSession, None]:
+    """
+    Session for read-only endpoints, bound to the replica
+    when `replica_router` allows it and to the primary otherwise.
+    """
+    session_factory = await replica_router.session_factory(request)
+    async with session_factory() as async_session:
+        yield async_session
+
+
+async def get_driver_connection(async_session: AsyncSession):
+    """
+    Returns asyncpg connection the session runs on. It is checked
+    out of the engine pool, so it is bound to the same database
+    and transaction as the session and goes back with it.
+    """
+    connection = await async_session.connection()
+    raw_connection = await connection.get_raw_connection()
+    return raw_connection.driver_connection
+
+
+def get_asyncpg_dsn(url: str = DATABASE_URL) -> str:
+    """
+    Returns SQLAlchemy database url in the form
+    accepted by `asyncpg.connect`.
+    """
+    return make_url(url).set(drivername='postgresql', query={}).render_as_string(hide_password=False)
+
+
+_sync_engine: Optional[Engine] = None
+
+
+def get_sync_engine() -> Engine:
+    """
+    Returns synchronous engine on the primary database, created on
+    first use. It is meant for Celery workers, which run outside
+    of an event loop.
+    """
+    global _sync_engine
+    if _sync_engine is None:
+        url = make_url(DATABASE_URL).set(drivername='postgresql+psycopg2', query={})
+        _sync_engine = create_engine(url, pool_pre_ping=True)
+        instrument_engine(_sync_engine)
+    return _sync_engine
+
+
 Base = declarative_base()
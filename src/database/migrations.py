@@ -0,0 +1,212 @@
+"""
+Helpers of migrations which run while the app is serving.
+
+`alembic/env.py` runs every migration in its own transaction with
+`MIGRATION_LOCK_TIMEOUT` and `MIGRATION_STATEMENT_TIMEOUT` set, so a
+migration waiting for a lock fails fast instead of queueing every query
+of the table behind it. After each migration it lists the ACCESS
+EXCLUSIVE locks the migration holds on tables larger than
+`MIGRATION_LARGE_TABLE_ROWS` rows, and with `MIGRATION_STRICT_LOCKS`
+fails the migration because of them.
+
+Work which must not hold locks runs in autocommit blocks through the
+helpers of this module:
+    - `create_index_concurrently` / `drop_index_concurrently`;
+    - `create_partitioned_index_concurrently`, for partitioned tables,
+      which do not support CONCURRENTLY themselves;
+    - `batched_update`, a backfill committed in small batches.
+The statement timeout is lifted within them, they may run for long.
+
+Migrations written before these guards rewrite or index whole tables
+in their transaction. They call `lift_statement_timeout` first, so
+that only the lock timeout applies to them.
+"""
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from alembic import op
+from sqlalchemy import text
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+MIGRATION_LOCK_TIMEOUT = os.environ.get('MIGRATION_LOCK_TIMEOUT', '5s')
+MIGRATION_STATEMENT_TIMEOUT = os.environ.get('MIGRATION_STATEMENT_TIMEOUT', '60s')
+MIGRATION_LARGE_TABLE_ROWS = int(os.environ.get('MIGRATION_LARGE_TABLE_ROWS', 100000))
+MIGRATION_STRICT_LOCKS = os.environ.get('MIGRATION_STRICT_LOCKS', 'false').lower() == 'true'
+
+ACCESS_EXCLUSIVE_LOCKS_QUERY = text("""
+    SELECT c.relname, c.reltuples::bigint AS rows
+    FROM pg_locks l
+    JOIN pg_class c ON c.oid = l.relation
+    WHERE l.pid = pg_backend_pid()
+      AND l.mode = 'AccessExclusiveLock'
+      AND l.granted
+      AND c.relkind IN ('r', 'p')
+      AND c.reltuples >= :rows
+""")
+INVALID_INDEX_QUERY = text("""
+    SELECT 1
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE c.relname = :name AND NOT i.indisvalid
+""")
+PARTITIONS_QUERY = text("""
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = CAST(:table AS regclass)
+    ORDER BY c.relname
+""")
+
+
+class MigrationLockError(RuntimeError):
+    pass
+
+
+def set_timeouts(connection):
+    """Sets the guards of `alembic/env.py` on the migration connection"""
+    connection.execute(text(f"SET lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'"))
+    connection.execute(text(f"SET statement_timeout = '{MIGRATION_STATEMENT_TIMEOUT}'"))
+
+
+def check_access_exclusive_locks(ctx, step, **kwargs):
+    """
+    `on_version_apply` callback of `alembic/env.py`, run in the
+    transaction of the migration just before it commits.
+    """
+    if ctx.as_sql:
+        return
+    tables = ctx.connection.execute(ACCESS_EXCLUSIVE_LOCKS_QUERY, {'rows': MIGRATION_LARGE_TABLE_ROWS}).fetchall()
+    if not tables:
+        return
+    described = ', '.join(f'{table.relname} (~{table.rows} rows)' for table in tables)
+    message = f'Migration {step.up_revision_id} holds ACCESS EXCLUSIVE locks on large tables: {described}'
+    if MIGRATION_STRICT_LOCKS:
+        raise MigrationLockError(message)
+    logger.warning(message)
+
+
+def lift_statement_timeout():
+    """Runs the rest of the migration transaction without the statement timeout"""
+    op.execute('SET LOCAL statement_timeout = 0')
+
+
+@contextmanager
+def autocommit_block():
+    """Runs the block outside of the migration transaction, without the statement timeout"""
+    with op.get_context().autocommit_block():
+        op.execute('SET statement_timeout = 0')
+        try:
+            yield
+        finally:
+            op.execute(f"SET statement_timeout = '{MIGRATION_STATEMENT_TIMEOUT}'")
+
+
+def _drop_invalid_index(name: str):
+    # left behind by a concurrent build which failed, it would
+    # make `IF NOT EXISTS` skip the build
+    if op.get_bind().execute(INVALID_INDEX_QUERY, {'name': name}).fetchone() is not None:
+        op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+
+def _create_index_sql(name: str,
+                      table: str,
+                      columns: list,
+                      unique: bool = False,
+                      where: Optional[str] = None,
+                      concurrently: bool = True,
+                      only: bool = False) -> str:
+    return ' '.join(filter(None, (
+        'CREATE UNIQUE INDEX' if unique else 'CREATE INDEX',
+        'CONCURRENTLY' if concurrently else None,
+        f'IF NOT EXISTS {name} ON',
+        'ONLY' if only else None,
+        f'{table} ({", ".join(columns)})',
+        f'WHERE {where}' if where else None
+    )))
+
+
+def create_index_concurrently(name: str,
+                              table: str,
+                              columns: list,
+                              unique: bool = False,
+                              where: Optional[str] = None):
+    """
+    Builds the index without blocking writes. Columns and `where`
+    are SQL expressions, such as `'title COLLATE "C"'`.
+    """
+    with autocommit_block():
+        _drop_invalid_index(name)
+        op.execute(_create_index_sql(name, table, columns, unique, where))
+
+
+def drop_index_concurrently(name: str):
+    with autocommit_block():
+        op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+
+def create_partitioned_index_concurrently(name: str,
+                                          table: str,
+                                          columns: list,
+                                          unique: bool = False,
+                                          where: Optional[str] = None):
+    """
+    Builds the index of a partitioned table without blocking writes.
+    The parent index is created invalid on the parent only, then every
+    partition is indexed concurrently and attached; the parent index
+    becomes valid when the last partition is attached.
+    """
+    op.execute(_create_index_sql(name, table, columns, unique, where, concurrently=False, only=True))
+    with autocommit_block():
+        partitions = [row.relname for row in op.get_bind().execute(PARTITIONS_QUERY, {'table': table})]
+        for partition in partitions:
+            partition_index = f'{name}_{partition}'[:63]
+            _drop_invalid_index(partition_index)
+            op.execute(_create_index_sql(partition_index, partition, columns, unique, where))
+            op.execute(f'ALTER INDEX {name} ATTACH PARTITION {partition_index}')
+
+
+def batched_update(table: str,
+                   set_clause: str,
+                   where: str = 'TRUE',
+                   key: str = 'id',
+                   batch_size: int = 5000,
+                   pause: float = 0,
+                   params: Optional[dict] = None) -> int:
+    """
+    Runs `UPDATE table SET set_clause WHERE where` over ranges of
+    `batch_size` rows by the unique, indexed `key`, each committed on
+    its own, so row locks are held briefly and replicas keep up.
+    Every range is read from the key index once. Returns the number
+    of updated rows.
+    """
+    # the last key of the batch, not max(), which uuid keys lack
+    range_query = text(f"""
+        SELECT {key} FROM (
+            SELECT {key} FROM {table}
+            WHERE :after IS NULL OR {key} > :after
+            ORDER BY {key}
+            LIMIT {int(batch_size)}
+        ) AS batch
+        ORDER BY {key} DESC
+        LIMIT 1
+    """)
+    update_query = text(f"""
+        UPDATE {table} SET {set_clause}
+        WHERE (:after IS NULL OR {key} > :after) AND {key} <= :upto AND ({where})
+    """)
+    updated = 0
+    after = None
+    with autocommit_block():
+        while True:
+            upto = op.get_bind().execute(range_query, {'after': after}).scalar()
+            if upto is None:
+                return updated
+            updated += op.get_bind().execute(update_query, {**(params or {}), 'after': after, 'upto': upto}).rowcount
+            after = upto
+            logger.info('Updated %s rows of %s', updated, table)
+            if pause:
+                time.sleep(pause)
@@ -0,0 +1,36 @@
+"""Helpers for ETag generation and conditional GET requests"""
+from typing import Optional
+
+from fastapi import Response, status
+
+
+def make_etag(*parts) -> str:
+    """
+    Returns weak ETag built from the given version parts,
+    for example `make_etag('user', user.id, user.version)`.
+    """
+    return 'W/"' + '-'.join(str(part) for part in parts) + '"'
+
+
+def _strip_weak(tag: str) -> str:
+    tag = tag.strip()
+    if tag.startswith('W/'):
+        tag = tag[2:]
+    return tag
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Checks `If-None-Match` header value against the ETag using weak
+    comparison, as required for conditional GET requests.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    etag = _strip_weak(etag)
+    return any(_strip_weak(tag) == etag for tag in if_none_match.split(','))
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
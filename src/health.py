@@ -0,0 +1,44 @@
+"""
+Health checks for the orchestrator.
+
+`/healthz` tells the process is alive and serving, and never touches
+its dependencies, so a database outage does not get workers restarted.
+`/readyz` tells the worker should get traffic: it has warmed up and the
+primary database answers within `READY_CHECK_TIMEOUT` seconds.
+"""
+import asyncio
+
+from fastapi import APIRouter, Response, status
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from src.database.core import engine
+from src.startup import is_warm
+
+READY_CHECK_TIMEOUT = 1
+
+router = APIRouter(tags=['Health'])
+
+
+async def _check_database():
+    async with engine.connect() as connection:
+        await connection.execute(text('SELECT 1'))
+
+
+@router.get('/healthz')
+async def healthz():
+    return {'status': 'ok'}
+
+
+@router.get('/readyz')
+async def readyz(response: Response):
+    checks = {'warm': is_warm()}
+    try:
+        await asyncio.wait_for(_check_database(), timeout=READY_CHECK_TIMEOUT)
+        checks['database'] = True
+    except (OSError, asyncio.TimeoutError, SQLAlchemyError):
+        checks['database'] = False
+    ready = all(checks.values())
+    if not ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {'status': 'ok' if ready else 'unavailable', 'checks': checks}
@@ -0,0 +1,364 @@
+"""
+Idempotency keys of write endpoints.
+
+A client retrying a write sends the same `Idempotency-Key` header, and
+the endpoint runs only once per key. The first request claims the key;
+when it finishes, its response is stored for `IDEMPOTENCY_TTL` seconds
+and replayed to every retry, which then costs a single lookup. A
+duplicate arriving while the first request is still running waits for
+its response instead of running again. The claim is refreshed while
+the request runs, so a long upload or import keeps it.
+
+Keys are scoped by the JWT subject and the request path, and bound to
+a fingerprint of the request, so a key reused for another request is
+rejected. Only successful responses and client errors which a retry
+would get again (`STORED_CLIENT_ERRORS`) are stored. Any other response,
+such as a server error, an expired token or a rate limit, releases
+the key and the retry runs again. So does a request which raised an
+unexpected error.
+
+Keys live in Redis. When Redis is unavailable they are claimed in the
+`idempotency_keys` table instead, and when neither is available the
+request runs without the guarantee.
+
+Endpoints opt in with the `idempotent` decorator on routers using
+`IdempotentRoute`.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+from typing import Callable, NamedTuple, Optional
+
+from fastapi import HTTPException, Request, Response, status
+from fastapi.exception_handlers import http_exception_handler
+from fastapi.routing import APIRoute
+from jose import jwt, JWTError
+from redis.exceptions import RedisError
+from sqlalchemy import Column, String, DateTime, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import func
+
+from src.config import SECRET_KEY
+from src.database.core import Base, session
+from src.redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+# how long responses are replayed
+IDEMPOTENCY_TTL = 24 * 60 * 60
+# how long a claim outlives a request which died without releasing it
+IN_FLIGHT_TTL = 60
+# how often the claim of a running request is refreshed
+REFRESH_INTERVAL = IN_FLIGHT_TTL / 3
+# how long a duplicate waits for the response of the first request
+WAIT_TIMEOUT = 30
+WAIT_INTERVAL = 0.05
+MAX_WAIT_INTERVAL = 0.5
+# response headers worth replaying
+STORED_HEADERS = ('content-type', 'etag', 'location')
+# client errors a retry of the same request gets anyway
+STORED_CLIENT_ERRORS = (400, 404, 409, 422)
+
+IDEMPOTENT_ATTRIBUTE = '__idempotent__'
+
+
+class IdempotencyKeys(Base):
+    """Fallback store of the keys for when Redis is unavailable"""
+    __tablename__ = 'idempotency_keys'
+
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String(length=64), nullable=False)
+    # null while the first request is running
+    response = Column(JSONB, nullable=True)
+    created = Column(DateTime(timezone=True), server_default=func.now())
+    expires = Column(DateTime(timezone=True), nullable=False, index=True)
+
+    def __repr__(self):
+        return f'Idempotency key: {self.key}'
+
+
+class StoredResponse(NamedTuple):
+    status_code: int
+    headers: dict
+    body: str  # base64
+
+    @classmethod
+    def from_response(cls, response: Response) -> 'StoredResponse':
+        headers = {name: value for name, value in response.headers.items() if name in STORED_HEADERS}
+        return cls(status_code=response.status_code,
+                   headers=headers,
+                   body=base64.b64encode(response.body).decode())
+
+    def to_response(self) -> Response:
+        return Response(content=base64.b64decode(self.body),
+                        status_code=self.status_code,
+                        headers={**self.headers, REPLAYED_HEADER: 'true'})
+
+
+class KeyState(NamedTuple):
+    fingerprint: str
+    response: Optional[StoredResponse] = None
+
+
+class RedisKeyStore:
+    """Keys as JSON strings, claimed with SET NX"""
+
+    @staticmethod
+    def _key(key: str) -> str:
+        return f'idempotency:{key}'
+
+    async def claim(self, key: str, fingerprint: str) -> bool:
+        value = json.dumps({'fingerprint': fingerprint})
+        return bool(await get_redis().set(self._key(key), value, nx=True, ex=IN_FLIGHT_TTL))
+
+    async def get(self, key: str) -> Optional[KeyState]:
+        value = await get_redis().get(self._key(key))
+        if value is None:
+            return None
+        state = json.loads(value)
+        response = state.get('response')
+        return KeyState(fingerprint=state['fingerprint'],
+                        response=StoredResponse(*response) if response is not None else None)
+
+    async def store(self, key: str, fingerprint: str, response: StoredResponse):
+        value = json.dumps({'fingerprint': fingerprint, 'response': response})
+        await get_redis().set(self._key(key), value, ex=IDEMPOTENCY_TTL)
+
+    async def refresh(self, key: str):
+        await get_redis().expire(self._key(key), IN_FLIGHT_TTL)
+
+    async def release(self, key: str):
+        await get_redis().delete(self._key(key))
+
+
+# an expired key is claimed again as if it did not exist
+CLAIM_QUERY = text(f"""
+    INSERT INTO idempotency_keys (key, fingerprint, expires)
+    VALUES (:key, :fingerprint, now() + interval '{IN_FLIGHT_TTL} seconds')
+    ON CONFLICT (key) DO UPDATE
+    SET fingerprint = excluded.fingerprint,
+        response = NULL,
+        created = now(),
+        expires = excluded.expires
+    WHERE idempotency_keys.expires < now()
+    RETURNING key
+""")
+GET_QUERY = text("""
+    SELECT fingerprint, response
+    FROM idempotency_keys
+    WHERE key = :key AND expires >= now()
+""").columns(fingerprint=String, response=JSONB)
+STORE_QUERY = text(f"""
+    UPDATE idempotency_keys
+    SET response = CAST(:response AS jsonb),
+        expires = now() + interval '{IDEMPOTENCY_TTL} seconds'
+    WHERE key = :key
+""")
+REFRESH_QUERY = text(f"""
+    UPDATE idempotency_keys
+    SET expires = now() + interval '{IN_FLIGHT_TTL} seconds'
+    WHERE key = :key AND response IS NULL
+""")
+RELEASE_QUERY = text('DELETE FROM idempotency_keys WHERE key = :key')
+PURGE_QUERY = text('DELETE FROM idempotency_keys WHERE expires < now()')
+
+
+class DatabaseKeyStore:
+    """Keys as rows of `idempotency_keys`, claimed with INSERT ON CONFLICT"""
+
+    async def claim(self, key: str, fingerprint: str) -> bool:
+        async with session() as async_session:
+            result = await async_session.execute(CLAIM_QUERY, {'key': key, 'fingerprint': fingerprint})
+            return result.scalar() is not None
+
+    async def get(self, key: str) -> Optional[KeyState]:
+        async with session() as async_session:
+            row = (await async_session.execute(GET_QUERY, {'key': key})).fetchone()
+        if row is None:
+            return None
+        return KeyState(fingerprint=row.fingerprint,
+                        response=StoredResponse(*row.response) if row.response is not None else None)
+
+    async def store(self, key: str, fingerprint: str, response: StoredResponse):
+        async with session() as async_session:
+            await async_session.execute(STORE_QUERY, {'key': key, 'response': json.dumps(response)})
+
+    async def refresh(self, key: str):
+        async with session() as async_session:
+            await async_session.execute(REFRESH_QUERY, {'key': key})
+
+    async def release(self, key: str):
+        async with session() as async_session:
+            await async_session.execute(RELEASE_QUERY, {'key': key})
+
+
+redis_key_store = RedisKeyStore()
+database_key_store = DatabaseKeyStore()
+
+
+def purge_expired_keys(connection) -> int:
+    """Deletes expired keys of the fallback table, returns their number"""
+    with connection.begin():
+        return connection.execute(PURGE_QUERY).rowcount
+
+
+async def _claim(key: str, fingerprint: str) -> tuple:
+    """
+    Claims the key in Redis or, when it is unavailable, in the
+    database. Returns the store and whether the key was claimed,
+    or no store when neither is available.
+    """
+    try:
+        return redis_key_store, await redis_key_store.claim(key, fingerprint)
+    except RedisError as error:
+        logger.warning('Idempotency keys fall back to the database: %s', error)
+    try:
+        return database_key_store, await database_key_store.claim(key, fingerprint)
+    except (OSError, SQLAlchemyError) as error:
+        logger.warning('Idempotency keys are unavailable: %s', error)
+    return None, False
+
+
+async def _release(store, key: str):
+    try:
+        await store.release(key)
+    except (OSError, RedisError, SQLAlchemyError) as error:
+        # the claim expires on its own
+        logger.warning('Could not release idempotency key: %s', error)
+
+
+async def _keep_claim(store, key: str):
+    """Refreshes the claim until cancelled when the request finishes"""
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL)
+        try:
+            await store.refresh(key)
+        except (OSError, RedisError, SQLAlchemyError) as error:
+            logger.warning('Could not refresh idempotency key: %s', error)
+
+
+def _is_stored(response: Response) -> bool:
+    return hasattr(response, 'body') and (200 <= response.status_code < 300
+                                          or response.status_code in STORED_CLIENT_ERRORS)
+
+
+async def _wait_for_response(store, key: str, fingerprint: str) -> Optional[Response]:
+    """
+    Returns response stored under the key, waiting while the first
+    request runs. Returns None if the key was released meanwhile.
+    """
+    interval = WAIT_INTERVAL
+    deadline = asyncio.get_running_loop().time() + WAIT_TIMEOUT
+    while True:
+        state = await store.get(key)
+        if state is None:
+            return None
+        if state.fingerprint != fingerprint:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                detail=f'{IDEMPOTENCY_HEADER} was already used for another request!')
+        if state.response is not None:
+            return state.response.to_response()
+        if asyncio.get_running_loop().time() >= deadline:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail='A request with this key is still in progress.',
+                                headers={'Retry-After': '1'})
+        await asyncio.sleep(interval)
+        interval = min(interval * 2, MAX_WAIT_INTERVAL)
+
+
+def _subject(request: Request) -> Optional[str]:
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    try:
+        return jwt.decode(token, SECRET_KEY, algorithms=['HS256']).get('sub')
+    except JWTError:
+        return None
+
+
+async def _fingerprint(request: Request, hash_body: bool) -> str:
+    digest = hashlib.sha256(f'{request.method} {request.url.path}?{request.url.query}\n'.encode())
+    if hash_body:
+        digest.update(await request.body())
+    else:
+        digest.update(request.headers.get('content-length', '').encode())
+    return digest.hexdigest()
+
+
+def idempotent(anonymous: bool = False, hash_body: bool = True) -> Callable:
+    """
+    Marks the endpoint as idempotent by `Idempotency-Key`.
+
+    Args:
+        anonymous (bool): keys are honoured without a valid bearer
+            token; otherwise such requests run as if there was no key.
+        hash_body (bool): the body is part of the request fingerprint.
+            Disable it for streamed bodies, which must not be read
+            ahead; their length is used instead.
+    """
+    def decorator(endpoint: Callable) -> Callable:
+        setattr(endpoint, IDEMPOTENT_ATTRIBUTE, {'anonymous': anonymous, 'hash_body': hash_body})
+        return endpoint
+
+    return decorator
+
+
+class IdempotentRoute(APIRoute):
+    """Route which honours `Idempotency-Key` of endpoints marked `idempotent`"""
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        options = getattr(self.endpoint, IDEMPOTENT_ATTRIBUTE, None)
+        if options is None:
+            return handler
+
+        async def idempotent_handler(request: Request) -> Response:
+            idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+            if idempotency_key is None:
+                return await handler(request)
+            if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                    detail=f'Invalid {IDEMPOTENCY_HEADER}!')
+            subject = _subject(request)
+            if subject is None and not options['anonymous']:
+                return await handler(request)
+            key = f'{subject or "-"}:{request.url.path}:{idempotency_key}'
+            fingerprint = await _fingerprint(request, options['hash_body'])
+
+            while True:
+                store, claimed = await _claim(key, fingerprint)
+                if store is None:
+                    return await handler(request)
+                if claimed:
+                    break
+                response = await _wait_for_response(store, key, fingerprint)
+                if response is not None:
+                    return response
+
+            keeper = asyncio.get_running_loop().create_task(_keep_claim(store, key))
+            try:
+                response = await handler(request)
+            except HTTPException as error:
+                response = await http_exception_handler(request, error)
+            except BaseException:
+                await _release(store, key)
+                raise
+            finally:
+                keeper.cancel()
+            if not _is_stored(response):
+                await _release(store, key)
+                return response
+            try:
+                await store.store(key, fingerprint, StoredResponse.from_response(response))
+            except (OSError, RedisError, SQLAlchemyError) as error:
+                # the claim expires on its own
+                logger.warning('Could not store idempotent response: %s', error)
+            return response
+
+        return idempotent_handler
@@ -1,10 +1,40 @@
 from fastapi import FastAPI
 from src.auth.views import router as user_app_router
+from src.tasks.views import router as tasks_app_router
+from src.tasks.notifications import task_changes_listener
+from src.auth.events import auth_event_log
+from src.redis import close_redis
+from src.health import router as health_router
+from src.profiling import router as profiling_router
+from src.startup import warm_up
+from src.tracing import TracingMiddleware
 
 app = FastAPI(
     title='Todo List'
 )
+app.add_middleware(TracingMiddleware)
 
 app.include_router(
     user_app_router
 )
+app.include_router(
+    tasks_app_router
+)
+app.include_router(
+    health_router
+)
+app.include_router(
+    profiling_router
+)
+
+
+@app.on_event('startup')
+async def startup():
+    await warm_up()
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    await task_changes_listener.stop()
+    await auth_event_log.stop()
+    await close_redis()
@@ -0,0 +1,167 @@
+"""
+On-demand sampling profiler of the running worker.
+
+`/admin/profile/` samples stacks of every thread of the worker which
+serves the request, for the given number of seconds, and returns them
+in the collapsed format of flamegraph.pl and speedscope: one line per
+distinct stack, frames root first and separated by `;`, then the
+number of samples. The worker keeps serving requests meanwhile; a
+sampling thread reads `sys._current_frames()` at `interval_ms`, which
+costs the worker a few microseconds per sample.
+
+With `loop_lag`, a task also measures how late the event loop wakes up,
+and the sampler records the loop thread's stack whenever the loop has
+been blocked for longer than `LOOP_BLOCKED_THRESHOLD`. Those stacks, such
+as synchronous bcrypt inside a coroutine, are put under a `[loop
+blocked]` root frame, and lag statistics are returned in headers.
+
+Only one profile runs per worker at a time.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+
+from src.auth.permissions import require_superadmin
+
+LOOP_BLOCKED_THRESHOLD = 0.05
+LOOP_TICK = 0.01
+BLOCKED_ROOT = '[loop blocked]'
+MAX_PROFILE_SECONDS = 60
+
+router = APIRouter(
+    prefix='/admin',
+    tags=['Admin'],
+    dependencies=[Depends(require_superadmin)]
+)
+
+_profiling = False
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    module = frame.f_globals.get('__name__', os.path.basename(code.co_filename))
+    return f'{module}.{code.co_name}:{code.co_firstlineno}'
+
+
+def _collapse(frame, root: str) -> str:
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.append(root)
+    return ';'.join(reversed(labels))
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Thread sampling stacks of all other threads every `interval`
+    seconds. When `loop_heartbeat` is given, also samples the loop
+    thread's stack while its heartbeat is older than the threshold.
+    """
+
+    def __init__(self, interval: float, loop_thread_id: int, loop_heartbeat: Optional['LoopLagMonitor'] = None):
+        super().__init__(name='sampling-profiler', daemon=True)
+        self.interval = interval
+        self.loop_thread_id = loop_thread_id
+        self.loop_heartbeat = loop_heartbeat
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames = sys._current_frames()
+            for thread_id, frame in frames.items():
+                if thread_id == own_id:
+                    continue
+                self.stacks[_collapse(frame, names.get(thread_id, str(thread_id)))] += 1
+            if self.loop_heartbeat is not None and self.loop_heartbeat.blocked_for() > LOOP_BLOCKED_THRESHOLD:
+                loop_frame = frames.get(self.loop_thread_id)
+                if loop_frame is not None:
+                    self.stacks[_collapse(loop_frame, BLOCKED_ROOT)] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+
+    def collapsed(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop runs a task scheduled every `LOOP_TICK` seconds"""
+
+    def __init__(self):
+        self.lags = []
+        self.heartbeat = time.monotonic()
+        self._task = None
+
+    def blocked_for(self) -> float:
+        return time.monotonic() - self.heartbeat
+
+    async def _run(self):
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(LOOP_TICK)
+            self.lags.append(max(0.0, time.monotonic() - self.heartbeat - LOOP_TICK))
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+    def summary(self) -> dict:
+        if not self.lags:
+            return {}
+        lags = sorted(self.lags)
+        return {
+            'X-Loop-Lag-P50-Ms': f'{lags[len(lags) // 2] * 1000:.1f}',
+            'X-Loop-Lag-P99-Ms': f'{lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000:.1f}',
+            'X-Loop-Lag-Max-Ms': f'{lags[-1] * 1000:.1f}',
+            'X-Loop-Blocked-Count': str(sum(lag > LOOP_BLOCKED_THRESHOLD for lag in lags)),
+        }
+
+
+@router.get('/profile/')
+async def profile_worker(seconds: float = Query(10, gt=0, le=MAX_PROFILE_SECONDS),
+                         interval_ms: float = Query(10, ge=1, le=1000),
+                         loop_lag: bool = False) -> Response:
+    """
+    Profiles this worker for `seconds` and returns collapsed stacks,
+    see the module docstring.
+    """
+    global _profiling
+    if _profiling:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail='A profile of this worker is already running.')
+    _profiling = True
+    monitor = LoopLagMonitor() if loop_lag else None
+    profiler = SamplingProfiler(interval_ms / 1000, threading.get_ident(), monitor)
+    try:
+        if monitor is not None:
+            monitor.start()
+        profiler.start()
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+        # joined off the loop, the sampler may be waiting out its interval
+        await asyncio.to_thread(profiler.join)
+        if monitor is not None:
+            monitor.stop()
+        _profiling = False
+    headers = {
+        'Content-Disposition': f'attachment; filename="profile-{os.getpid()}.collapsed"',
+        'X-Profile-Pid': str(os.getpid()),
+        'X-Profile-Samples': str(profiler.samples),
+        **(monitor.summary() if monitor is not None else {})
+    }
+    return Response(content=profiler.collapsed(), media_type='text/plain', headers=headers)
@@ -0,0 +1,26 @@
+"""Shared Redis client of the worker process"""
+from typing import Optional
+
+from redis.asyncio import Redis
+
+from src.config import REDIS_URL
+
+_redis: Optional[Redis] = None
+
+
+def get_redis() -> Redis:
+    """
+    Returns the Redis client of this process. It is created on
+    first use, so its connection pool belongs to the running loop.
+    """
+    global _redis
+    if _redis is None:
+        _redis = Redis.from_url(REDIS_URL)
+    return _redis
+
+
+async def close_redis():
+    global _redis
+    if _redis is not None:
+        await _redis.close()
+        _redis = None
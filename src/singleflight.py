@@ -0,0 +1,88 @@
+"""
+Coalescing of concurrent identical reads within a worker.
+
+Clients of a user often fire bursts of parallel requests, and every
+one of them looks up the same token user and reads the same list. With
+`SingleFlight.do`, concurrent callers with the same key share a single
+query and its result (or its error) instead of each running their own.
+
+A caller only joins a flight whose query has not been sent yet, so the
+result is never older than the caller: it reflects everything committed
+before the caller arrived. Flights seal themselves right before the
+query goes out (see `flight_session`); a caller arriving after that
+starts the next flight, which waits for the running one to finish. So
+at most one query per key runs at a time, and a burst costs two
+queries however many requests it has.
+
+A flight runs as a task of its own in its own session, shielded from
+its callers: a caller which is cancelled, for example because its
+client went away, leaves the flight running for the others.
+"""
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Hashable, TypeVar
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+T = TypeVar('T')
+
+
+class _Flight:
+    __slots__ = ('task', 'sealed')
+
+    def __init__(self):
+        self.task = None
+        self.sealed = False
+
+    def seal(self):
+        self.sealed = True
+
+
+class SingleFlight:
+    """Flights of one kind of read, by key"""
+
+    def __init__(self):
+        self._flights = {}
+
+    async def _run(self, flight: _Flight, previous, function: Callable) -> T:
+        if previous is not None:
+            await asyncio.wait({previous.task})
+        return await function(flight.seal)
+
+    def _finished(self, key: Hashable, flight: _Flight, task: asyncio.Task):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not task.cancelled():
+            # retrieved here, callers get it re-raised
+            task.exception()
+
+    async def do(self, key: Hashable, function: Callable[[Callable[[], None]], Awaitable[T]]) -> T:
+        """
+        Returns result of `function(seal)`, shared with concurrent
+        callers of the same key. The function must call `seal` right
+        before it sends its query, `flight_session` does it.
+        """
+        flight = self._flights.get(key)
+        if flight is None or flight.sealed:
+            previous = flight
+            flight = _Flight()
+            flight.task = asyncio.ensure_future(self._run(flight, previous, function))
+            flight.task.add_done_callback(functools.partial(self._finished, key, flight))
+            self._flights[key] = flight
+        return await asyncio.shield(flight.task)
+
+
+@asynccontextmanager
+async def flight_session(async_session: AsyncSession, seal: Callable[[], None]) -> AsyncIterator[AsyncSession]:
+    """
+    Session of a flight on the database of `async_session`, in a
+    transaction which holds a connection already. The flight is
+    sealed once the connection is there, so callers still join it
+    while it waits for the pool.
+    """
+    async with AsyncSession(async_session.bind, expire_on_commit=False) as shared_session:
+        async with shared_session.begin():
+            await shared_session.connection()
+            seal()
+            yield shared_session
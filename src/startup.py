@@ -0,0 +1,96 @@
+"""
+Start-up of the web workers.
+
+`warm_up` runs in every worker before it accepts requests: it opens
+`DATABASE_WARM_CONNECTIONS` pool connections on each database and
+compiles the mail templates, so the first requests of a fresh worker do
+not pay for connecting and compiling. `/readyz` reports the worker as
+ready only after it.
+
+The launcher waits for the database with:
+    python -m src.startup wait-for-db
+"""
+import asyncio
+import logging
+import sys
+import time
+
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from src.config import DATABASE_WARM_CONNECTIONS, DATABASE_WAIT_TIMEOUT
+from src.database.core import engine, replica_engine, get_asyncpg_dsn
+
+logger = logging.getLogger(__name__)
+
+WAIT_RETRY_INTERVAL = 1
+
+_warm = False
+
+
+def is_warm() -> bool:
+    return _warm
+
+
+async def _open_connection(async_engine: AsyncEngine):
+    async with async_engine.connect() as connection:
+        await connection.execute(text('SELECT 1'))
+
+
+async def warm_pool(async_engine: AsyncEngine, connections: int = DATABASE_WARM_CONNECTIONS):
+    """
+    Opens connections at the same time, so they are all
+    left idle in the pool. The pool keeps at most its size.
+    """
+    connections = min(connections, async_engine.pool.size())
+    await asyncio.gather(*[_open_connection(async_engine) for _ in range(connections)])
+
+
+def warm_templates():
+    # imported here, the mail module is heavy and not needed by the launcher
+    from src.auth.token import env
+    for name in env.list_templates(extensions=['html']):
+        env.get_template(name)
+
+
+async def warm_up():
+    global _warm
+    started = time.monotonic()
+    warm_templates()
+    for async_engine in (engine, replica_engine):
+        if async_engine is None:
+            continue
+        try:
+            await warm_pool(async_engine)
+        except (OSError, asyncio.TimeoutError, SQLAlchemyError) as error:
+            # the worker still starts, `/readyz` tells it is not ready
+            logger.warning('Could not warm connection pool: %s', error)
+    _warm = True
+    logger.info('Worker warmed up in %.2f seconds', time.monotonic() - started)
+
+
+async def wait_for_database(timeout: float = DATABASE_WAIT_TIMEOUT) -> bool:
+    """Returns True once the database accepts connections, False after `timeout` seconds"""
+    deadline = time.monotonic() + timeout
+    dsn = get_asyncpg_dsn()
+    while True:
+        try:
+            connection = await asyncpg.connect(dsn, timeout=WAIT_RETRY_INTERVAL)
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError,
+                asyncpg.InterfaceError) as error:
+            if time.monotonic() >= deadline:
+                logger.error('Database is not ready: %s', error)
+                return False
+            await asyncio.sleep(WAIT_RETRY_INTERVAL)
+            continue
+        await connection.close()
+        return True
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] != ['wait-for-db']:
+        sys.exit('Usage: python -m src.startup wait-for-db')
+    sys.exit(0 if asyncio.run(wait_for_database()) else 1)
@@ -0,0 +1,157 @@
+"""
+Maintenance of the hot `tasks` table, run by Celery workers.
+
+Both jobs work in short transactions over a few creators at a time.
+Creators are locked with the same advisory locks `TasksManager` takes
+before drawing versions, so versions of one user are still committed
+in order and delta sync cursors stay valid. Every changed row is
+announced on the task changes channel and counted in the user task
+stats, like writes made through the API.
+"""
+import datetime
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+EXPIRE_BATCH_CREATORS = 100
+ARCHIVE_BATCH_CREATORS = 100
+ARCHIVE_BATCH_SIZE = 5000
+# expired tasks untouched for this many days are moved to the archive
+ARCHIVE_AFTER_DAYS = 30
+
+LOCK_CREATORS_QUERY = text("""
+    SELECT pg_advisory_xact_lock(hashtext(creator_id::text))
+    FROM unnest(CAST(:creators AS uuid[])) AS creator_id
+    ORDER BY hashtext(creator_id::text)
+""")
+
+# Masters of recurring tasks never expire, their `deadline` is only
+# the start of the series. Both queries repeat the predicate of
+# `ix_tasks_deadline_pending`, which leaves masters out.
+OVERDUE_CREATORS_QUERY = text("""
+    SELECT DISTINCT creator_id FROM tasks
+    WHERE NOT expired AND NOT is_recurring AND deadline < CURRENT_DATE
+    LIMIT :limit
+""")
+
+EXPIRE_QUERY = text("""
+    WITH expired_tasks AS (
+        UPDATE tasks
+        SET expired = true, updated = now(), version = nextval('tasks_version_seq')
+        WHERE creator_id = ANY(CAST(:creators AS uuid[]))
+          AND NOT expired AND NOT is_recurring AND deadline < CURRENT_DATE
+        RETURNING creator_id, id, version, deadline
+    ), expired_deadlines AS (
+        SELECT creator_id, deadline, count(*) AS count
+        FROM expired_tasks GROUP BY creator_id, deadline
+    ), emptied_deadlines AS (
+        DELETE FROM user_task_deadlines d
+        USING expired_deadlines e
+        WHERE d.user_id = e.creator_id AND d.deadline = e.deadline AND d.pending <= e.count
+    ), pending_stats AS (
+        UPDATE user_task_deadlines d
+        SET pending = d.pending - e.count
+        FROM expired_deadlines e
+        WHERE d.user_id = e.creator_id AND d.deadline = e.deadline AND d.pending > e.count
+    ), expired_stats AS (
+        UPDATE user_task_stats s
+        SET expired = s.expired + e.count
+        FROM (SELECT creator_id, count(*) AS count FROM expired_tasks GROUP BY creator_id) e
+        WHERE s.user_id = e.creator_id
+    )
+    SELECT count(pg_notify('task_changes', json_build_object(
+        'creator_id', creator_id, 'id', id, 'version', version, 'op', 'updated')::text))
+    FROM expired_tasks
+""")
+
+ARCHIVABLE_CREATORS_QUERY = text("""
+    SELECT DISTINCT creator_id FROM tasks
+    WHERE expired AND coalesce(updated, created) < :cutoff
+    LIMIT :limit
+""")
+
+# Archived tasks leave tombstones, so for clients they are deleted
+# from the active list; they can be restored on demand.
+ARCHIVE_QUERY = text("""
+    WITH batch AS (
+        SELECT creator_id, id FROM tasks
+        WHERE creator_id = ANY(CAST(:creators AS uuid[]))
+          AND expired AND coalesce(updated, created) < :cutoff
+        LIMIT :batch_size
+    ), moved AS (
+        DELETE FROM tasks t
+        USING batch b
+        WHERE t.creator_id = b.creator_id AND t.id = b.id
+        RETURNING t.id, t.creator_id, t.title, t.task_text, t.created,
+                  t.updated, t.deadline, t.expired, t.version
+    ), archived AS (
+        INSERT INTO tasks_archive
+            (id, creator_id, title, task_text, created, updated, deadline, expired, version)
+        SELECT id, creator_id, title, task_text, created, updated, deadline, expired, version
+        FROM moved
+    ), tombstones AS (
+        INSERT INTO tasks_tombstones (id, creator_id)
+        SELECT id, creator_id FROM moved
+        RETURNING id, creator_id, version
+    ), stats AS (
+        UPDATE user_task_stats s
+        SET total = s.total - m.count, expired = s.expired - m.count
+        FROM (SELECT creator_id, count(*) AS count FROM moved GROUP BY creator_id) m
+        WHERE s.user_id = m.creator_id
+    )
+    SELECT count(pg_notify('task_changes', json_build_object(
+        'creator_id', creator_id, 'id', id, 'version', version, 'op', 'deleted')::text))
+    FROM tombstones
+""")
+
+
+def _lock_creators(connection: Connection, creators: list):
+    connection.execute(LOCK_CREATORS_QUERY, {'creators': creators})
+
+
+def expire_overdue_tasks(connection: Connection,
+                         batch_creators: int = EXPIRE_BATCH_CREATORS) -> int:
+    """
+    Marks tasks with passed deadline as expired.
+
+    Returns:
+        Number of expired tasks.
+    """
+    total = 0
+    while True:
+        with connection.begin():
+            creators = [str(row[0]) for row in
+                        connection.execute(OVERDUE_CREATORS_QUERY, {'limit': batch_creators})]
+            if not creators:
+                return total
+            _lock_creators(connection, creators)
+            total += connection.execute(EXPIRE_QUERY, {'creators': creators}).scalar()
+
+
+def archive_expired_tasks(connection: Connection,
+                          cutoff: Optional[datetime.datetime] = None,
+                          batch_creators: int = ARCHIVE_BATCH_CREATORS,
+                          batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Moves expired tasks, which were not changed since `cutoff`,
+    from `tasks` into `tasks_archive` in batches of at most
+    `batch_size` tasks.
+
+    Returns:
+        Number of archived tasks.
+    """
+    if cutoff is None:
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=ARCHIVE_AFTER_DAYS)
+    total = 0
+    while True:
+        with connection.begin():
+            creators = [str(row[0]) for row in
+                        connection.execute(ARCHIVABLE_CREATORS_QUERY,
+                                           {'cutoff': cutoff, 'limit': batch_creators})]
+            if not creators:
+                return total
+            _lock_creators(connection, creators)
+            total += connection.execute(ARCHIVE_QUERY, {'creators': creators,
+                                                        'cutoff': cutoff,
+                                                        'batch_size': batch_size}).scalar()
@@ -0,0 +1,347 @@
+"""
+Files attached to tasks.
+
+Bytes never pass through the database. An upload is streamed from the
+request into a temporary file of the attachment store, hashed on the
+way, then moved to its content address `<root>/ab/cd/<sha256>`; when
+a file with the same digest is already there, the upload is dropped
+and the stored file is shared. Only metadata goes to
+`task_attachments`. Writes and hashing run in a worker thread in
+chunks of `WRITE_BUFFER_SIZE` bytes, so an upload holds at most that
+much memory whatever its size, and no database connection while the
+body streams in.
+
+Downloads are served from the store with `FileResponse`, or with a
+ranged stream for a `Range` request. The digest is the strong ETag of
+the file.
+
+Stored files are never deleted by requests, as another attachment may
+share them. `collect_attachments` drops metadata of deleted tasks and
+files no attachment refers to anymore.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import time
+import uuid
+from typing import AsyncIterable, AsyncIterator, NamedTuple, Optional, Union
+from urllib.parse import quote
+
+from fastapi import Response, status
+from fastapi.responses import FileResponse, StreamingResponse
+from sqlalchemy import select, delete, exists, text
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import ATTACHMENTS_DIR, ATTACHMENT_MAX_SIZE
+from src.etag import etag_matches, not_modified
+from .models import Tasks, TaskAttachments
+
+logger = logging.getLogger(__name__)
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+# files younger than this are kept by the garbage collection, an
+# upload may be about to refer to them
+COLLECT_GRACE_SECONDS = 24 * 60 * 60
+COLLECT_BATCH_SIZE = 1000
+
+ORPHANED_ATTACHMENTS_QUERY = text("""
+    DELETE FROM task_attachments a
+    WHERE NOT EXISTS (SELECT 1 FROM tasks t WHERE t.creator_id = a.creator_id AND t.id = a.task_id)
+      AND NOT EXISTS (SELECT 1 FROM tasks_archive t WHERE t.creator_id = a.creator_id AND t.id = a.task_id)
+""")
+REFERENCED_DIGESTS_QUERY = text("""
+    SELECT DISTINCT sha256 FROM task_attachments
+    WHERE sha256 = ANY(CAST(:digests AS varchar[]))
+""")
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class StoredFile(NamedTuple):
+    sha256: str
+    size: int
+
+
+def _write(file, digest, chunk: bytes):
+    digest.update(chunk)
+    file.write(chunk)
+
+
+class AttachmentStore:
+    """Content-addressed files under `root`"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+
+    def path(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def _publish(self, tmp_path: str, sha256: str):
+        path = self.path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            # keeps the shared file out of the garbage collection
+            os.utime(path)
+            os.remove(tmp_path)
+            return
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, path)
+
+    async def save(self, chunks: AsyncIterable[bytes], max_size: int = ATTACHMENT_MAX_SIZE) -> StoredFile:
+        """
+        Streams the chunks into the store. Raises AttachmentTooLarge,
+        leaving nothing behind, once more than `max_size` bytes came.
+        """
+        await asyncio.to_thread(os.makedirs, self.tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        digest = hashlib.sha256()
+        size = 0
+        buffer = bytearray()
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > max_size:
+                        raise AttachmentTooLarge(f'Attachments are limited to {max_size} bytes!')
+                    buffer += chunk
+                    if len(buffer) >= WRITE_BUFFER_SIZE:
+                        await asyncio.to_thread(_write, file, digest, bytes(buffer))
+                        buffer.clear()
+                await asyncio.to_thread(_write, file, digest, bytes(buffer))
+                await asyncio.to_thread(os.fsync, file.fileno())
+            sha256 = digest.hexdigest()
+            await asyncio.to_thread(self._publish, tmp_path, sha256)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return StoredFile(sha256=sha256, size=size)
+
+    async def read_range(self, sha256: str, start: int, end: int) -> AsyncIterator[bytes]:
+        """Yields bytes from `start` to `end` of the file, both included"""
+        file = await asyncio.to_thread(open, self.path(sha256), 'rb')
+        try:
+            await asyncio.to_thread(file.seek, start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await asyncio.to_thread(file.read, min(READ_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            await asyncio.to_thread(file.close)
+
+    def collect(self, connection: Connection, grace: float = COLLECT_GRACE_SECONDS) -> int:
+        """
+        Deletes files older than `grace` seconds which no attachment
+        refers to, and temporary files of uploads which died. Returns
+        the number of deleted files.
+        """
+        cutoff = time.time() - grace
+        deleted = 0
+        candidates = []
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    if os.stat(path).st_mtime >= cutoff:
+                        continue
+                except FileNotFoundError:
+                    continue
+                if directory == self.tmp_dir:
+                    os.remove(path)
+                    deleted += 1
+                    continue
+                candidates.append(filename)
+                if len(candidates) >= COLLECT_BATCH_SIZE:
+                    deleted += self._delete_unreferenced(connection, candidates, cutoff)
+                    candidates = []
+        if candidates:
+            deleted += self._delete_unreferenced(connection, candidates, cutoff)
+        return deleted
+
+    def _delete_unreferenced(self, connection: Connection, digests: list, cutoff: float) -> int:
+        with connection.begin():
+            referenced = {row.sha256 for row in connection.execute(REFERENCED_DIGESTS_QUERY, {'digests': digests})}
+        deleted = 0
+        for sha256 in digests:
+            if sha256 in referenced:
+                continue
+            path = self.path(sha256)
+            try:
+                # an upload may have shared it since it was listed
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+                    deleted += 1
+            except FileNotFoundError:
+                pass
+        return deleted
+
+
+attachment_store = AttachmentStore(ATTACHMENTS_DIR)
+
+
+def collect_attachments(connection: Connection) -> int:
+    """
+    Drops attachments of tasks which are neither active nor archived,
+    then the stored files nothing refers to. Returns the number of
+    deleted files.
+    """
+    with connection.begin():
+        orphaned = connection.execute(ORPHANED_ATTACHMENTS_QUERY).rowcount
+    logger.info('Dropped %s attachments of deleted tasks', orphaned)
+    return attachment_store.collect(connection)
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[tuple]:
+    """
+    Returns first and last byte of a single `bytes=` range, or None
+    when the whole file should be sent: there is no range, it is not
+    in bytes, or it has several ranges, which may be answered in full.
+    Raises RangeNotSatisfiable when the range is outside the file.
+    """
+    if not header:
+        return None
+    unit, _, ranges = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, dash, last = ranges.strip().partition('-')
+    if not dash:
+        return None
+    try:
+        if not first:
+            # suffix range, the last `last` bytes
+            length = int(last)
+            if length <= 0 or size == 0:
+                raise RangeNotSatisfiable()
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start < 0 or start > end:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+def _content_disposition(filename: str) -> str:
+    return f"attachment; filename*=utf-8''{quote(filename)}"
+
+
+def attachment_response(attachment: TaskAttachments,
+                        range_header: Optional[str] = None,
+                        if_range: Optional[str] = None,
+                        if_none_match: Optional[str] = None) -> Response:
+    """
+    Response of the attachment's file: 304 on a matching `If-None-Match`,
+    206 with the requested range, unless `If-Range` names another
+    version of the file, or the whole file.
+    """
+    etag = f'"{attachment.sha256}"'
+    headers = {
+        'ETag': etag,
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, max-age=31536000, immutable',
+        'Content-Disposition': _content_disposition(attachment.filename)
+    }
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    if if_range is not None and if_range.strip() != etag:
+        range_header = None
+    try:
+        byte_range = parse_range(range_header, attachment.size)
+    except RangeNotSatisfiable:
+        return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                        headers={'Content-Range': f'bytes */{attachment.size}'})
+    if byte_range is None:
+        return FileResponse(attachment_store.path(attachment.sha256),
+                            media_type=attachment.content_type,
+                            headers=headers)
+    start, end = byte_range
+    return StreamingResponse(
+        attachment_store.read_range(attachment.sha256, start, end),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=attachment.content_type,
+        headers={**headers,
+                 'Content-Range': f'bytes {start}-{end}/{attachment.size}',
+                 'Content-Length': str(end - start + 1)}
+    )
+
+
+class AttachmentsManager:
+    """
+    Metadata of task attachments. Every query is scoped by
+    `creator_id`, so users reach only attachments of their own tasks.
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def task_exists(self, creator_id: UUID, task_id: UUID) -> bool:
+        query = select(exists().where(Tasks.creator_id == creator_id, Tasks.id == task_id))
+        return (await self.session.execute(query)).scalar()
+
+    async def create_attachment(self,
+                                creator_id: UUID,
+                                task_id: UUID,
+                                filename: str,
+                                content_type: str,
+                                stored: StoredFile) -> Union[TaskAttachments, None]:
+        """
+        Saves metadata of the stored file. Returns None
+        if the task was deleted while the file streamed in.
+        """
+        if not await self.task_exists(creator_id, task_id):
+            return None
+        attachment = TaskAttachments(id=uuid.uuid4(),
+                                     creator_id=creator_id,
+                                     task_id=task_id,
+                                     filename=filename,
+                                     content_type=content_type,
+                                     size=stored.size,
+                                     sha256=stored.sha256)
+        self.session.add(attachment)
+        await self.session.flush()
+        return attachment
+
+    async def get_attachments(self, creator_id: UUID, task_id: UUID) -> list[TaskAttachments]:
+        query = select(TaskAttachments).where(
+            TaskAttachments.creator_id == creator_id,
+            TaskAttachments.task_id == task_id
+        ).order_by(TaskAttachments.created, TaskAttachments.id)
+        return list((await self.session.execute(query)).scalars())
+
+    async def get_attachment(self,
+                             creator_id: UUID,
+                             task_id: UUID,
+                             attachment_id: UUID) -> Union[TaskAttachments, None]:
+        query = select(TaskAttachments).where(
+            TaskAttachments.creator_id == creator_id,
+            TaskAttachments.task_id == task_id,
+            TaskAttachments.id == attachment_id
+        )
+        return (await self.session.execute(query)).scalar()
+
+    async def delete_attachment(self, creator_id: UUID, task_id: UUID, attachment_id: UUID) -> bool:
+        """Deletes metadata only, the file is left to the garbage collection"""
+        query = delete(TaskAttachments).where(
+            TaskAttachments.creator_id == creator_id,
+            TaskAttachments.task_id == task_id,
+            TaskAttachments.id == attachment_id
+        ).returning(TaskAttachments.id)
+        return (await self.session.execute(query)).fetchone() is not None
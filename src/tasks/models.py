@@ -1,9 +1,11 @@
 import uuid
+from enum import Enum
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, ForeignKey, String, Boolean, DateTime, Integer, Date, Text
+from sqlalchemy import (Column, ForeignKey, String, Boolean, DateTime, Integer, Date, Text,
+                        BigInteger, Index, Sequence, PrimaryKeyConstraint)
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, text
 from sqlalchemy.dialects.postgresql import UUID
 from src.auth.models import User
 
@@ -12,21 +14,232 @@ from src.database.core import Base
 
 # Base = declarative_base()
 
+# Every write to a task (and every deletion) takes the next value of this
+# sequence, so `version` is a monotonic change cursor for delta sync.
+tasks_version_seq = Sequence('tasks_version_seq', metadata=Base.metadata)
+
+TASKS_PARTITIONS = 16
+
 
 class Tasks(Base):
+    """
+    Tasks are hash partitioned by `creator_id` into `TASKS_PARTITIONS`
+    partitions (created by migrations). Always filter by `creator_id`,
+    so that Postgres prunes the query down to a single partition.
+    """
     __tablename__ = 'tasks'
+    __table_args__ = (
+        PrimaryKeyConstraint('creator_id', 'id'),
+        Index('ix_tasks_creator_id_version', 'creator_id', 'version'),
+        # keyset indexes of task search, one per sort order
+        Index('ix_tasks_creator_id_deadline', 'creator_id', 'deadline', 'id'),
+        Index('ix_tasks_creator_id_created', 'creator_id', 'created', 'id'),
+        Index('ix_tasks_creator_id_title', 'creator_id', text('title COLLATE "C"'), 'id'),
+        # partial indexes of the maintenance jobs, queries must repeat
+        # their predicates (`NOT expired AND NOT is_recurring`, `expired`)
+        # verbatim to use them
+        Index('ix_tasks_deadline_pending', 'deadline', 'creator_id',
+              postgresql_where=text('NOT expired AND NOT is_recurring')),
+        Index('ix_tasks_archivable', text('coalesce(updated, created)'),
+              postgresql_where=text('expired')),
+        {'postgresql_partition_by': 'HASH (creator_id)'}
+    )
+    # fetch server generated `version`/`created` values with RETURNING
+    __mapper_args__ = {'eager_defaults': True}
 
     id = Column(UUID(as_uuid=True),  # as_uuid helps us to return python uuid
                 primary_key=True,
                 default=uuid.uuid4)
-    creator_id = Column(UUID(as_uuid=True), ForeignKey(User.id))
+    creator_id = Column(UUID(as_uuid=True), ForeignKey(User.id), primary_key=True)
     creator = relationship(lambda: User, back_populates='tasks')
     title = Column(String(length=150), nullable=False)
     task_text = Column(Text, nullable=False)
     created = Column(DateTime(timezone=True), server_default=func.now())
-    updated = Column(DateTime(timezone=True), nullable=True)
+    updated = Column(DateTime(timezone=True), nullable=True, onupdate=func.now())
     deadline = Column(Date, nullable=False)
     expired = Column(Boolean, default=False)
+    # master of a recurring task, kept by `RecurrenceManager`; masters
+    # never expire and stay out of the pending index
+    is_recurring = Column(Boolean, nullable=False, default=False, server_default=text('false'))
+    version = Column(BigInteger,
+                     server_default=tasks_version_seq.next_value(),
+                     onupdate=tasks_version_seq.next_value(),
+                     nullable=False)
 
     def __repr__(self):
         return f'Task: {self.title}, creator: {self.creator.username}'
+
+
+class TaskTombstones(Base):
+    """
+    Marker of a deleted task, kept so that delta sync
+    can tell clients which tasks to drop.
+    """
+    __tablename__ = 'tasks_tombstones'
+    __table_args__ = (
+        Index('ix_tasks_tombstones_creator_id_version', 'creator_id', 'version'),
+    )
+    __mapper_args__ = {'eager_defaults': True}
+
+    id = Column(UUID(as_uuid=True), primary_key=True)  # id of the deleted task
+    creator_id = Column(UUID(as_uuid=True), ForeignKey(User.id), nullable=False)
+    version = Column(BigInteger,
+                     server_default=tasks_version_seq.next_value(),
+                     nullable=False)
+    deleted = Column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f'Deleted task: {self.id}, version: {self.version}'
+
+
+class TasksArchive(Base):
+    """
+    Cold storage of old expired tasks, moved here by the
+    `archive_expired_tasks` job to keep `tasks` small.
+    """
+    __tablename__ = 'tasks_archive'
+    __table_args__ = (
+        PrimaryKeyConstraint('creator_id', 'id'),
+    )
+
+    id = Column(UUID(as_uuid=True), primary_key=True)
+    creator_id = Column(UUID(as_uuid=True), ForeignKey(User.id), primary_key=True)
+    title = Column(String(length=150), nullable=False)
+    task_text = Column(Text, nullable=False)
+    created = Column(DateTime(timezone=True))
+    updated = Column(DateTime(timezone=True), nullable=True)
+    deadline = Column(Date, nullable=False)
+    expired = Column(Boolean, default=True)
+    version = Column(BigInteger, nullable=False)
+    archived = Column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f'Archived task: {self.title}'
+
+
+class UserTaskStats(Base):
+    """
+    Task counters of a user, updated in the same transaction
+    as task writes and by the maintenance jobs.
+    """
+    __tablename__ = 'user_task_stats'
+
+    user_id = Column(UUID(as_uuid=True), ForeignKey(User.id), primary_key=True)
+    total = Column(Integer, nullable=False, default=0)
+    expired = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'Task stats of {self.user_id}: {self.total} total, {self.expired} expired'
+
+
+class UserTaskDeadlines(Base):
+    """
+    Number of not expired tasks of a user per deadline day.
+    "Due today" and "overdue" counters are read from here.
+    """
+    __tablename__ = 'user_task_deadlines'
+
+    user_id = Column(UUID(as_uuid=True), ForeignKey(User.id), primary_key=True)
+    deadline = Column(Date, primary_key=True)
+    pending = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'{self.pending} pending tasks of {self.user_id} on {self.deadline}'
+
+
+class DeadlineDigest(Base):
+    """
+    Marker of a deadline digest sent to a user. It is claimed before
+    the mail is sent, so a user gets at most one digest per day even
+    if the job runs twice.
+    """
+    __tablename__ = 'deadline_digests'
+
+    user_id = Column(UUID(as_uuid=True), ForeignKey(User.id), primary_key=True)
+    digest_date = Column(Date, primary_key=True)
+    sent = Column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f'Deadline digest of {self.user_id} on {self.digest_date}'
+
+
+class RecurrenceFrequencies(str, Enum):
+    daily = 'daily'
+    weekly = 'weekly'
+    monthly = 'monthly'
+
+
+class TaskRecurrences(Base):
+    """
+    Recurrence rule of a task. The task is the master of the series:
+    it holds title and text of every occurrence and its `deadline` is
+    the date of the first one. Occurrences are not stored, they are
+    expanded from the rule within the requested window.
+    There is no foreign key to `tasks`, so the rule of an archived
+    task comes back when it is restored; `TasksManager.delete_task`
+    deletes rules and exceptions of deleted tasks.
+    """
+    __tablename__ = 'task_recurrences'
+    __table_args__ = (
+        PrimaryKeyConstraint('creator_id', 'task_id'),
+    )
+
+    creator_id = Column(UUID(as_uuid=True), primary_key=True)
+    task_id = Column(UUID(as_uuid=True), primary_key=True)
+    frequency = Column(String(length=10), nullable=False)
+    interval = Column(Integer, nullable=False, default=1)
+    until = Column(Date, nullable=True)
+
+    def __repr__(self):
+        return f'Recurrence of {self.task_id}: every {self.interval} {self.frequency}'
+
+
+class TaskOccurrences(Base):
+    """
+    Exception of a recurring task: occurrence which was edited,
+    completed or cancelled. Columns left null are taken from the
+    master task. Like the rule, it outlives archiving of the task.
+    """
+    __tablename__ = 'task_occurrences'
+    __table_args__ = (
+        PrimaryKeyConstraint('creator_id', 'task_id', 'occurrence'),
+    )
+
+    creator_id = Column(UUID(as_uuid=True), primary_key=True)
+    task_id = Column(UUID(as_uuid=True), primary_key=True)
+    occurrence = Column(Date, primary_key=True)
+    title = Column(String(length=150), nullable=True)
+    task_text = Column(Text, nullable=True)
+    expired = Column(Boolean, nullable=False, default=False)
+    cancelled = Column(Boolean, nullable=False, default=False)
+    updated = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f'Occurrence of {self.task_id} on {self.occurrence}'
+
+
+class TaskAttachments(Base):
+    """
+    Metadata of a file attached to a task. The bytes live in the
+    attachment store under their `sha256`, shared by identical files.
+    There is no foreign key to `tasks`: attachments of an archived
+    task come back when it is restored, and the attachments garbage
+    collection drops those of deleted tasks.
+    """
+    __tablename__ = 'task_attachments'
+    __table_args__ = (
+        PrimaryKeyConstraint('creator_id', 'task_id', 'id'),
+        Index('ix_task_attachments_sha256', 'sha256'),
+    )
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    creator_id = Column(UUID(as_uuid=True), primary_key=True)
+    task_id = Column(UUID(as_uuid=True), primary_key=True)
+    filename = Column(String(length=255), nullable=False)
+    content_type = Column(String(length=255), nullable=False)
+    size = Column(BigInteger, nullable=False)
+    sha256 = Column(String(length=64), nullable=False)
+    created = Column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f'Attachment {self.filename} of {self.task_id}'
@@ -0,0 +1,197 @@
+"""
+Push of task changes to connected clients.
+
+Task writes emit `NOTIFY task_changes` inside their transaction, so
+an event is delivered only when the change is committed. Every worker
+process keeps one asyncpg connection which LISTENs on the channel and
+fans events out to the clients subscribed in this process, so the
+number of database connections does not depend on the number of
+open streams.
+"""
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import NamedTuple, Optional
+
+import asyncpg
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.core import get_asyncpg_dsn
+
+logger = logging.getLogger(__name__)
+
+TASK_CHANGES_CHANNEL = 'task_changes'
+SUBSCRIPTION_QUEUE_SIZE = 100
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+
+
+class TaskOperations:
+    CREATED = 'created'
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+
+
+class TaskEvent(NamedTuple):
+    type: str
+    data: Optional[dict] = None
+
+
+RESYNC_EVENT = TaskEvent(type='resync')
+
+
+async def notify_task_change(session: AsyncSession,
+                             creator_id: UUID,
+                             task_id: UUID,
+                             version: int,
+                             operation: str):
+    """
+    Queues a notification about the task change. Postgres
+    delivers it to listeners when the transaction commits.
+    """
+    payload = json.dumps({
+        'creator_id': str(creator_id),
+        'id': str(task_id),
+        'version': version,
+        'op': operation
+    })
+    await session.execute(select(func.pg_notify(TASK_CHANGES_CHANNEL, payload)))
+
+
+async def notify_resync(session: AsyncSession, creator_id: UUID):
+    """
+    Queues a `resync` event for the user's subscribers, for bulk
+    changes which are cheaper to catch up through delta sync than
+    to announce task by task.
+    """
+    payload = json.dumps({
+        'creator_id': str(creator_id),
+        'op': RESYNC_EVENT.type
+    })
+    await session.execute(select(func.pg_notify(TASK_CHANGES_CHANNEL, payload)))
+
+
+class Subscription:
+    """
+    Bounded queue of events of one connected client.
+
+    A slow client never blocks the listener: when its queue is
+    full the pending events are dropped and replaced by a single
+    `resync` event, after which the client is expected to catch
+    up through the delta sync endpoint.
+    """
+
+    def __init__(self, creator_id: str, maxsize: int = SUBSCRIPTION_QUEUE_SIZE):
+        self.creator_id = creator_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+
+    def push(self, event: TaskEvent):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC_EVENT)
+
+    async def get(self) -> TaskEvent:
+        return await self.queue.get()
+
+
+class TaskChangesListener:
+    """
+    Single LISTEN connection of the worker process.
+
+    The connection is opened lazily with the first subscription and
+    reopened with backoff if it is lost. Subscribers get a `resync`
+    event after a reconnect, since notifications sent in between
+    are lost.
+    """
+
+    def __init__(self, channel: str = TASK_CHANGES_CHANNEL):
+        self.channel = channel
+        self._connection: Optional[asyncpg.Connection] = None
+        self._subscribers: dict[str, set[Subscription]] = defaultdict(set)
+        self._lock: Optional[asyncio.Lock] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    async def _connect(self):
+        connection = await asyncpg.connect(get_asyncpg_dsn())
+        await connection.add_listener(self.channel, self._on_notify)
+        connection.add_termination_listener(self._on_termination)
+        self._connection = connection
+
+    async def start(self):
+        if self._lock is None:
+            # created here to be bound to the running loop
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._connection is None or self._connection.is_closed():
+                self._closed = False
+                await self._connect()
+
+    async def stop(self):
+        self._closed = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if self._connection is not None and not self._connection.is_closed():
+            self._connection.remove_termination_listener(self._on_termination)
+            await self._connection.close()
+        self._connection = None
+
+    def _broadcast(self, event: TaskEvent):
+        for subscriptions in self._subscribers.values():
+            for subscription in subscriptions:
+                subscription.push(event)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            logger.warning('Malformed task change notification: %s', payload)
+            return
+        event = TaskEvent(type=data['op'], data=data)
+        for subscription in self._subscribers.get(data['creator_id'], ()):
+            subscription.push(event)
+
+    def _on_termination(self, connection):
+        self._connection = None
+        if not self._closed and self._reconnect_task is None:
+            self._reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        delay = RECONNECT_DELAY
+        try:
+            while not self._closed:
+                try:
+                    await self.start()
+                except (OSError, asyncpg.PostgresError) as error:
+                    logger.warning('Task changes listener reconnect failed: %s', error)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                else:
+                    self._broadcast(RESYNC_EVENT)
+                    return
+        finally:
+            self._reconnect_task = None
+
+    @asynccontextmanager
+    async def subscribe(self, creator_id: UUID):
+        await self.start()
+        subscription = Subscription(creator_id=str(creator_id))
+        self._subscribers[subscription.creator_id].add(subscription)
+        try:
+            yield subscription
+        finally:
+            subscriptions = self._subscribers[subscription.creator_id]
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscribers[subscription.creator_id]
+
+
+task_changes_listener = TaskChangesListener()
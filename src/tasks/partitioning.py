@@ -0,0 +1,75 @@
+"""
+Online backfill of the hash partitioned tasks table.
+
+Run between migrations 24f4e806ccb0 and 8a68672dd75b:
+
+    python -m src.tasks.partitioning [batch_size]
+
+Rows are copied in primary key order, one short autocommitted batch
+at a time, so the application keeps working on `tasks` meanwhile.
+Source rows of a batch are locked `FOR KEY SHARE`, so a concurrent
+delete waits for the batch and its trigger then removes the copy;
+concurrent updates are mirrored by the trigger and win over the copy.
+When everything is copied the table is marked as backfilled, which
+the swap migration checks. Tasks without a creator have no partition
+and are skipped, here and by the mirror trigger; they stay in the old
+table, see migration 8a68672dd75b.
+"""
+import asyncio
+import sys
+import uuid
+from typing import Optional
+
+from sqlalchemy import text
+
+from src.database.core import engine
+
+BACKFILL_BATCH_SIZE = 5000
+BACKFILLED_MARK = 'backfilled'
+
+COPY_BATCH_QUERY = text("""
+    WITH batch AS (
+        SELECT id, creator_id, title, task_text, created, updated, deadline, expired, version
+        FROM tasks
+        WHERE creator_id IS NOT NULL
+          AND (CAST(:last_id AS UUID) IS NULL OR id > CAST(:last_id AS UUID))
+        ORDER BY id
+        LIMIT :batch_size
+        FOR KEY SHARE
+    ), copied AS (
+        INSERT INTO tasks_partitioned
+            (id, creator_id, title, task_text, created, updated, deadline, expired, version)
+        SELECT id, creator_id, title, task_text, created, updated, deadline, expired, version
+        FROM batch
+        ON CONFLICT (creator_id, id) DO NOTHING
+    )
+    SELECT id FROM batch ORDER BY id DESC LIMIT 1
+""")
+
+
+async def backfill_partitioned_tasks(batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """
+    Copies all tasks into `tasks_partitioned`.
+
+    Returns:
+        Number of copied batches.
+    """
+    last_id: Optional[uuid.UUID] = None
+    batches = 0
+    async with engine.connect() as connection:
+        while True:
+            result = await connection.execute(COPY_BATCH_QUERY,
+                                              {'last_id': last_id, 'batch_size': batch_size})
+            row = result.fetchone()
+            if row is None:
+                break
+            last_id = row[0]
+            batches += 1
+        await connection.execute(text(f"COMMENT ON TABLE tasks_partitioned IS '{BACKFILLED_MARK}'"))
+    return batches
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else BACKFILL_BATCH_SIZE
+    copied = asyncio.run(backfill_partitioned_tasks(size))
+    print(f'Copied {copied} batches, tasks_partitioned is ready for the swap.')
@@ -0,0 +1,213 @@
+"""
+Filter and sort spec of task searches, compiled to keyset queries.
+
+Every sort order has an index `(creator_id, <sort column>, id)`. The
+filter on the sort column becomes a range of that index, and pages are
+read past a keyset cursor, so such a search reads only the rows it
+returns whatever page it is.
+
+Other filters have no index to seek on. They are applied to at most
+`SCAN_LIMIT` index rows past the cursor; when the scan runs out before
+the page is full, the cursor points past the scanned rows and the
+client continues from there. A page therefore never costs more than
+`SCAN_LIMIT` rows, however selective the filters are.
+"""
+import base64
+import binascii
+import datetime
+import json
+import uuid
+from typing import NamedTuple, Optional
+
+from sqlalchemy import and_, or_, select, tuple_, func, literal
+from sqlalchemy.dialects.postgresql import UUID
+
+from .models import Tasks
+
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGE_SIZE = 200
+SCAN_LIMIT = 5000
+
+
+class SortFields:
+    DEADLINE = 'deadline'
+    CREATED = 'created'
+    TITLE = 'title'
+
+
+SORT_REGEX = '^-?(deadline|created|title)$'
+
+
+class TaskQueryError(ValueError):
+    pass
+
+
+class TaskQuerySpec(NamedTuple):
+    expired: Optional[bool] = None
+    deadline_from: Optional[datetime.date] = None
+    deadline_to: Optional[datetime.date] = None
+    created_from: Optional[datetime.datetime] = None
+    created_to: Optional[datetime.datetime] = None
+    title_prefix: Optional[str] = None
+    sort: str = SortFields.DEADLINE
+    limit: int = SEARCH_PAGE_SIZE
+    cursor: Optional[str] = None
+
+    @property
+    def sort_field(self) -> str:
+        return self.sort.lstrip('-')
+
+    @property
+    def descending(self) -> bool:
+        return self.sort.startswith('-')
+
+
+class TaskPageData(NamedTuple):
+    items: list
+    cursor: Optional[str]
+
+
+def _sort_column(columns, field: str):
+    # titles are ordered bytewise, so a prefix is a range of the index
+    if field == SortFields.TITLE:
+        return columns.title.collate('C')
+    return columns[field]
+
+
+def _prefix_upper_bound(prefix: str) -> Optional[str]:
+    """Returns the smallest string greater than all strings starting with `prefix`"""
+    while prefix:
+        last = ord(prefix[-1])
+        if last < 0x10FFFF:
+            return prefix[:-1] + chr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+def _range_filters(spec: TaskQuerySpec, columns) -> dict:
+    """Returns conditions of every filter, keyed by the filtered field"""
+    filters = {}
+    if spec.deadline_from is not None or spec.deadline_to is not None:
+        filters[SortFields.DEADLINE] = and_(
+            columns.deadline >= spec.deadline_from if spec.deadline_from is not None else True,
+            columns.deadline <= spec.deadline_to if spec.deadline_to is not None else True
+        )
+    if spec.created_from is not None or spec.created_to is not None:
+        filters[SortFields.CREATED] = and_(
+            columns.created >= spec.created_from if spec.created_from is not None else True,
+            columns.created <= spec.created_to if spec.created_to is not None else True
+        )
+    if spec.title_prefix:
+        title = _sort_column(columns, SortFields.TITLE)
+        upper = _prefix_upper_bound(spec.title_prefix)
+        filters[SortFields.TITLE] = and_(
+            title >= spec.title_prefix,
+            title < upper if upper is not None else True
+        )
+    if spec.expired is not None:
+        filters['expired'] = columns.expired.is_(spec.expired)
+    return filters
+
+
+def encode_cursor(sort: str, value, task_id) -> str:
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        value = value.isoformat()
+    payload = json.dumps([sort, value, str(task_id)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(spec: TaskQuerySpec) -> tuple:
+    """
+    Returns sort value and task id of the cursor.
+
+    Raises:
+        TaskQueryError: cursor is malformed or made for another sort.
+    """
+    try:
+        padded = spec.cursor + '=' * (-len(spec.cursor) % 4)
+        sort, value, task_id = json.loads(base64.urlsafe_b64decode(padded))
+    except (binascii.Error, TypeError, ValueError) as error:
+        raise TaskQueryError('Invalid cursor!') from error
+    if sort != spec.sort:
+        raise TaskQueryError('Cursor does not match the sort order!')
+    try:
+        if spec.sort_field == SortFields.DEADLINE:
+            value = datetime.date.fromisoformat(value)
+        elif spec.sort_field == SortFields.CREATED:
+            value = datetime.datetime.fromisoformat(value)
+        elif not isinstance(value, str):
+            raise TypeError(value)
+        return value, uuid.UUID(task_id)
+    except (TypeError, ValueError) as error:
+        raise TaskQueryError('Invalid cursor!') from error
+
+
+def _ordered(spec: TaskQuerySpec, columns) -> list:
+    keys = [_sort_column(columns, spec.sort_field), columns.id]
+    return [key.desc() for key in keys] if spec.descending else keys
+
+
+def compile_task_query(spec: TaskQuerySpec, creator_id: UUID):
+    """
+    Compiles the spec to a query of the user's tasks. The query
+    returns up to `limit + 1` matching rows and, when some filters
+    are not served by the index, also the last scanned row, which
+    has `position` equal to the number of `scanned` rows.
+
+    Raises:
+        TaskQueryError: cursor is invalid.
+    """
+    table = Tasks.__table__
+    sort_field = spec.sort_field
+    filters = _range_filters(spec, table.c)
+    conditions = [table.c.creator_id == creator_id]
+    if sort_field in filters:
+        conditions.append(filters.pop(sort_field))
+    if spec.cursor is not None:
+        value, task_id = decode_cursor(spec)
+        sort_key = tuple_(_sort_column(table.c, sort_field), table.c.id)
+        cursor_key = tuple_(literal(value, type_=table.c[sort_field].type),
+                            literal(task_id, type_=table.c.id.type))
+        conditions.append(sort_key < cursor_key if spec.descending else sort_key > cursor_key)
+
+    if not filters:
+        return select(table, literal(True).label('matched')).where(
+            *conditions
+        ).order_by(*_ordered(spec, table.c)).limit(spec.limit + 1)
+
+    scanned = select(table).where(*conditions).order_by(
+        *_ordered(spec, table.c)
+    ).limit(SCAN_LIMIT).subquery('scanned')
+    matched = and_(*[condition for field, condition in _range_filters(spec, scanned.c).items()
+                     if field != sort_field])
+    order = _ordered(spec, scanned.c)
+    windowed = select(
+        scanned,
+        matched.label('matched'),
+        func.row_number().over(order_by=order).label('position'),
+        func.count().over().label('scanned'),
+        func.count().filter(matched).over(order_by=order).label('matched_position')
+    ).subquery('windowed')
+    return select(windowed).where(
+        or_(and_(windowed.c.matched, windowed.c.matched_position <= spec.limit + 1),
+            windowed.c.position == windowed.c.scanned)
+    ).order_by(windowed.c.position)
+
+
+def paginate(spec: TaskQuerySpec, rows: list) -> TaskPageData:
+    """
+    Cuts the rows of `compile_task_query` into a page
+    and the cursor of the next one.
+    """
+    matched = [row for row in rows if row.matched]
+    if len(matched) > spec.limit:
+        items = matched[:spec.limit]
+        last = items[-1]
+    elif rows and rows[-1]._mapping.get('scanned') == SCAN_LIMIT:
+        # the scan ran out before the page was full
+        items = matched
+        last = rows[-1]
+    else:
+        return TaskPageData(items=matched, cursor=None)
+    cursor = encode_cursor(spec.sort, getattr(last, spec.sort_field), last.id)
+    return TaskPageData(items=items, cursor=cursor)
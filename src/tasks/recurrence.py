@@ -0,0 +1,271 @@
+"""
+Recurring tasks.
+
+A recurring task is an ordinary task (the master) with a row in
+`task_recurrences`. Its occurrences are computed from the rule when a
+window of dates is requested, and only occurrences which were edited,
+completed or cancelled are stored, in `task_occurrences`. So storage
+grows with the number of exceptions and the cost of a listing with
+the size of the window, not with the age of the series.
+
+Every change of the rule or of an exception takes a new version of
+the master task, so delta sync reports the master as changed and the
+client expands its visible window again.
+"""
+import calendar
+import datetime
+from typing import NamedTuple, Optional, Union
+
+from sqlalchemy import select, update, delete, func, exists
+from sqlalchemy.dialects.postgresql import UUID, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import Tasks, TaskRecurrences, TaskOccurrences, RecurrenceFrequencies, tasks_version_seq
+from .notifications import notify_task_change, TaskOperations
+from .stats import TaskStatsManager
+from .schemas import TaskRecurrenceSet, TaskOccurrenceUpdate
+
+# longest window of dates occurrences are expanded in at once
+MAX_WINDOW_DAYS = 366
+
+
+class TaskOccurrenceData(NamedTuple):
+    task_id: UUID
+    occurrence: datetime.date
+    title: str
+    task_text: str
+    expired: bool
+    edited: bool
+    version: int
+
+
+def _add_months(day: datetime.date, months: int, day_of_month: int) -> datetime.date:
+    month_index = day.month - 1 + months
+    year, month = day.year + month_index // 12, month_index % 12 + 1
+    return datetime.date(year, month, min(day_of_month, calendar.monthrange(year, month)[1]))
+
+
+def occurrence_dates(start: datetime.date,
+                     frequency: str,
+                     interval: int,
+                     until: Optional[datetime.date],
+                     window_start: datetime.date,
+                     window_end: datetime.date) -> list[datetime.date]:
+    """
+    Returns dates of the series starting at `start` which fall
+    into the window, both ends included. The first occurrence in
+    the window is computed directly, so the cost depends on the
+    window only.
+    """
+    last = min(window_end, until) if until is not None else window_end
+    first = max(start, window_start)
+    if first > last:
+        return []
+    dates = []
+    if frequency == RecurrenceFrequencies.monthly:
+        months = (first.year - start.year) * 12 + first.month - start.month
+        index = max(0, -(-months // interval))
+        day = _add_months(start, index * interval, start.day)
+        while day <= last:
+            if day >= first:
+                dates.append(day)
+            index += 1
+            day = _add_months(start, index * interval, start.day)
+        return dates
+    step = interval * (7 if frequency == RecurrenceFrequencies.weekly else 1)
+    index = -(-(first - start).days // step)
+    day = start + datetime.timedelta(days=index * step)
+    while day <= last:
+        dates.append(day)
+        day += datetime.timedelta(days=step)
+    return dates
+
+
+def is_occurrence(rule: TaskRecurrences, start: datetime.date, day: datetime.date) -> bool:
+    return day in occurrence_dates(start, rule.frequency, rule.interval, rule.until, day, day)
+
+
+class RecurrenceManager:
+    """
+    Manager for recurrence rules and occurrences of one user's
+    tasks. Write methods follow the rules of `TasksManager`: they
+    must run in a real transaction and lock the creator first.
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+        self.stats = TaskStatsManager(session)
+
+    async def _lock_creator(self, creator_id: UUID):
+        query = select(func.pg_advisory_xact_lock(func.hashtext(str(creator_id))))
+        await self.session.execute(query)
+
+    async def _get_master(self, creator_id: UUID, task_id: UUID) -> Union[tuple, None]:
+        query = select(Tasks, TaskRecurrences).outerjoin(
+            TaskRecurrences,
+            (TaskRecurrences.creator_id == Tasks.creator_id) & (TaskRecurrences.task_id == Tasks.id)
+        ).where(Tasks.creator_id == creator_id, Tasks.id == task_id)
+        result = await self.session.execute(query)
+        return result.fetchone()
+
+    async def _touch_master(self, creator_id: UUID, task_id: UUID, **values) -> int:
+        query = update(Tasks).where(
+            Tasks.creator_id == creator_id,
+            Tasks.id == task_id
+        ).values(version=tasks_version_seq.next_value(), updated=func.now(), **values).returning(Tasks.version)
+        version = (await self.session.execute(query)).scalar()
+        await notify_task_change(self.session, creator_id, task_id, version, TaskOperations.UPDATED)
+        return version
+
+    async def is_recurring(self, creator_id: UUID, task_id: UUID) -> bool:
+        query = exists().where(TaskRecurrences.creator_id == creator_id,
+                               TaskRecurrences.task_id == task_id).select()
+        return (await self.session.execute(query)).scalar()
+
+    async def set_recurrence(self,
+                             creator_id: UUID,
+                             task_id: UUID,
+                             data: TaskRecurrenceSet) -> Union[TaskRecurrences, None]:
+        """
+        Creates or replaces the rule of the task. Returns
+        the rule or None if there is no such task.
+        """
+        await self._lock_creator(creator_id)
+        row = await self._get_master(creator_id, task_id)
+        if row is None:
+            return None
+        task, rule = row
+        query = insert(TaskRecurrences).values(creator_id=creator_id,
+                                               task_id=task_id,
+                                               frequency=data.frequency.value,
+                                               interval=data.interval,
+                                               until=data.until)
+        query = query.on_conflict_do_update(
+            index_elements=[TaskRecurrences.creator_id, TaskRecurrences.task_id],
+            set_={'frequency': query.excluded.frequency,
+                  'interval': query.excluded.interval,
+                  'until': query.excluded.until}
+        ).returning(TaskRecurrences)
+        rule_set = (await self.session.scalars(query)).first()
+        if rule is None:
+            # the master stops being pending on its own deadline
+            await self.stats.task_changed(creator_id,
+                                          before=(task.deadline, task.expired),
+                                          after=(None, task.expired))
+        await self._touch_master(creator_id, task_id, is_recurring=True)
+        return rule_set
+
+    async def delete_recurrence(self, creator_id: UUID, task_id: UUID) -> bool:
+        """
+        Turns the task back into an ordinary one and drops its
+        exceptions. Returns False if the task is not recurring.
+        """
+        await self._lock_creator(creator_id)
+        row = await self._get_master(creator_id, task_id)
+        if row is None or row[1] is None:
+            return False
+        task = row[0]
+        await self.drop_series(creator_id, task_id)
+        await self.stats.task_changed(creator_id,
+                                      before=(None, task.expired),
+                                      after=(task.deadline, task.expired))
+        await self._touch_master(creator_id, task_id, is_recurring=False)
+        return True
+
+    async def drop_series(self, creator_id: UUID, task_id: UUID):
+        """Deletes the rule and exceptions of a deleted task"""
+        await self.session.execute(delete(TaskRecurrences).where(TaskRecurrences.creator_id == creator_id,
+                                                                 TaskRecurrences.task_id == task_id))
+        await self.session.execute(delete(TaskOccurrences).where(TaskOccurrences.creator_id == creator_id,
+                                                                 TaskOccurrences.task_id == task_id))
+
+    async def update_occurrence(self,
+                                creator_id: UUID,
+                                task_id: UUID,
+                                occurrence: datetime.date,
+                                data: TaskOccurrenceUpdate) -> Union[TaskOccurrenceData, None]:
+        """
+        Stores the change of one occurrence as an exception row.
+        Returns the occurrence or None if the task is not recurring
+        or has no occurrence on that date.
+        """
+        await self._lock_creator(creator_id)
+        row = await self._get_master(creator_id, task_id)
+        if row is None or row[1] is None:
+            return None
+        task, rule = row
+        if not is_occurrence(rule, task.deadline, occurrence):
+            return None
+        values = data.dict(exclude_unset=True)
+        # flags can not be reset to null, unlike overrides
+        values = {field: value for field, value in values.items()
+                  if value is not None or field in ('title', 'task_text')}
+        query = insert(TaskOccurrences).values(creator_id=creator_id,
+                                               task_id=task_id,
+                                               occurrence=occurrence,
+                                               **values)
+        if values:
+            query = query.on_conflict_do_update(
+                index_elements=[TaskOccurrences.creator_id, TaskOccurrences.task_id, TaskOccurrences.occurrence],
+                set_={**{field: query.excluded[field] for field in values}, 'updated': func.now()}
+            )
+        else:
+            query = query.on_conflict_do_nothing()
+        await self.session.execute(query)
+        version = await self._touch_master(creator_id, task_id)
+        exception = await self.session.get(TaskOccurrences, (creator_id, task_id, occurrence),
+                                           populate_existing=True)
+        return TaskOccurrenceData(task_id=task_id,
+                                  occurrence=occurrence,
+                                  title=exception.title or task.title,
+                                  task_text=exception.task_text or task.task_text,
+                                  expired=exception.expired,
+                                  edited=True,
+                                  version=version)
+
+    async def get_occurrences(self,
+                              creator_id: UUID,
+                              start: datetime.date,
+                              end: datetime.date) -> list[TaskOccurrenceData]:
+        """
+        Expands occurrences of the user's recurring tasks within the
+        window, both ends included, and applies their exceptions.
+        Cancelled occurrences and series of expired masters, which
+        are finished, are left out.
+        """
+        masters_query = select(Tasks, TaskRecurrences).join(
+            TaskRecurrences,
+            (TaskRecurrences.creator_id == Tasks.creator_id) & (TaskRecurrences.task_id == Tasks.id)
+        ).where(
+            Tasks.creator_id == creator_id,
+            Tasks.expired.is_not(True),
+            Tasks.deadline <= end,
+            (TaskRecurrences.until.is_(None)) | (TaskRecurrences.until >= start)
+        )
+        masters = (await self.session.execute(masters_query)).fetchall()
+        if not masters:
+            return []
+        exceptions_query = select(TaskOccurrences).where(
+            TaskOccurrences.creator_id == creator_id,
+            TaskOccurrences.task_id.in_([task.id for task, _ in masters]),
+            TaskOccurrences.occurrence.between(start, end)
+        )
+        exceptions = {(exception.task_id, exception.occurrence): exception
+                      for exception in (await self.session.scalars(exceptions_query))}
+        occurrences = []
+        for task, rule in masters:
+            for day in occurrence_dates(task.deadline, rule.frequency, rule.interval, rule.until, start, end):
+                exception = exceptions.get((task.id, day))
+                if exception is not None and exception.cancelled:
+                    continue
+                occurrences.append(TaskOccurrenceData(
+                    task_id=task.id,
+                    occurrence=day,
+                    title=(exception.title or task.title) if exception else task.title,
+                    task_text=(exception.task_text or task.task_text) if exception else task.task_text,
+                    expired=exception.expired if exception else False,
+                    edited=exception is not None,
+                    version=task.version
+                ))
+        occurrences.sort(key=lambda item: (item.occurrence, item.title))
+        return occurrences
@@ -0,0 +1,176 @@
+"""
+Daily digests of upcoming task deadlines, sent by Celery workers.
+
+The dispatcher splits users into `DIGEST_SHARDS` shards by the hash of
+`creator_id`, and every shard is handled by its own job. A shard reads
+its users with one range query over `ix_tasks_deadline_pending` and
+mails them in batches of `DIGEST_BATCH_USERS`, one digest per user
+whatever the number of their tasks.
+
+Before a batch is mailed its users are claimed in `deadline_digests`,
+so a repeated or concurrent run skips them. Claims of failed mails are
+released, and the next run retries them.
+"""
+import asyncio
+import datetime
+import logging
+from itertools import groupby
+from typing import NamedTuple, Optional
+
+from fastapi_mail import FastMail, MessageSchema
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from src.auth.token import env, get_mail_config
+from src.tracing import span
+
+logger = logging.getLogger(__name__)
+
+DIGEST_SUBJECT = 'CodeSphere - upcoming deadlines'
+DIGEST_SHARDS = 16
+DIGEST_BATCH_USERS = 500
+# tasks with deadline from the digest day up to this many days later
+DIGEST_LOOKAHEAD_DAYS = 1
+# tasks listed in one digest, the rest is only counted
+DIGEST_MAX_TASKS = 50
+# concurrent SMTP connections of one job
+DIGEST_MAIL_CONCURRENCY = 10
+DIGEST_MARKERS_KEEP_DAYS = 7
+
+# Repeats the predicate of `ix_tasks_deadline_pending`, so the shard is
+# read from the index only.
+DUE_USERS_QUERY = text("""
+    SELECT DISTINCT creator_id FROM tasks
+    WHERE NOT expired AND NOT is_recurring AND deadline BETWEEN :start AND :end
+      AND (hashtext(creator_id::text) & 2147483647) % :shards = :shard
+""")
+
+CLAIM_QUERY = text("""
+    INSERT INTO deadline_digests (user_id, digest_date)
+    SELECT user_id, CAST(:digest_date AS date) FROM unnest(CAST(:users AS uuid[])) AS user_id
+    ON CONFLICT DO NOTHING
+    RETURNING user_id
+""")
+
+RELEASE_QUERY = text("""
+    DELETE FROM deadline_digests
+    WHERE user_id = ANY(CAST(:users AS uuid[])) AND digest_date = :digest_date
+""")
+
+DIGEST_TASKS_QUERY = text("""
+    SELECT u.id, u.email, u.username, t.title, t.deadline
+    FROM users u
+    JOIN tasks t ON t.creator_id = u.id
+    WHERE u.id = ANY(CAST(:users AS uuid[])) AND u.is_active
+      AND NOT t.expired AND NOT t.is_recurring AND t.deadline BETWEEN :start AND :end
+    ORDER BY u.id, t.deadline, t.title
+""")
+
+PURGE_MARKERS_QUERY = text("""
+    DELETE FROM deadline_digests WHERE digest_date < :before
+""")
+
+
+class DigestTask(NamedTuple):
+    title: str
+    deadline: datetime.date
+
+
+class Digest(NamedTuple):
+    user_id: str
+    email: str
+    username: str
+    tasks: list[DigestTask]
+    total: int
+
+
+def _digest_window(digest_date: datetime.date) -> dict:
+    return {'start': digest_date,
+            'end': digest_date + datetime.timedelta(days=DIGEST_LOOKAHEAD_DAYS)}
+
+
+def collect_digests(connection: Connection, users: list, digest_date: datetime.date) -> list[Digest]:
+    rows = connection.execute(DIGEST_TASKS_QUERY, {'users': users, **_digest_window(digest_date)})
+    digests = []
+    for (user_id, email, username), user_rows in groupby(rows, key=lambda row: row[:3]):
+        tasks = [DigestTask(title=row.title, deadline=row.deadline) for row in user_rows]
+        digests.append(Digest(user_id=str(user_id),
+                              email=email,
+                              username=username,
+                              tasks=tasks[:DIGEST_MAX_TASKS],
+                              total=len(tasks)))
+    return digests
+
+
+async def send_digests(digests: list[Digest], digest_date: datetime.date) -> list[str]:
+    """
+    Sends digests over at most `DIGEST_MAIL_CONCURRENCY`
+    connections at a time.
+
+    Returns:
+        Ids of users whose digest could not be sent.
+    """
+    mail = FastMail(get_mail_config())
+    template = env.get_template('deadline_digest.html')
+    semaphore = asyncio.Semaphore(DIGEST_MAIL_CONCURRENCY)
+
+    async def send(digest: Digest) -> Optional[str]:
+        html = template.render(subject=DIGEST_SUBJECT,
+                               username=digest.username,
+                               tasks=digest.tasks,
+                               total=digest.total,
+                               digest_date=digest_date)
+        message = MessageSchema(subject=DIGEST_SUBJECT,
+                                recipients=[digest.email],
+                                body=html,
+                                subtype='html')
+        async with semaphore:
+            try:
+                with span('smtp.send', **{'mail.template': 'deadline_digest'}):
+                    await mail.send_message(message)
+            except Exception as error:
+                logger.warning('Deadline digest to %s failed: %s', digest.email, error)
+                return digest.user_id
+
+    failed = await asyncio.gather(*(send(digest) for digest in digests))
+    return [user_id for user_id in failed if user_id is not None]
+
+
+def purge_digest_markers(connection: Connection, digest_date: datetime.date):
+    with connection.begin():
+        before = digest_date - datetime.timedelta(days=DIGEST_MARKERS_KEEP_DAYS)
+        connection.execute(PURGE_MARKERS_QUERY, {'before': before})
+
+
+def send_deadline_digests(connection: Connection,
+                          shard: int,
+                          digest_date: datetime.date,
+                          shards: int = DIGEST_SHARDS,
+                          batch_users: int = DIGEST_BATCH_USERS) -> int:
+    """
+    Sends deadline digests to the users of one shard.
+
+    Returns:
+        Number of sent digests.
+    """
+    with connection.begin():
+        users = [str(row[0]) for row in
+                 connection.execute(DUE_USERS_QUERY, {'shard': shard,
+                                                      'shards': shards,
+                                                      **_digest_window(digest_date)})]
+    sent = 0
+    for offset in range(0, len(users), batch_users):
+        batch = users[offset:offset + batch_users]
+        with connection.begin():
+            claimed = [str(row[0]) for row in
+                       connection.execute(CLAIM_QUERY, {'users': batch, 'digest_date': digest_date})]
+        if not claimed:
+            continue
+        with connection.begin():
+            digests = collect_digests(connection, claimed, digest_date)
+        failed = asyncio.run(send_digests(digests, digest_date))
+        if failed:
+            with connection.begin():
+                connection.execute(RELEASE_QUERY, {'users': failed, 'digest_date': digest_date})
+        sent += len(digests) - len(failed)
+    return sent
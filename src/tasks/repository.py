@@ -0,0 +1,51 @@
+"""
+Read-only fast path of the task list.
+
+Enabled by `DATABASE_RAW_READS`, like `src.auth.repository`. The query
+runs directly on the asyncpg connection behind the session, and records
+are turned straight into dicts of the `TaskShow` fields, skipping ORM
+row processing, the identity map and `from_orm`. Like the user lookup,
+it is unmeasured: see `benchmarks/read_paths.py`.
+"""
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.core import get_driver_connection
+from src.singleflight import SingleFlight, flight_session
+
+# columns of `TaskShow`, in the order of `TasksManager.get_user_tasks`
+USER_TASKS_QUERY = """
+    SELECT id, title, task_text, created, updated, deadline, expired, version
+    FROM tasks
+    WHERE creator_id = $1
+    ORDER BY deadline, id
+"""
+
+# Task list flights of both readers. Keys start with the reader
+# class, as each reader returns its own kind of rows.
+user_tasks_flights = SingleFlight()
+
+
+class TaskReadRepository:
+    """Must be called inside a session transaction, as `TasksManager` reads are"""
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def get_user_tasks(self, creator_id: UUID) -> list[dict]:
+        connection = await get_driver_connection(self.session)
+        records = await connection.fetch(USER_TASKS_QUERY, creator_id)
+        return [dict(record) for record in records]
+
+    async def get_user_tasks_shared(self, creator_id: UUID) -> list[dict]:
+        """
+        Same as `get_user_tasks`, but concurrent calls of the worker
+        share one query, see `src.singleflight`. Call it outside of a
+        transaction of the session, the query runs in a session of
+        its own.
+        """
+        async def fetch(seal):
+            async with flight_session(self.session, seal) as shared_session:
+                return await TaskReadRepository(shared_session).get_user_tasks(creator_id)
+
+        return await user_tasks_flights.do((TaskReadRepository, self.session.bind, creator_id), fetch)
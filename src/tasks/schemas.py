@@ -0,0 +1,110 @@
+import uuid
+from datetime import date, datetime
+from typing import Optional
+
+from pydantic import BaseModel, constr, conint, validator
+
+from src.auth.schemas import MainModel
+from .models import RecurrenceFrequencies
+
+
+class TaskCreate(BaseModel):
+    title: constr(min_length=1, max_length=150)
+    task_text: str
+    deadline: date
+
+
+class TaskUpdate(BaseModel):
+    title: Optional[constr(min_length=1, max_length=150)] = None
+    task_text: Optional[str] = None
+    deadline: Optional[date] = None
+    expired: Optional[bool] = None
+
+    @validator('title', 'task_text', 'deadline', 'expired', pre=True)
+    def reject_null(cls, value):
+        # fields may be left out, but the columns are not nullable
+        if value is None:
+            raise ValueError('may be omitted, but not null')
+        return value
+
+
+class TaskShow(MainModel):
+    id: uuid.UUID
+    title: str
+    task_text: str
+    created: datetime
+    updated: Optional[datetime]
+    deadline: date
+    expired: bool
+    version: int
+    archived: Optional[datetime] = None
+
+
+class TaskTombstoneShow(MainModel):
+    id: uuid.UUID
+    version: int
+    deleted: datetime
+
+
+class TaskChanges(BaseModel):
+    changed: list[TaskShow]
+    deleted: list[TaskTombstoneShow]
+    cursor: int
+    has_more: bool
+
+
+class TaskPage(BaseModel):
+    items: list[TaskShow]
+    cursor: Optional[str]
+
+
+class TaskStatsShow(BaseModel):
+    total: int
+    expired: int
+    due_today: int
+    overdue: int
+
+
+class TaskImportResult(BaseModel):
+    created: int
+    updated: int
+
+
+class TaskRecurrenceSet(BaseModel):
+    frequency: RecurrenceFrequencies
+    interval: conint(ge=1, le=366) = 1
+    until: Optional[date] = None
+
+
+class TaskRecurrenceShow(MainModel):
+    task_id: uuid.UUID
+    frequency: RecurrenceFrequencies
+    interval: int
+    until: Optional[date]
+
+
+class TaskOccurrenceUpdate(BaseModel):
+    title: Optional[constr(min_length=1, max_length=150)] = None
+    task_text: Optional[str] = None
+    expired: Optional[bool] = None
+    cancelled: Optional[bool] = None
+
+
+class TaskOccurrenceShow(MainModel):
+    task_id: uuid.UUID
+    occurrence: date
+    title: str
+    task_text: str
+    expired: bool
+    edited: bool
+    version: int
+
+
+class TaskAttachmentShow(MainModel):
+    id: uuid.UUID
+    task_id: uuid.UUID
+    filename: str
+    content_type: str
+    size: int
+    sha256: str
+    created: datetime
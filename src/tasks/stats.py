@@ -0,0 +1,181 @@
+"""
+Incrementally maintained task counters of users.
+
+`user_task_stats` keeps total and expired counts, `user_task_deadlines`
+keeps the number of not expired tasks per deadline day, not counting
+masters of recurring tasks. A deadline row is deleted by the statement
+which takes its count to zero, and overdue tasks are expired by the
+hourly sweep, so the deadlines table holds only days with pending tasks
+and every counter is read with a couple of index lookups, never with a
+scan over `tasks`.
+"""
+import datetime
+from collections import Counter
+from typing import NamedTuple, Optional, Iterable
+
+from sqlalchemy import select, func, text
+from sqlalchemy.dialects.postgresql import UUID, insert
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .archive import LOCK_CREATORS_QUERY
+from .models import UserTaskStats, UserTaskDeadlines
+
+RECONCILE_BATCH_SIZE = 1000
+
+# Recounts the counters of the given users from `tasks`. Callers must
+# hold the creators' advisory locks, so no write slips in between.
+REBUILD_QUERIES = (
+    text("""
+        DELETE FROM user_task_deadlines WHERE user_id = ANY(CAST(:users AS uuid[]))
+    """),
+    text("""
+        INSERT INTO user_task_deadlines (user_id, deadline, pending)
+        SELECT creator_id, deadline, count(*) FROM tasks
+        WHERE creator_id = ANY(CAST(:users AS uuid[])) AND NOT expired AND NOT is_recurring
+        GROUP BY creator_id, deadline
+    """),
+    text("""
+        INSERT INTO user_task_stats (user_id, total, expired)
+        SELECT u.user_id, count(t.id), count(t.id) FILTER (WHERE t.expired)
+        FROM unnest(CAST(:users AS uuid[])) AS u(user_id)
+        LEFT JOIN tasks t ON t.creator_id = u.user_id
+        GROUP BY u.user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            total = EXCLUDED.total,
+            expired = EXCLUDED.expired
+    """),
+)
+
+# Adds the deltas to the user's deadline counts. Rows the deltas take
+# to zero are deleted instead; both parts see the same snapshot, so
+# they never touch the same row.
+APPLY_PENDING_QUERY = text("""
+    WITH changes AS (
+        SELECT * FROM unnest(CAST(:deadlines AS date[]), CAST(:deltas AS integer[])) AS c(deadline, delta)
+    ), emptied AS (
+        DELETE FROM user_task_deadlines d
+        USING changes c
+        WHERE d.user_id = CAST(:user_id AS uuid) AND d.deadline = c.deadline AND d.pending + c.delta <= 0
+        RETURNING d.deadline
+    )
+    INSERT INTO user_task_deadlines (user_id, deadline, pending)
+    SELECT CAST(:user_id AS uuid), c.deadline, c.delta FROM changes c
+    WHERE c.deadline NOT IN (SELECT deadline FROM emptied)
+    ON CONFLICT (user_id, deadline) DO UPDATE SET
+        pending = user_task_deadlines.pending + EXCLUDED.pending
+""")
+
+USERS_BATCH_QUERY = text("""
+    SELECT id FROM users
+    WHERE CAST(:last_id AS uuid) IS NULL OR id > CAST(:last_id AS uuid)
+    ORDER BY id
+    LIMIT :limit
+""")
+
+
+class TaskStatsData(NamedTuple):
+    total: int = 0
+    expired: int = 0
+    due_today: int = 0
+    overdue: int = 0
+
+
+class TaskStatsManager:
+    """
+    Keeps counters of one user in step with task writes.
+    Must be used in the transaction of the write, while the
+    creator's advisory lock is held.
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def apply(self,
+                    user_id: UUID,
+                    total: int = 0,
+                    expired: int = 0,
+                    pending: Optional[Counter] = None):
+        if total or expired:
+            query = insert(UserTaskStats).values(user_id=user_id, total=total, expired=expired)
+            query = query.on_conflict_do_update(
+                index_elements=[UserTaskStats.user_id],
+                set_={'total': UserTaskStats.total + query.excluded.total,
+                      'expired': UserTaskStats.expired + query.excluded.expired}
+            )
+            await self.session.execute(query)
+        changes = [(deadline, count) for deadline, count in (pending or {}).items() if count]
+        if changes:
+            await self.session.execute(APPLY_PENDING_QUERY, {
+                'user_id': str(user_id),
+                'deadlines': [deadline for deadline, _ in changes],
+                'deltas': [count for _, count in changes]
+            })
+
+    async def task_changed(self,
+                           user_id: UUID,
+                           before: Optional[tuple] = None,
+                           after: Optional[tuple] = None):
+        """
+        Applies change of one task. `before` and `after` are
+        `(deadline, expired)` of the task, None when it did not
+        exist before or does not exist after the change. Deadline
+        is None for masters of recurring tasks, which are not
+        pending on any particular day.
+        """
+        total, expired, pending = 0, 0, Counter()
+        for state, sign in ((before, -1), (after, 1)):
+            if state is None:
+                continue
+            deadline, is_expired = state
+            total += sign
+            if is_expired:
+                expired += sign
+            elif deadline is not None:
+                pending[deadline] += sign
+        await self.apply(user_id, total=total, expired=expired, pending=pending)
+
+    async def get_stats(self, user_id: UUID, today: Optional[datetime.date] = None) -> TaskStatsData:
+        # by default the database date, the one the expiry sweep uses
+        today = today or func.current_date()
+        due_today = select(func.coalesce(func.sum(UserTaskDeadlines.pending), 0)).where(
+            UserTaskDeadlines.user_id == user_id,
+            UserTaskDeadlines.deadline == today
+        ).scalar_subquery()
+        overdue = select(func.coalesce(func.sum(UserTaskDeadlines.pending), 0)).where(
+            UserTaskDeadlines.user_id == user_id,
+            UserTaskDeadlines.deadline < today
+        ).scalar_subquery()
+        total = select(UserTaskStats.total).where(UserTaskStats.user_id == user_id).scalar_subquery()
+        expired = select(UserTaskStats.expired).where(UserTaskStats.user_id == user_id).scalar_subquery()
+        query = select(func.coalesce(total, 0), func.coalesce(expired, 0), due_today, overdue)
+        result = await self.session.execute(query)
+        return TaskStatsData(*result.fetchone())
+
+    async def rebuild(self, user_ids: Iterable[UUID]):
+        users = [str(user_id) for user_id in user_ids]
+        for query in REBUILD_QUERIES:
+            await self.session.execute(query, {'users': users})
+
+
+def reconcile_task_stats(connection: Connection, batch_size: int = RECONCILE_BATCH_SIZE) -> int:
+    """
+    Recounts the counters of all users from `tasks`, one
+    transaction per batch of users, in case they drifted.
+
+    Returns:
+        Number of processed users.
+    """
+    last_id = None
+    processed = 0
+    while True:
+        with connection.begin():
+            users = [str(row[0]) for row in
+                     connection.execute(USERS_BATCH_QUERY, {'last_id': last_id, 'limit': batch_size})]
+            if not users:
+                return processed
+            connection.execute(LOCK_CREATORS_QUERY, {'creators': users})
+            for query in REBUILD_QUERIES:
+                connection.execute(query, {'users': users})
+        last_id = users[-1]
+        processed += len(users)
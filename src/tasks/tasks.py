@@ -0,0 +1,56 @@
+import datetime
+from typing import Optional
+
+from src.celery import app
+from src.database.core import get_sync_engine
+from src.idempotency import purge_expired_keys
+from .archive import expire_overdue_tasks, archive_expired_tasks
+from .attachments import collect_attachments
+from .stats import reconcile_task_stats
+from .reminders import purge_digest_markers, send_deadline_digests, DIGEST_SHARDS
+
+
+@app.task
+def expire_overdue_tasks_job() -> int:
+    with get_sync_engine().connect() as connection:
+        return expire_overdue_tasks(connection)
+
+
+@app.task
+def archive_expired_tasks_job() -> int:
+    with get_sync_engine().connect() as connection:
+        return archive_expired_tasks(connection)
+
+
+@app.task
+def reconcile_task_stats_job() -> int:
+    with get_sync_engine().connect() as connection:
+        return reconcile_task_stats(connection)
+
+
+@app.task
+def purge_idempotency_keys_job() -> int:
+    with get_sync_engine().connect() as connection:
+        return purge_expired_keys(connection)
+
+
+@app.task
+def collect_attachments_job() -> int:
+    with get_sync_engine().connect() as connection:
+        return collect_attachments(connection)
+
+
+@app.task
+def dispatch_deadline_digests_job(digest_date: Optional[str] = None):
+    """Fans the digest day out into one job per shard of users"""
+    digest_date = digest_date or datetime.date.today().isoformat()
+    with get_sync_engine().connect() as connection:
+        purge_digest_markers(connection, datetime.date.fromisoformat(digest_date))
+    for shard in range(DIGEST_SHARDS):
+        send_deadline_digests_job.delay(shard, digest_date)
+
+
+@app.task
+def send_deadline_digests_job(shard: int, digest_date: str) -> int:
+    with get_sync_engine().connect() as connection:
+        return send_deadline_digests(connection, shard, datetime.date.fromisoformat(digest_date))
@@ -0,0 +1,199 @@
+"""
+Bulk export and import of a user's tasks with COPY.
+
+Data is streamed between the HTTP connection and the database
+connection through a small bounded buffer, so memory use does not
+depend on the size of the task list, and rows never pass through
+the ORM.
+
+Two formats are supported, both with the columns of `EXPORT_COLUMNS`:
+    - csv, with a header line;
+    - ndjson, one JSON object per line. It goes through COPY in csv
+      mode with control characters as quote and delimiter, which never
+      appear raw in JSON, so lines are passed through untouched.
+"""
+import asyncio
+from typing import AsyncIterable, AsyncIterator, NamedTuple
+
+from sqlalchemy import select, func, text
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.core import get_driver_connection
+from .notifications import notify_resync
+from .stats import TaskStatsManager
+
+COPY_BUFFER_CHUNKS = 16
+
+
+class TransferFormats:
+    CSV = 'csv'
+    NDJSON = 'ndjson'
+
+
+MEDIA_TYPES = {
+    TransferFormats.CSV: 'text/csv',
+    TransferFormats.NDJSON: 'application/x-ndjson'
+}
+
+EXPORT_COLUMNS = 'id, title, task_text, created, updated, deadline, expired, version'
+
+EXPORT_QUERIES = {
+    TransferFormats.CSV: f'SELECT {EXPORT_COLUMNS} FROM tasks WHERE creator_id = $1',
+    TransferFormats.NDJSON: f'''
+        SELECT row_to_json(t) FROM (
+            SELECT {EXPORT_COLUMNS} FROM tasks WHERE creator_id = $1
+        ) t
+    '''
+}
+
+COPY_OPTIONS = {
+    TransferFormats.CSV: {'format': 'csv', 'header': True},
+    TransferFormats.NDJSON: {'format': 'csv', 'quote': '\x01', 'delimiter': '\x02'}
+}
+
+# `position` numbers the rows in the order COPY reads them.
+STAGING_QUERIES = {
+    TransferFormats.CSV: text("""
+        CREATE TEMP TABLE tasks_import (
+            position bigint GENERATED ALWAYS AS IDENTITY,
+            id uuid, title text, task_text text, created timestamptz,
+            updated timestamptz, deadline date, expired boolean, version bigint
+        ) ON COMMIT DROP
+    """),
+    TransferFormats.NDJSON: text("""
+        CREATE TEMP TABLE tasks_import (
+            position bigint GENERATED ALWAYS AS IDENTITY,
+            doc json
+        ) ON COMMIT DROP
+    """)
+}
+
+STAGING_COLUMNS = {
+    TransferFormats.CSV: [column.strip() for column in EXPORT_COLUMNS.split(',')],
+    TransferFormats.NDJSON: ['doc']
+}
+
+# Staged rows, in the shape of the csv staging table.
+SOURCE_ROWS = {
+    TransferFormats.CSV: 'SELECT position, id, title, task_text, deadline, expired FROM tasks_import',
+    TransferFormats.NDJSON: """
+        SELECT position,
+               CAST(doc->>'id' AS uuid) AS id,
+               doc->>'title' AS title,
+               doc->>'task_text' AS task_text,
+               CAST(doc->>'deadline' AS date) AS deadline,
+               CAST(doc->>'expired' AS boolean) AS expired
+        FROM tasks_import
+    """
+}
+
+# When the file repeats an id, its last row wins. Rows with ids of the
+# user's tasks or tombstones replace or revive those tasks, other rows
+# are created with new ids. Ids of archived tasks are skipped, such
+# tasks are brought back with restore.
+MERGE_QUERY = """
+    WITH staged AS (
+        {source_rows}
+    ), latest AS (
+        SELECT id, title, task_text, deadline, expired
+        FROM (
+            SELECT *, row_number() OVER (PARTITION BY id ORDER BY position DESC) AS recency
+            FROM staged
+        ) ranked
+        WHERE id IS NULL OR recency = 1
+    ), source AS (
+        SELECT id, title, task_text, deadline, coalesce(expired, false) AS expired
+        FROM (
+            SELECT CASE
+                WHEN s.id IN (SELECT id FROM tasks WHERE creator_id = CAST(:creator_id AS uuid))
+                  OR s.id IN (SELECT id FROM tasks_tombstones WHERE creator_id = CAST(:creator_id AS uuid))
+                THEN s.id ELSE gen_random_uuid()
+            END AS id, title, task_text, deadline, expired
+            FROM latest s
+        ) rows
+        WHERE id NOT IN (SELECT id FROM tasks_archive WHERE creator_id = CAST(:creator_id AS uuid))
+    ), merged AS (
+        INSERT INTO tasks (id, creator_id, title, task_text, deadline, expired)
+        SELECT id, CAST(:creator_id AS uuid), title, task_text, deadline, expired FROM source
+        ON CONFLICT (creator_id, id) DO UPDATE SET
+            title = EXCLUDED.title,
+            task_text = EXCLUDED.task_text,
+            deadline = EXCLUDED.deadline,
+            expired = EXCLUDED.expired,
+            updated = now(),
+            version = nextval('tasks_version_seq')
+        RETURNING id, xmax = 0 AS inserted
+    ), revived AS (
+        DELETE FROM tasks_tombstones t
+        USING merged m
+        WHERE t.id = m.id AND t.creator_id = CAST(:creator_id AS uuid)
+    )
+    SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted)
+    FROM merged
+"""
+
+MERGE_QUERIES = {
+    format: text(MERGE_QUERY.format(source_rows=source_rows))
+    for format, source_rows in SOURCE_ROWS.items()
+}
+
+
+class TaskImportData(NamedTuple):
+    created: int
+    updated: int
+
+
+async def export_tasks(session: AsyncSession, creator_id: UUID, format: str) -> AsyncIterator[bytes]:
+    """
+    Yields COPY output of the user's tasks as it is received.
+    The buffer holds at most `COPY_BUFFER_CHUNKS` chunks; while it
+    is full the database connection is not read, so a slow client
+    slows down the COPY instead of filling the memory.
+    """
+    connection = await get_driver_connection(session)
+    buffer: asyncio.Queue = asyncio.Queue(maxsize=COPY_BUFFER_CHUNKS)
+    done = object()
+
+    async def produce():
+        try:
+            await connection.copy_from_query(EXPORT_QUERIES[format], creator_id,
+                                             output=buffer.put, **COPY_OPTIONS[format])
+        finally:
+            await buffer.put(done)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            chunk = await buffer.get()
+            if chunk is done:
+                break
+            yield chunk
+        # raises the COPY error, if any
+        await producer
+    finally:
+        producer.cancel()
+
+
+async def import_tasks(session: AsyncSession,
+                       creator_id: UUID,
+                       format: str,
+                       source: AsyncIterable[bytes]) -> TaskImportData:
+    """
+    Streams `source` into a temporary staging table with COPY and
+    merges it into the user's tasks. Must be called inside a real
+    transaction, the staging table is dropped on commit.
+
+    Listeners get a single `resync` event instead of an event per
+    task, and the user task stats are recounted.
+    """
+    await session.execute(select(func.pg_advisory_xact_lock(func.hashtext(str(creator_id)))))
+    await session.execute(STAGING_QUERIES[format])
+    connection = await get_driver_connection(session)
+    await connection.copy_to_table('tasks_import', source=source, columns=STAGING_COLUMNS[format],
+                                   **COPY_OPTIONS[format])
+    result = await session.execute(MERGE_QUERIES[format], {'creator_id': str(creator_id)})
+    imported = TaskImportData(*result.fetchone())
+    await TaskStatsManager(session).rebuild([creator_id])
+    await notify_resync(session, creator_id)
+    return imported
@@ -1,4 +1,246 @@
+from typing import NamedTuple, Optional, Union
+
+from sqlalchemy import select, delete, insert, func, literal
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.singleflight import flight_session
+from .models import Tasks, TaskTombstones, TasksArchive
+from .notifications import notify_task_change, TaskOperations
+from .stats import TaskStatsManager
+from .recurrence import RecurrenceManager
+from .query import TaskQuerySpec, TaskPageData, compile_task_query, paginate
+from .repository import user_tasks_flights
+from .schemas import TaskCreate, TaskUpdate
+
+CHANGES_PAGE_SIZE = 100
+CHANGES_MAX_PAGE_SIZE = 500
+
+
+class TaskChangesData(NamedTuple):
+    changed: list
+    deleted: list
+    cursor: int
+    has_more: bool
+
+
 class TasksManager:
+    """
+    Manager for the tasks of one user.
+
+    Every write takes a transaction-scoped advisory lock on the creator,
+    so versions drawn from `tasks_version_seq` for one user are committed
+    in the order they were drawn. Because of it a client which has seen
+    version N will never later miss a change with version < N, and delta
+    sync by version cursor is safe. Write methods must be called inside
+    a real transaction (see `get_transactional_database`); they also
+    notify listeners of the change, which Postgres delivers on commit,
+    and keep the user task stats up to date.
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+        self.stats = TaskStatsManager(session)
+        self.recurrences = RecurrenceManager(session)
+
+    async def _lock_creator(self, creator_id: UUID):
+        query = select(func.pg_advisory_xact_lock(func.hashtext(str(creator_id))))
+        await self.session.execute(query)
+
+    async def create_task(self, creator_id: UUID, data: TaskCreate) -> Tasks:
+        await self._lock_creator(creator_id)
+        new_task = Tasks(creator_id=creator_id,
+                         title=data.title,
+                         task_text=data.task_text,
+                         deadline=data.deadline,
+                         expired=False)
+        self.session.add(new_task)
+        await self.session.flush()
+        await self.stats.task_changed(creator_id, after=(new_task.deadline, new_task.expired))
+        await notify_task_change(self.session, creator_id, new_task.id,
+                                 new_task.version, TaskOperations.CREATED)
+        return new_task
+
+    async def get_task(self, creator_id: UUID, task_id: UUID) -> Union[Tasks, None]:
+        query = select(Tasks).where(Tasks.creator_id == creator_id,
+                                    Tasks.id == task_id)
+        result = await self.session.execute(query)
+        task_row = result.fetchone()
+        if task_row is not None:
+            return task_row[0]
+
+    async def get_version_stamp(self, creator_id: UUID) -> int:
+        """
+        Returns the highest version among the user's tasks and
+        tombstones. It changes with every write, so it is used as
+        ETag of task lists; both maximums are read from the
+        (creator_id, version) indexes without touching the rows.
+        """
+        tasks_max = select(func.max(Tasks.version)).where(
+            Tasks.creator_id == creator_id
+        ).scalar_subquery()
+        tombstones_max = select(func.max(TaskTombstones.version)).where(
+            TaskTombstones.creator_id == creator_id
+        ).scalar_subquery()
+        query = select(func.coalesce(func.greatest(tasks_max, tombstones_max), 0))
+        result = await self.session.execute(query)
+        return result.scalar()
+
+    async def get_user_tasks(self, creator_id: UUID) -> list[Tasks]:
+        query = select(Tasks).where(Tasks.creator_id == creator_id).order_by(Tasks.deadline, Tasks.id)
+        result = await self.session.execute(query)
+        return list(result.scalars())
+
+    async def get_user_tasks_shared(self, creator_id: UUID) -> list[Tasks]:
+        """
+        Same as `get_user_tasks`, but concurrent calls of the worker
+        share one query, see `src.singleflight`. Tasks are detached and
+        must not be changed. Call it outside of a transaction of the
+        session, the query runs in a session of its own.
+        """
+        async def fetch(seal):
+            async with flight_session(self.session, seal) as shared_session:
+                return await TasksManager(shared_session).get_user_tasks(creator_id)
+
+        return await user_tasks_flights.do((TasksManager, self.session.bind, creator_id), fetch)
+
+    async def search_tasks(self, creator_id: UUID, spec: TaskQuerySpec) -> TaskPageData:
+        """
+        Returns a page of the user's tasks selected by the spec,
+        see `src.tasks.query` for how it is compiled.
+
+        Raises:
+            TaskQueryError: cursor of the spec is invalid.
+        """
+        result = await self.session.execute(compile_task_query(spec, creator_id))
+        return paginate(spec, result.fetchall())
+
+    async def get_archived_tasks(self, creator_id: UUID) -> list[TasksArchive]:
+        query = select(TasksArchive).where(
+            TasksArchive.creator_id == creator_id
+        ).order_by(TasksArchive.deadline, TasksArchive.id)
+        result = await self.session.execute(query)
+        return list(result.scalars())
+
+    async def restore_task(self, creator_id: UUID, task_id: UUID) -> Union[Tasks, None]:
+        """
+        Moves the task back from the archive. The restored task gets
+        a new version and its tombstone is removed. Returns restored
+        task or None if there is no such archived task.
+        """
+        await self._lock_creator(creator_id)
+        # the rule of a recurring task outlives the archive
+        recurring = await self.recurrences.is_recurring(creator_id, task_id)
+        columns = ['id', 'creator_id', 'title', 'task_text', 'created', 'deadline', 'expired']
+        archived = delete(TasksArchive).where(
+            TasksArchive.creator_id == creator_id,
+            TasksArchive.id == task_id
+        ).returning(*[getattr(TasksArchive, column) for column in columns]).cte('archived')
+        query = insert(Tasks).from_select(
+            columns + ['updated', 'is_recurring'],
+            select(*[archived.c[column] for column in columns], func.now(), literal(recurring))
+        ).returning(Tasks)
+        task = (await self.session.scalars(query)).first()
+        if task is None:
+            return None
+        await self.session.execute(delete(TaskTombstones).where(
+            TaskTombstones.creator_id == creator_id,
+            TaskTombstones.id == task_id
+        ))
+        deadline = None if recurring else task.deadline
+        await self.stats.task_changed(creator_id, after=(deadline, task.expired))
+        await notify_task_change(self.session, creator_id, task.id,
+                                 task.version, TaskOperations.CREATED)
+        return task
+
+    async def update_task(self,
+                          creator_id: UUID,
+                          task_id: UUID,
+                          data: TaskUpdate) -> Union[Tasks, None]:
+        await self._lock_creator(creator_id)
+        task = await self.get_task(creator_id, task_id)
+        if task is None:
+            return None
+        before = (task.deadline, task.expired)
+        for field, value in data.dict(exclude_unset=True).items():
+            setattr(task, field, value)
+        await self.session.flush()
+        after = (task.deadline, task.expired)
+        if before != after:
+            if task.is_recurring:
+                # masters of recurring tasks are not pending on their deadline
+                before, after = (None, before[1]), (None, after[1])
+            await self.stats.task_changed(creator_id, before=before, after=after)
+        await notify_task_change(self.session, creator_id, task.id,
+                                 task.version, TaskOperations.UPDATED)
+        return task
+
+    async def delete_task(self, creator_id: UUID, task_id: UUID) -> Union[UUID, None]:
+        """
+        Deletes the task and leaves a tombstone in the same
+        statement, then the recurrence rule and exceptions of
+        the task. Returns id of deleted task or None.
+        """
+        await self._lock_creator(creator_id)
+        deleted = delete(Tasks).where(
+            Tasks.creator_id == creator_id,
+            Tasks.id == task_id
+        ).returning(Tasks.id, Tasks.creator_id, Tasks.deadline, Tasks.expired, Tasks.is_recurring).cte('deleted')
+        tombstone = insert(TaskTombstones).from_select(
+            ['id', 'creator_id'],
+            select(deleted.c.id, deleted.c.creator_id)
+        ).returning(TaskTombstones.id, TaskTombstones.version).cte('tombstone')
+        query = select(tombstone.c.id, tombstone.c.version, deleted.c.deadline, deleted.c.expired,
+                       deleted.c.is_recurring).join_from(
+            tombstone, deleted, tombstone.c.id == deleted.c.id
+        )
+        result = await self.session.execute(query)
+        deleted_row = result.fetchone()
+        if deleted_row is not None:
+            deadline = None if deleted_row.is_recurring else deleted_row.deadline
+            if deleted_row.is_recurring:
+                await self.recurrences.drop_series(creator_id, task_id)
+            await self.stats.task_changed(creator_id, before=(deadline, deleted_row.expired))
+            await notify_task_change(self.session, creator_id, deleted_row.id,
+                                     deleted_row.version, TaskOperations.DELETED)
+            return deleted_row.id
+
+    async def get_changes(self,
+                          creator_id: UUID,
+                          since: int = 0,
+                          limit: Optional[int] = None) -> TaskChangesData:
+        """
+        Returns tasks changed and deleted after the `since` cursor,
+        ordered by version and bounded by `limit` rows in total.
+
+        Args:
+            creator_id (UUID): id of tasks owner.
+            since (int): the last version the client has seen.
+            limit (int): maximum number of changed and deleted rows.
+        Returns:
+            TaskChangesData with rows, next cursor and `has_more` flag.
+        """
+        limit = limit or CHANGES_PAGE_SIZE
+        tasks_query = select(Tasks).where(
+            Tasks.creator_id == creator_id,
+            Tasks.version > since
+        ).order_by(Tasks.version).limit(limit)
+        tombstones_query = select(TaskTombstones).where(
+            TaskTombstones.creator_id == creator_id,
+            TaskTombstones.version > since
+        ).order_by(TaskTombstones.version).limit(limit)
+        tasks = list((await self.session.execute(tasks_query)).scalars())
+        tombstones = list((await self.session.execute(tombstones_query)).scalars())
 
-    def __init__(self):
-        pass
+        merged = sorted(tasks + tombstones, key=lambda row: row.version)
+        page = merged[:limit]
+        has_more = (len(merged) > limit
+                    or len(tasks) == limit
+                    or len(tombstones) == limit)
+        cursor = page[-1].version if page else since
+        return TaskChangesData(
+            changed=[row for row in page if isinstance(row, Tasks)],
+            deleted=[row for row in page if isinstance(row, TaskTombstones)],
+            cursor=cursor,
+            has_more=has_more
+        )
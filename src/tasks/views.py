@@ -0,0 +1,466 @@
+import asyncio
+import datetime
+import heapq
+import json
+import uuid
+
+import asyncpg
+
+from typing import Optional
+
+from fastapi import Depends, Header, HTTPException, Query, Request, Response, status, APIRouter
+from fastapi.responses import StreamingResponse
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import DATABASE_RAW_READS, ATTACHMENT_MAX_SIZE
+from src.auth.utils import get_current_active_user, get_current_active_reader
+from src.database.core import get_read_database, get_transactional_database
+from src.etag import make_etag, etag_matches, not_modified
+from src.idempotency import IdempotentRoute, idempotent
+from .schemas import (TaskCreate, TaskUpdate, TaskShow, TaskChanges, TaskStatsShow,
+                      TaskImportResult, TaskPage, TaskRecurrenceSet, TaskRecurrenceShow,
+                      TaskOccurrenceUpdate, TaskOccurrenceShow, TaskAttachmentShow)
+from .repository import TaskReadRepository
+from .utils import TasksManager, CHANGES_PAGE_SIZE, CHANGES_MAX_PAGE_SIZE
+from .notifications import task_changes_listener
+from .stats import TaskStatsManager
+from .query import (TaskQuerySpec, TaskQueryError, SORT_REGEX,
+                    SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE)
+from .recurrence import RecurrenceManager, MAX_WINDOW_DAYS
+from .transfer import export_tasks, import_tasks, MEDIA_TYPES
+from .attachments import AttachmentsManager, AttachmentTooLarge, attachment_store, attachment_response
+
+STREAM_HEARTBEAT_INTERVAL = 15
+TRANSFER_FORMAT_REGEX = '^(csv|ndjson)$'
+
+router = APIRouter(
+    prefix='/tasks',
+    tags=['Tasks'],
+    route_class=IdempotentRoute
+)
+
+
+@router.get('/changes/', response_model=TaskChanges)
+async def get_task_changes(since: int = Query(0, ge=0),
+                           limit: int = Query(CHANGES_PAGE_SIZE, ge=1, le=CHANGES_MAX_PAGE_SIZE),
+                           session: AsyncSession = Depends(get_read_database),
+                           current_user=Depends(get_current_active_reader)) -> TaskChanges:
+    """
+    Delta sync. Returns tasks changed and deleted after the `since`
+    cursor. Pass the returned `cursor` as `since` in the next call
+    while `has_more` is true.
+    """
+    manager = TasksManager(session)
+    async with session.begin():
+        changes = await manager.get_changes(creator_id=current_user.id,
+                                            since=since,
+                                            limit=limit)
+        return TaskChanges(
+            changed=[TaskShow.from_orm(task) for task in changes.changed],
+            deleted=changes.deleted,
+            cursor=changes.cursor,
+            has_more=changes.has_more
+        )
+
+
+async def task_events(creator_id: uuid.UUID):
+    async with task_changes_listener.subscribe(creator_id) as subscription:
+        yield 'retry: 3000\n\n'
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(),
+                                               timeout=STREAM_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                # keeps proxies from closing an idle connection
+                yield ': keep-alive\n\n'
+                continue
+            yield f'event: {event.type}\ndata: {json.dumps(event.data)}\n\n'
+
+
+@router.get('/stream/')
+async def stream_task_changes(current_user=Depends(get_current_active_reader)):
+    """
+    Server-sent events with changes of the user's tasks. On a
+    `resync` event the client should catch up through `/tasks/changes/`.
+    """
+    return StreamingResponse(
+        task_events(current_user.id),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def _task_order(task) -> tuple:
+    """Order of the task lists, for `TaskShow` and raw read dicts"""
+    if isinstance(task, dict):
+        return task['deadline'], task['id']
+    return task.deadline, task.id
+
+
+@router.get('/', response_model=list[TaskShow])
+async def get_tasks(response: Response,
+                    include_archived: bool = False,
+                    if_none_match: Optional[str] = Header(None),
+                    session: AsyncSession = Depends(get_read_database),
+                    current_user=Depends(get_current_active_reader)) -> list[TaskShow]:
+    manager = TasksManager(session)
+    # archiving and restoring leave tombstones and versions,
+    # so the stamp covers the archive as well
+    etag_name = 'tasks+archive' if include_archived else 'tasks'
+    async with session.begin():
+        stamp = await manager.get_version_stamp(creator_id=current_user.id)
+        etag = make_etag(etag_name, current_user.id, stamp)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+    # shared with concurrent requests of the user, outside of the
+    # transaction so that waiting for them holds no connection
+    if DATABASE_RAW_READS:
+        tasks = list(await TaskReadRepository(session).get_user_tasks_shared(creator_id=current_user.id))
+        versions = [task['version'] for task in tasks]
+    else:
+        tasks = [TaskShow.from_orm(task)
+                 for task in await manager.get_user_tasks_shared(creator_id=current_user.id)]
+        versions = [task.version for task in tasks]
+    # The list is read after the stamp, so it may hold later writes;
+    # its own versions then make the ETag. Writes are committed in
+    # version order, so the list holds every write up to that version.
+    # A delete after the stamp leaves the ETag behind the list, which
+    # costs the next request a 200, never a wrong 304.
+    response.headers['ETag'] = make_etag(etag_name, current_user.id, max([stamp, *versions]))
+    if include_archived:
+        async with session.begin():
+            archived = [TaskShow.from_orm(task)
+                        for task in await manager.get_archived_tasks(creator_id=current_user.id)]
+        # both lists are ordered by (deadline, id), so is their merge
+        tasks = list(heapq.merge(tasks, archived, key=_task_order))
+    return tasks
+
+
+@router.post('/', response_model=TaskShow, status_code=status.HTTP_201_CREATED)
+@idempotent()
+async def create_task(data: TaskCreate,
+                      session: AsyncSession = Depends(get_transactional_database),
+                      current_user=Depends(get_current_active_user)) -> TaskShow:
+    manager = TasksManager(session)
+    async with session.begin():
+        task = await manager.create_task(creator_id=current_user.id, data=data)
+    return TaskShow.from_orm(task)
+
+
+@router.get('/stats/', response_model=TaskStatsShow)
+async def get_task_stats(session: AsyncSession = Depends(get_read_database),
+                         current_user=Depends(get_current_active_reader)) -> TaskStatsShow:
+    """
+    Counters of the user's tasks, read from precomputed stats.
+    """
+    manager = TaskStatsManager(session)
+    async with session.begin():
+        stats = await manager.get_stats(user_id=current_user.id)
+    return TaskStatsShow(**stats._asdict())
+
+
+def task_query_spec(expired: Optional[bool] = None,
+                    deadline_from: Optional[datetime.date] = None,
+                    deadline_to: Optional[datetime.date] = None,
+                    created_from: Optional[datetime.datetime] = None,
+                    created_to: Optional[datetime.datetime] = None,
+                    title_prefix: Optional[str] = Query(None, min_length=1, max_length=150),
+                    sort: str = Query('deadline', regex=SORT_REGEX),
+                    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+                    cursor: Optional[str] = None) -> TaskQuerySpec:
+    return TaskQuerySpec(expired=expired,
+                         deadline_from=deadline_from,
+                         deadline_to=deadline_to,
+                         created_from=created_from,
+                         created_to=created_to,
+                         title_prefix=title_prefix,
+                         sort=sort,
+                         limit=limit,
+                         cursor=cursor)
+
+
+@router.get('/search/', response_model=TaskPage)
+async def search_tasks(spec: TaskQuerySpec = Depends(task_query_spec),
+                       session: AsyncSession = Depends(get_read_database),
+                       current_user=Depends(get_current_active_reader)) -> TaskPage:
+    """
+    Filtered and sorted page of the user's tasks. `sort` is one of
+    `deadline`, `created`, `title`, prefixed with `-` for descending
+    order. Pass the returned `cursor` to get the next page, it is null
+    on the last one. A page may hold less than `limit` tasks and still
+    have a cursor when filters other than the one on the sort field
+    leave few matches.
+    """
+    manager = TasksManager(session)
+    async with session.begin():
+        try:
+            page = await manager.search_tasks(creator_id=current_user.id, spec=spec)
+        except TaskQueryError as error:
+            raise HTTPException(status_code=400, detail=str(error))
+        return TaskPage(items=[TaskShow.from_orm(task) for task in page.items],
+                        cursor=page.cursor)
+
+
+@router.get('/occurrences/', response_model=list[TaskOccurrenceShow])
+async def get_task_occurrences(start: datetime.date,
+                               end: datetime.date,
+                               session: AsyncSession = Depends(get_read_database),
+                               current_user=Depends(get_current_active_reader)) -> list[TaskOccurrenceShow]:
+    """
+    Occurrences of the user's recurring tasks from `start` to `end`,
+    both included. The window may span at most `MAX_WINDOW_DAYS` days.
+    """
+    if not start <= end < start + datetime.timedelta(days=MAX_WINDOW_DAYS):
+        raise HTTPException(status_code=400,
+                            detail=f'Window must end after its start and span at most {MAX_WINDOW_DAYS} days!')
+    manager = RecurrenceManager(session)
+    async with session.begin():
+        occurrences = await manager.get_occurrences(creator_id=current_user.id, start=start, end=end)
+    return [TaskOccurrenceShow.from_orm(occurrence) for occurrence in occurrences]
+
+
+@router.get('/export/')
+async def export_user_tasks(format: str = Query('ndjson', regex=TRANSFER_FORMAT_REGEX),
+                            session: AsyncSession = Depends(get_read_database),
+                            current_user=Depends(get_current_active_reader)):
+    """
+    Streams all tasks of the user as csv or ndjson.
+    """
+    return StreamingResponse(
+        export_tasks(session, creator_id=current_user.id, format=format),
+        media_type=MEDIA_TYPES[format],
+        headers={'Content-Disposition': f'attachment; filename="tasks.{format}"'}
+    )
+
+
+@router.post('/import/', response_model=TaskImportResult)
+@idempotent(hash_body=False)
+async def import_user_tasks(request: Request,
+                            format: str = Query('ndjson', regex=TRANSFER_FORMAT_REGEX),
+                            session: AsyncSession = Depends(get_transactional_database),
+                            current_user=Depends(get_current_active_user)) -> TaskImportResult:
+    """
+    Imports tasks from a csv or ndjson body in the format of the export.
+    Tasks with ids of the user's tasks are replaced, the rest are created.
+    """
+    try:
+        async with session.begin():
+            imported = await import_tasks(session,
+                                          creator_id=current_user.id,
+                                          format=format,
+                                          source=request.stream())
+    # only errors caused by the data are the client's, other
+    # database errors are ours; none of their messages is sent
+    except (asyncpg.DataError, DataError):
+        raise HTTPException(status_code=400, detail='Invalid import data: a value has a wrong type or format.')
+    except (asyncpg.IntegrityConstraintViolationError, IntegrityError):
+        raise HTTPException(status_code=400, detail='Invalid import data: a row breaks a constraint of tasks.')
+    return TaskImportResult(**imported._asdict())
+
+
+@router.get('/{task_id}/', response_model=TaskShow)
+async def get_task(task_id: uuid.UUID,
+                   response: Response,
+                   if_none_match: Optional[str] = Header(None),
+                   session: AsyncSession = Depends(get_read_database),
+                   current_user=Depends(get_current_active_reader)) -> TaskShow:
+    manager = TasksManager(session)
+    async with session.begin():
+        task = await manager.get_task(creator_id=current_user.id, task_id=task_id)
+        if task is None:
+            raise HTTPException(status_code=404, detail='Task not found!')
+        etag = make_etag('task', task.id, task.version)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+        response.headers['ETag'] = etag
+        return TaskShow.from_orm(task)
+
+
+@router.patch('/{task_id}/', response_model=TaskShow)
+async def update_task(task_id: uuid.UUID,
+                      data: TaskUpdate,
+                      session: AsyncSession = Depends(get_transactional_database),
+                      current_user=Depends(get_current_active_user)) -> TaskShow:
+    manager = TasksManager(session)
+    async with session.begin():
+        task = await manager.update_task(creator_id=current_user.id,
+                                         task_id=task_id,
+                                         data=data)
+        if task is None:
+            raise HTTPException(status_code=404, detail='Task not found!')
+    return TaskShow.from_orm(task)
+
+
+@router.post('/{task_id}/restore/', response_model=TaskShow)
+@idempotent()
+async def restore_task(task_id: uuid.UUID,
+                       session: AsyncSession = Depends(get_transactional_database),
+                       current_user=Depends(get_current_active_user)) -> TaskShow:
+    manager = TasksManager(session)
+    async with session.begin():
+        task = await manager.restore_task(creator_id=current_user.id, task_id=task_id)
+        if task is None:
+            raise HTTPException(status_code=404, detail='Archived task not found!')
+    return TaskShow.from_orm(task)
+
+
+@router.put('/{task_id}/recurrence/', response_model=TaskRecurrenceShow)
+async def set_task_recurrence(task_id: uuid.UUID,
+                              data: TaskRecurrenceSet,
+                              session: AsyncSession = Depends(get_transactional_database),
+                              current_user=Depends(get_current_active_user)) -> TaskRecurrenceShow:
+    """
+    Makes the task recurring, starting on its deadline,
+    or replaces its recurrence rule.
+    """
+    manager = RecurrenceManager(session)
+    async with session.begin():
+        rule = await manager.set_recurrence(creator_id=current_user.id, task_id=task_id, data=data)
+        if rule is None:
+            raise HTTPException(status_code=404, detail='Task not found!')
+    return TaskRecurrenceShow.from_orm(rule)
+
+
+@router.delete('/{task_id}/recurrence/')
+async def delete_task_recurrence(task_id: uuid.UUID,
+                                 session: AsyncSession = Depends(get_transactional_database),
+                                 current_user=Depends(get_current_active_user)):
+    manager = RecurrenceManager(session)
+    async with session.begin():
+        deleted = await manager.delete_recurrence(creator_id=current_user.id, task_id=task_id)
+    if not deleted:
+        raise HTTPException(status_code=404, detail='Recurring task not found!')
+    return {
+        'status_code': status.HTTP_200_OK,
+        'detail': 'Task is not recurring anymore.'
+    }
+
+
+@router.patch('/{task_id}/occurrences/{occurrence}/', response_model=TaskOccurrenceShow)
+async def update_task_occurrence(task_id: uuid.UUID,
+                                 occurrence: datetime.date,
+                                 data: TaskOccurrenceUpdate,
+                                 session: AsyncSession = Depends(get_transactional_database),
+                                 current_user=Depends(get_current_active_user)) -> TaskOccurrenceShow:
+    """
+    Edits, completes (`expired`) or cancels one occurrence of a recurring task.
+    """
+    manager = RecurrenceManager(session)
+    async with session.begin():
+        updated = await manager.update_occurrence(creator_id=current_user.id,
+                                                  task_id=task_id,
+                                                  occurrence=occurrence,
+                                                  data=data)
+        if updated is None:
+            raise HTTPException(status_code=404, detail='Occurrence not found!')
+    return TaskOccurrenceShow.from_orm(updated)
+
+
+@router.delete('/{task_id}/')
+@idempotent()
+async def delete_task(task_id: uuid.UUID,
+                      session: AsyncSession = Depends(get_transactional_database),
+                      current_user=Depends(get_current_active_user)):
+    manager = TasksManager(session)
+    async with session.begin():
+        deleted_id = await manager.delete_task(creator_id=current_user.id, task_id=task_id)
+    if deleted_id is None:
+        raise HTTPException(status_code=404, detail='Task not found!')
+    return {
+        'status_code': status.HTTP_200_OK,
+        'detail': 'Task has been deleted.'
+    }
+
+
+@router.post('/{task_id}/attachments/', response_model=TaskAttachmentShow, status_code=status.HTTP_201_CREATED)
+@idempotent(hash_body=False)
+async def upload_task_attachment(task_id: uuid.UUID,
+                                 request: Request,
+                                 filename: str = Query(..., min_length=1, max_length=255),
+                                 session: AsyncSession = Depends(get_transactional_database),
+                                 current_user=Depends(get_current_active_user)) -> TaskAttachmentShow:
+    """
+    Attaches the raw request body to the task as a file named `filename`,
+    with the request's `Content-Type`. The body is streamed to the
+    attachment store, at most `ATTACHMENT_MAX_SIZE` bytes.
+    """
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > ATTACHMENT_MAX_SIZE:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f'Attachments are limited to {ATTACHMENT_MAX_SIZE} bytes!')
+    filename = filename.replace('\\', '/').rsplit('/', 1)[-1]
+    if not filename:
+        raise HTTPException(status_code=400, detail='Invalid filename!')
+    manager = AttachmentsManager(session)
+    # no transaction is open while the body streams in
+    async with session.begin():
+        if not await manager.task_exists(creator_id=current_user.id, task_id=task_id):
+            raise HTTPException(status_code=404, detail='Task not found!')
+    try:
+        stored = await attachment_store.save(request.stream())
+    except AttachmentTooLarge as error:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(error))
+    async with session.begin():
+        attachment = await manager.create_attachment(creator_id=current_user.id,
+                                                     task_id=task_id,
+                                                     filename=filename,
+                                                     content_type=request.headers.get('content-type',
+                                                                                      'application/octet-stream'),
+                                                     stored=stored)
+        if attachment is None:
+            raise HTTPException(status_code=404, detail='Task not found!')
+    return TaskAttachmentShow.from_orm(attachment)
+
+
+@router.get('/{task_id}/attachments/', response_model=list[TaskAttachmentShow])
+async def get_task_attachments(task_id: uuid.UUID,
+                               session: AsyncSession = Depends(get_read_database),
+                               current_user=Depends(get_current_active_reader)) -> list[TaskAttachmentShow]:
+    manager = AttachmentsManager(session)
+    async with session.begin():
+        if not await manager.task_exists(creator_id=current_user.id, task_id=task_id):
+            raise HTTPException(status_code=404, detail='Task not found!')
+        attachments = await manager.get_attachments(creator_id=current_user.id, task_id=task_id)
+        return [TaskAttachmentShow.from_orm(attachment) for attachment in attachments]
+
+
+@router.get('/{task_id}/attachments/{attachment_id}/')
+async def download_task_attachment(task_id: uuid.UUID,
+                                   attachment_id: uuid.UUID,
+                                   range_header: Optional[str] = Header(None, alias='Range'),
+                                   if_range: Optional[str] = Header(None),
+                                   if_none_match: Optional[str] = Header(None),
+                                   session: AsyncSession = Depends(get_read_database),
+                                   current_user=Depends(get_current_active_reader)) -> Response:
+    """
+    Streams the attached file. Supports a single `Range` with `If-Range`,
+    and `If-None-Match` against the ETag, which is the file's sha256.
+    """
+    manager = AttachmentsManager(session)
+    async with session.begin():
+        attachment = await manager.get_attachment(creator_id=current_user.id,
+                                                  task_id=task_id,
+                                                  attachment_id=attachment_id)
+    if attachment is None:
+        raise HTTPException(status_code=404, detail='Attachment not found!')
+    return attachment_response(attachment, range_header=range_header, if_range=if_range, if_none_match=if_none_match)
+
+
+@router.delete('/{task_id}/attachments/{attachment_id}/')
+@idempotent()
+async def delete_task_attachment(task_id: uuid.UUID,
+                                 attachment_id: uuid.UUID,
+                                 session: AsyncSession = Depends(get_transactional_database),
+                                 current_user=Depends(get_current_active_user)):
+    manager = AttachmentsManager(session)
+    async with session.begin():
+        deleted = await manager.delete_attachment(creator_id=current_user.id,
+                                                  task_id=task_id,
+                                                  attachment_id=attachment_id)
+    if not deleted:
+        raise HTTPException(status_code=404, detail='Attachment not found!')
+    return {
+        'status_code': status.HTTP_200_OK,
+        'detail': 'Attachment has been deleted.'
+    }
@@ -0,0 +1,393 @@
+"""
+Lightweight request tracing.
+
+A trace is a tree of spans: timed, named operations. The current span
+is kept in a context variable, so spans opened while handling a request
+become its children, across awaits and across SQLAlchemy's greenlets.
+Spans come from:
+    - `TracingMiddleware`, one root span per HTTP request;
+    - SQLAlchemy engine events, one span per statement;
+    - `span` and `traced` around code worth measuring (bcrypt, SMTP);
+    - Celery signals: the publisher puts the trace context into the
+      task headers and the worker continues the trace in the task.
+Trace context crosses processes as a W3C `traceparent` header.
+
+Whether a trace is recorded is decided once, at its root, with
+probability `TRACING_SAMPLE_RATE`; spans of unsampled traces are
+dropped. Finished spans are batched to a background thread, which
+writes them to `TRACING_JSONL_PATH` (exporter `jsonl`) or posts them to
+an OTLP/HTTP collector at `TRACING_OTLP_ENDPOINT` (exporter `otlp`).
+Tracing is off unless `TRACING_EXPORTER` is set.
+
+A request's waterfall is printed from the JSONL file with:
+    python -m src.tracing traces.jsonl [trace_id]
+"""
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from src.config import (TRACING_EXPORTER,
+                        TRACING_SAMPLE_RATE,
+                        TRACING_JSONL_PATH,
+                        TRACING_OTLP_ENDPOINT,
+                        TRACING_SERVICE_NAME)
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT_HEADER = 'traceparent'
+EXPORT_BATCH_SIZE = 512
+EXPORT_INTERVAL = 1
+EXPORT_QUEUE_SIZE = 10000
+STATEMENT_MAX_LENGTH = 1000
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'sampled',
+                 'attributes', 'start', 'end', 'error')
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool, attributes: dict):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.sampled = sampled
+        self.attributes = attributes
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+
+    @property
+    def traceparent(self) -> str:
+        return f'00-{self.trace_id}-{self.span_id}-{"01" if self.sampled else "00"}'
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.end = time.time_ns()
+        if error is not None:
+            self.error = f'{type(error).__name__}: {error}'
+        if self.sampled:
+            exporter.export(self)
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start / 1e9,
+            'duration_ms': (self.end - self.start) / 1e6,
+            'attributes': self.attributes,
+            'error': self.error
+        }
+
+
+def parse_traceparent(traceparent: Optional[str]) -> Optional[tuple]:
+    """Returns trace id, parent span id and sampled flag of the header"""
+    if not traceparent:
+        return None
+    parts = traceparent.strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+def start_span(name: str, traceparent: Optional[str] = None, **attributes) -> Optional[Span]:
+    """
+    Returns new span, child of the current span or of the remote
+    `traceparent`, or a new root. Returns None if tracing is off.
+    """
+    if not TRACING_EXPORTER:
+        return None
+    parent = _current_span.get()
+    remote = parse_traceparent(traceparent) if parent is None else None
+    if parent is not None:
+        return Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+    if remote is not None:
+        return Span(name, remote[0], remote[1], remote[2], attributes)
+    return Span(name, os.urandom(16).hex(), None, random.random() < TRACING_SAMPLE_RATE, attributes)
+
+
+def current_traceparent() -> Optional[str]:
+    current = _current_span.get()
+    return current.traceparent if current is not None else None
+
+
+@contextmanager
+def span(name: str, traceparent: Optional[str] = None, **attributes):
+    """Runs the block in a new span, the current one within it"""
+    new_span = start_span(name, traceparent, **attributes)
+    if new_span is None:
+        yield None
+        return
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as error:
+        new_span.finish(error)
+        raise
+    else:
+        new_span.finish()
+    finally:
+        _current_span.reset(token)
+
+
+def traced(name: str) -> Callable:
+    """Decorator running every call of the function, sync or async, in a span"""
+    def decorator(function: Callable) -> Callable:
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+class SpanExporter:
+    """
+    Batches finished spans to a daemon thread, so exporting never
+    blocks the event loop. Spans are dropped when the queue is full.
+    The thread is started in every process on first use, forked
+    workers included.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def export(self, finished: Span):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(finished)
+        except queue.Full:
+            pass
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='span-exporter', daemon=True).start()
+
+    def _run(self):
+        spans_queue = self._queue
+        while True:
+            batch = [spans_queue.get()]
+            deadline = time.monotonic() + EXPORT_INTERVAL
+            while len(batch) < EXPORT_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(spans_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                if TRACING_EXPORTER == 'otlp':
+                    self._post_otlp(batch)
+                else:
+                    self._write_jsonl(batch)
+            except OSError as error:
+                logger.warning('Could not export %s spans: %s', len(batch), error)
+
+    @staticmethod
+    def _write_jsonl(batch: list):
+        lines = ''.join(json.dumps(finished.to_dict(), default=str) + '\n' for finished in batch)
+        with open(TRACING_JSONL_PATH, 'a') as file:
+            file.write(lines)
+
+    @staticmethod
+    def _otlp_span(finished: Span) -> dict:
+        otlp_span = {
+            'traceId': finished.trace_id,
+            'spanId': finished.span_id,
+            'name': finished.name,
+            'kind': 1,
+            'startTimeUnixNano': str(finished.start),
+            'endTimeUnixNano': str(finished.end),
+            'attributes': [{'key': key, 'value': {'stringValue': str(value)}}
+                           for key, value in finished.attributes.items()],
+            'status': {'code': 2, 'message': finished.error} if finished.error else {'code': 1}
+        }
+        if finished.parent_id:
+            otlp_span['parentSpanId'] = finished.parent_id
+        return otlp_span
+
+    def _post_otlp(self, batch: list):
+        payload = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': TRACING_SERVICE_NAME}}]},
+            'scopeSpans': [{'scope': {'name': __name__},
+                            'spans': [self._otlp_span(finished) for finished in batch]}]
+        }]}
+        request = urllib.request.Request(TRACING_OTLP_ENDPOINT,
+                                         data=json.dumps(payload).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=5):
+            pass
+
+
+exporter = SpanExporter()
+
+
+class TracingMiddleware:
+    """ASGI middleware opening the root span of every HTTP request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not TRACING_EXPORTER:
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get('headers') or [])
+        traceparent = headers.get(TRACEPARENT_HEADER.encode(), b'').decode('latin-1') or None
+        with span(f'{scope["method"]} {scope["path"]}',
+                  traceparent,
+                  **{'http.method': scope['method'], 'http.target': scope['path']}) as request_span:
+
+            async def send_with_trace(message):
+                if message['type'] == 'http.response.start':
+                    request_span.attributes['http.status_code'] = message['status']
+                    route = scope.get('route')
+                    if route is not None:
+                        request_span.attributes['http.route'] = route.path
+                    message.setdefault('headers', [])
+                    message['headers'] = [*message['headers'],
+                                          (b'x-trace-id', request_span.trace_id.encode())]
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    statement_span = start_span('sql', **{'db.statement': statement[:STATEMENT_MAX_LENGTH]})
+    if statement_span is not None:
+        conn.info.setdefault('trace_spans', []).append(statement_span)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    spans = conn.info.get('trace_spans')
+    if spans:
+        statement_span = spans.pop()
+        if cursor is not None and cursor.rowcount is not None and cursor.rowcount >= 0:
+            statement_span.attributes['db.rowcount'] = cursor.rowcount
+        statement_span.finish()
+
+
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    spans = connection.info.get('trace_spans') if connection is not None else None
+    if spans:
+        spans.pop().finish(exception_context.original_exception)
+
+
+def instrument_engine(sync_engine: Engine):
+    """Traces every statement of the engine; pass `sync_engine` of async engines"""
+    if not TRACING_EXPORTER:
+        return
+    event.listen(sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(sync_engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(sync_engine, 'handle_error', _handle_error)
+
+
+def instrument_celery():
+    """Propagates trace context from publishers into Celery tasks"""
+    if not TRACING_EXPORTER:
+        return
+    from celery import signals
+
+    @signals.before_task_publish.connect(weak=False)
+    def inject_traceparent(headers=None, **kwargs):
+        traceparent = current_traceparent()
+        if traceparent is not None and headers is not None:
+            headers[TRACEPARENT_HEADER] = traceparent
+
+    @signals.task_prerun.connect(weak=False)
+    def start_task_span(task=None, **kwargs):
+        # custom headers are request attributes, or in `headers` since Celery 5.3
+        traceparent = (getattr(task.request, TRACEPARENT_HEADER, None)
+                       or (task.request.headers or {}).get(TRACEPARENT_HEADER))
+        task_span = start_span(f'celery {task.name}',
+                               traceparent,
+                               **{'celery.task_id': task.request.id})
+        if task_span is not None:
+            task.request.trace_span = task_span
+            task.request.trace_token = _current_span.set(task_span)
+
+    @signals.task_postrun.connect(weak=False)
+    def finish_task_span(task=None, state=None, **kwargs):
+        task_span = getattr(task.request, 'trace_span', None)
+        if task_span is None:
+            return
+        task_span.attributes['celery.state'] = state
+        _current_span.reset(task.request.trace_token)
+        task_span.finish()
+
+    @signals.task_failure.connect(weak=False)
+    def record_task_error(sender=None, exception=None, **kwargs):
+        task_span = getattr(sender.request, 'trace_span', None)
+        if task_span is not None:
+            task_span.error = f'{type(exception).__name__}: {exception}'
+
+
+def print_waterfall(path: str, trace_id: Optional[str] = None):
+    """Prints spans of the trace, the last one in the file by default, as a waterfall"""
+    with open(path) as file:
+        spans = [json.loads(line) for line in file if line.strip()]
+    if not spans:
+        return
+    trace_id = trace_id or spans[-1]['trace_id']
+    spans = sorted((item for item in spans if item['trace_id'] == trace_id), key=lambda item: item['start'])
+    children = {}
+    for item in spans:
+        children.setdefault(item['parent_id'], []).append(item)
+    span_ids = {item['span_id'] for item in spans}
+    roots = [item for item in spans if item['parent_id'] not in span_ids]
+    started = spans[0]['start']
+
+    def show(item: dict, depth: int):
+        offset = (item['start'] - started) * 1000
+        label = item['name'] if item['name'] != 'sql' else 'sql ' + item['attributes']['db.statement'].split()[0]
+        error = f'  ! {item["error"]}' if item['error'] else ''
+        print(f'{offset:>9.1f} ms {item["duration_ms"]:>9.1f} ms  {"  " * depth}{label}{error}')
+        for child in children.get(item['span_id'], []):
+            show(child, depth + 1)
+
+    print(f'trace {trace_id}')
+    print(f'{"start":>12} {"duration":>12}')
+    for root in roots:
+        show(root, 0)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        sys.exit('Usage: python -m src.tracing traces.jsonl [trace_id]')
+    print_waterfall(*sys.argv[1:])
@@ -1,9 +1,15 @@
 #!/bin/sh
+# Usage: start.sh [prod|dev], prod by default.
+# Migrations are applied by migrate.sh, not here.
 
-sleep 10
-
-alembic upgrade head
+set -e
 
 cd /app/todolist_app
 
-gunicorn src.auth.router:user_app --workers 4 --worker-class uvicorn.workers.UvicornWorker --bind=0.0.0.0:8000 --reload
+python -m src.startup wait-for-db
+
+if [ "${1:-prod}" = "dev" ]; then
+  exec uvicorn src.main:app --host 0.0.0.0 --port 8000 --reload
+fi
+
+exec gunicorn src.main:app --config gunicorn.conf.py
@@ -0,0 +1,150 @@
+import asyncio
+
+import pytest
+
+from src.singleflight import SingleFlight
+
+
+class FakeQuery:
+    """
+    `function(seal)` of a flight: seals once released, then answers
+    once finished
+    """
+
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.running = 0
+        self.max_running = 0
+        self.sealed = asyncio.Event()
+        self.release = asyncio.Event()
+        self.finish = asyncio.Event()
+        self.finish.set()
+
+    async def __call__(self, seal):
+        self.calls += 1
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await self.release.wait()
+            seal()
+            self.sealed.set()
+            # the query is on the wire
+            await self.finish.wait()
+            if self.error is not None:
+                raise self.error
+            return self.result
+        finally:
+            self.running -= 1
+
+
+@pytest.mark.asyncio
+async def test_callers_join_unsealed_flight():
+    flights = SingleFlight()
+    first, second = FakeQuery('first'), FakeQuery('second')
+
+    callers = [asyncio.ensure_future(flights.do('key', first)),
+               asyncio.ensure_future(flights.do('key', second))]
+    await asyncio.sleep(0)
+    first.release.set()
+
+    assert await asyncio.gather(*callers) == ['first', 'first']
+    assert first.calls == 1
+    assert second.calls == 0
+
+
+@pytest.mark.asyncio
+async def test_caller_after_seal_starts_next_flight():
+    flights = SingleFlight()
+    first, second = FakeQuery('first'), FakeQuery('second')
+
+    early = asyncio.ensure_future(flights.do('key', first))
+    first.release.set()
+    await first.sealed.wait()
+    late = asyncio.ensure_future(flights.do('key', second))
+    second.release.set()
+
+    assert await early == 'first'
+    assert await late == 'second'
+    assert (first.calls, second.calls) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_one_query_per_key_at_a_time():
+    flights = SingleFlight()
+    queries = [FakeQuery(number) for number in range(3)]
+    running = []
+
+    def function(query):
+        async def function(seal):
+            running.append(sum(other.running for other in queries))
+            return await query(seal)
+        return function
+
+    for query in queries:
+        query.release.set()
+    queries[0].finish.clear()
+    callers = [asyncio.ensure_future(flights.do('key', function(queries[0])))]
+    await queries[0].sealed.wait()
+    # the next flight waits for the sealed one, later callers join it
+    callers += [asyncio.ensure_future(flights.do('key', function(query))) for query in queries[1:]]
+    await asyncio.sleep(0)
+    queries[0].finish.set()
+
+    assert await asyncio.gather(*callers) == [0, 1, 1]
+    assert [query.calls for query in queries] == [1, 1, 0]
+    assert running == [0, 0]
+
+
+@pytest.mark.asyncio
+async def test_other_keys_are_not_shared():
+    flights = SingleFlight()
+    first, second = FakeQuery('first'), FakeQuery('second')
+    first.release.set()
+    second.release.set()
+
+    assert await asyncio.gather(flights.do('first', first), flights.do('second', second)) == ['first', 'second']
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_leaves_flight_running():
+    flights = SingleFlight()
+    query = FakeQuery('result')
+
+    cancelled = asyncio.ensure_future(flights.do('key', query))
+    waiting = asyncio.ensure_future(flights.do('key', query))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.sleep(0)
+    query.release.set()
+
+    assert await waiting == 'result'
+    assert cancelled.cancelled()
+    assert query.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_error_is_shared_with_all_callers():
+    flights = SingleFlight()
+    error = RuntimeError('query failed')
+    query = FakeQuery(error=error)
+
+    callers = [asyncio.ensure_future(flights.do('key', query)) for _ in range(3)]
+    await asyncio.sleep(0)
+    query.release.set()
+    results = await asyncio.gather(*callers, return_exceptions=True)
+
+    assert results == [error, error, error]
+    assert query.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_finished_flight_is_not_reused():
+    flights = SingleFlight()
+    first, second = FakeQuery('first'), FakeQuery('second')
+    first.release.set()
+    second.release.set()
+
+    assert await flights.do('key', first) == 'first'
+    assert await flights.do('key', second) == 'second'